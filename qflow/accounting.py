@@ -0,0 +1,133 @@
+'''
+Accounting of the resources used by solver processes.
+
+A ``ResourceMonitor`` samples a solver process and all of its descendants
+(e.g. the ranks started by ``mpirun``) with psutil while it runs, and
+combines the samples with the ``rusage`` of reaped children once it has
+exited. Processes which exit between samples are counted up to their
+last sample.
+'''
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def _children_rusage():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_CHILDREN)
+
+
+class ResourceMonitor(object):
+    '''Sample the CPU time, memory and I/O of a process tree.
+
+    ``report`` is called with a snapshot of the tree's usage at most once
+    every ``interval`` seconds, when ``poll`` is called.
+    '''
+    def __init__(self, pid: int, report=None, interval: float=10.0):
+        self.pid = pid
+        self._report = report
+        self._interval = interval
+        self._started = time.monotonic()
+        self._rusage = _children_rusage()
+        # Latest counters of every process seen, keyed by pid and start time
+        # so a reused pid is never mistaken for an earlier process
+        self._processes = {}
+        self._peak_rss = 0
+        self._last = None
+
+    def _tree(self):
+        try:
+            root = psutil.Process(self.pid)
+            return [root] + root.children(recursive=True)
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            return []
+
+    def sample(self):
+        '''Sample the process tree now.
+
+        Returns:
+            dict: the tree's current ``rss`` (MB) and ``processes``, and its
+                totals so far (see ``totals``)
+        '''
+        rss = 0
+        processes = 0
+        if psutil is not None:
+            for process in self._tree():
+                try:
+                    with process.oneshot():
+                        key = (process.pid, process.create_time())
+                        cpu = process.cpu_times()
+                        memory = process.memory_info().rss
+                        try:
+                            io = process.io_counters()
+                            read, written = io.read_bytes, io.write_bytes
+                        except (AttributeError, psutil.AccessDenied):
+                            read = written = 0
+                except (psutil.NoSuchProcess, psutil.AccessDenied):
+                    continue
+                self._processes[key] = (cpu.user, cpu.system, read, written)
+                rss += memory
+                processes += 1
+        self._peak_rss = max(self._peak_rss, rss)
+
+        snapshot = self.totals()
+        snapshot['rss'] = rss // 2**20
+        snapshot['processes'] = processes
+        return snapshot
+
+    def totals(self, final: bool=False):
+        '''Usage of the tree so far: ``user`` and ``system`` CPU seconds, the
+        ``peak_rss`` (MB), ``read_bytes`` and ``write_bytes``, the ``wall``
+        seconds since monitoring started and the mean number of cores used
+        (``cpu_utilisation``).
+
+        If ``final``, CPU time and peak memory also include the ``rusage`` of
+        children reaped since monitoring started.
+        '''
+        user = sum(counters[0] for counters in self._processes.values())
+        system = sum(counters[1] for counters in self._processes.values())
+        peak_rss = self._peak_rss
+
+        if final and self._rusage is not None:
+            rusage = _children_rusage()
+            user = max(user, rusage.ru_utime - self._rusage.ru_utime)
+            system = max(system, rusage.ru_stime - self._rusage.ru_stime)
+            # ru_maxrss is the largest child reaped by this process ever (in KB
+            # on Linux), so it only tells us about this tree if it has grown
+            if rusage.ru_maxrss > self._rusage.ru_maxrss:
+                peak_rss = max(peak_rss, rusage.ru_maxrss * 1024)
+
+        wall = time.monotonic() - self._started
+        return {
+            'user': user,
+            'system': system,
+            'peak_rss': peak_rss // 2**20,
+            'read_bytes': sum(counters[2] for counters in self._processes.values()),
+            'write_bytes': sum(counters[3] for counters in self._processes.values()),
+            'wall': wall,
+            'cpu_utilisation': (user + system) / wall if wall > 0 else None
+        }
+
+    def poll(self):
+        '''Sample and report the usage if ``interval`` has passed
+        '''
+        now = time.monotonic()
+        if self._last is None or now - self._last >= self._interval:
+            self._last = now
+            snapshot = self.sample()
+            if self._report:
+                self._report(snapshot)
+
+    def finish(self):
+        '''Final usage of the tree, once the process has exited
+        '''
+        return self.totals(final=True)
@@ -0,0 +1,420 @@
+'''
+Benchmarks of qflow's own throughput and overhead.
+
+Usage: python -m qflow.benchmark [options]
+
+Drives ``run_tuflow``, ``run_anuga``, ``extract_model`` and
+``workflow.run_multiple`` with a mock solver (see ``qflow/mocksolver.py``)
+standing in for TUFLOW and ANUGA, and reports:
+
+- tasks per second, from the first submission to the last result
+- message events and lines of solver output per second
+- submit to start latency, from submitting a task to its ``task-started`` event
+- per task overhead, the task's runtime less the time the solver ran for
+
+By default the broker and result backend are in memory and a worker is
+started in this process. Pass ``--broker redis://...`` (and ``--backend``)
+with ``--external-worker`` to measure workers started by ``tools/run.sh``.
+Results are written as JSON; pass an earlier file to ``--compare`` to
+print the change in each measurement.
+'''
+import argparse
+import json
+import os
+import platform
+import re
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from contextlib import ExitStack
+
+from qflow import __version__
+from qflow.celery import app
+from qflow.mocksolver import FINISHED
+from qflow.utils import ensure_dir
+
+MOCKSOLVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mocksolver.py')
+DATA_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests', 'data')
+BENCHMARKS = ('run_tuflow', 'run_anuga', 'extract_model', 'run_multiple')
+
+_FINISHED = re.compile(FINISHED.replace('{:.6f}', r'([\d.]+)'))
+_MESSAGE_EVENTS = ('task-tuflow-message', 'task-anuga-message')
+
+
+class EventRecorder(object):
+    '''Record the events of each task, in a background thread
+    '''
+    def __init__(self):
+        self.tasks = {}
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+
+    def _task(self, uuid: str):
+        return self.tasks.setdefault(uuid, {
+            'started': None,
+            'runtime': None,
+            'events': 0,
+            'lines': 0,
+            'solver_runtime': None
+        })
+
+    def _on_event(self, event: dict):
+        kind = event.get('type')
+        if kind == 'qflow-benchmark-probe':
+            self._ready.set()
+            return
+        uuid = event.get('uuid')
+        if not uuid:
+            return
+
+        with self._lock:
+            task = self._task(uuid)
+            if kind == 'task-started':
+                task['started'] = event['timestamp']
+            elif kind in ('task-succeeded', 'task-failed'):
+                task['runtime'] = event.get('runtime')
+            elif kind in _MESSAGE_EVENTS:
+                task['events'] += 1
+                task['lines'] += event.get('lines', 0)
+                match = _FINISHED.search(event.get('stdout') or '')
+                if match:
+                    task['solver_runtime'] = float(match.group(1))
+
+    def _capture(self):
+        with app.connection() as connection:
+            receiver = app.events.Receiver(connection, handlers={'*': self._on_event})
+            receiver.capture(limit=None, timeout=None, wakeup=False)
+
+    def start(self, timeout: float=10.0):
+        '''Start recording, returning once events are being received
+        '''
+        thread = threading.Thread(target=self._capture)
+        thread.daemon = True
+        thread.start()
+
+        deadline = time.monotonic() + timeout
+        with app.events.default_dispatcher() as dispatcher:
+            while not self._ready.wait(0.1):
+                if time.monotonic() > deadline:
+                    raise RuntimeError('No events received from the broker')
+                dispatcher.send('qflow-benchmark-probe')
+
+    def get(self, uuid: str):
+        with self._lock:
+            return dict(self._task(uuid))
+
+
+def _stats(values):
+    '''Mean, median, 95th percentile and maximum of some values
+    '''
+    values = sorted(value for value in values if value is not None)
+    if not values:
+        return None
+
+    def percentile(p):
+        return values[min(len(values) - 1, int(round(p * (len(values) - 1))))]
+
+    return {
+        'mean': sum(values) / len(values),
+        'p50': percentile(0.5),
+        'p95': percentile(0.95),
+        'max': values[-1],
+        'count': len(values)
+    }
+
+
+def _failed(result):
+    if not result.successful():
+        return True
+    value = result.result
+    return isinstance(value, dict) and (
+        value.get('status') in ('FAILURE', 'ABORTED') or 'state' in value)
+
+
+def measure(name: str, signatures, recorder: EventRecorder, timeout: float=600):
+    '''Submit ``signatures`` at once and wait for all their results.
+
+    Returns:
+        dict: The measurements, and the results of the tasks
+    '''
+    submitted = {}
+    results = []
+    start = time.time()
+    for signature in signatures:
+        submit = time.time()
+        result = signature.apply_async()
+        children = getattr(result, 'results', None) or [result]
+        for child in children:
+            submitted[child.id] = submit
+        results.extend(children)
+
+    for result in results:
+        result.get(timeout=timeout, propagate=False, interval=0.05)
+    wall = time.time() - start
+    # Allow the final events to arrive
+    time.sleep(max(app.conf.get('event_batch_interval', 1.0), 0.5))
+
+    tasks = {result.id: recorder.get(result.id) for result in results}
+    latency = [
+        task['started'] - submitted[uuid]
+        for uuid, task in tasks.items() if task['started'] is not None
+    ]
+    overhead = [
+        task['runtime'] - task['solver_runtime']
+        for task in tasks.values()
+        if task['runtime'] is not None and task['solver_runtime'] is not None
+    ]
+    events = sum(task['events'] for task in tasks.values())
+    lines = sum(task['lines'] for task in tasks.values())
+    return {
+        'name': name,
+        'tasks': len(results),
+        'failures': sum(1 for result in results if _failed(result)),
+        'wall_time': wall,
+        'tasks_per_second': len(results) / wall,
+        'events': events,
+        'events_per_second': events / wall,
+        'lines_per_second': lines / wall,
+        'latency': _stats(latency),
+        'overhead': _stats(overhead),
+        'task_runtime': _stats(task['runtime'] for task in tasks.values()),
+        'results': [result.result for result in results]
+    }
+
+
+def _solver_args(options, style: str):
+    args = [
+        '--style', style,
+        '--runtime', options.runtime,
+        '--distribution', options.distribution,
+        '--jitter', options.jitter,
+        '--rate', options.rate,
+        '--stderr-ratio', options.stderr_ratio,
+        '--fail-rate', options.fail_rate,
+    ]
+    return [str(arg) for arg in args]
+
+
+def mock_tuflow_exe(directory: str, options):
+    '''Write an executable which runs the mock solver with ``options``,
+    to pass to ``run_tuflow`` in place of TUFLOW
+    '''
+    path = os.path.join(directory, 'mock_tuflow')
+    with open(path, 'w') as fout:
+        fout.write('#!/bin/sh\nexec "{}" "{}" {} "$@"\n'.format(
+            sys.executable, MOCKSOLVER, ' '.join(_solver_args(options, 'tuflow'))))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return path
+
+
+def mock_anuga_script(directory: str, options, index: int):
+    '''Write an ANUGA script which runs the mock solver with ``options``.
+    It imports anuga, so it needs a working ANUGA environment.
+    '''
+    path = os.path.join(directory, 'mock_anuga_{}.py'.format(index))
+    with open(path, 'w') as fout:
+        fout.write(
+            'import anuga\nimport runpy\nimport sys\n'
+            'sys.argv = {!r}\n'
+            'runpy.run_path({!r}, run_name="__main__")\n'.format(
+                [MOCKSOLVER] + _solver_args(options, 'anuga'), MOCKSOLVER))
+    return path
+
+
+def bench_run_tuflow(options, workdir: str, recorder: EventRecorder):
+    from qflow import tasks
+    model = os.path.join(workdir, 'tuflow')
+    shutil.copytree(options.data, model)
+    tcf_file = os.path.join(model, options.tcf)
+    exe = mock_tuflow_exe(workdir, options)
+    return measure(
+        'run_tuflow',
+        [tasks.run_tuflow.s(tcf_file, exe) for _ in range(options.tasks)],
+        recorder
+    )
+
+
+def bench_run_multiple(options, workdir: str, recorder: EventRecorder):
+    from qflow import workflow
+    model = os.path.join(workdir, 'multiple')
+    shutil.copytree(options.data, model)
+    tcf_file = os.path.join(model, options.tcf)
+    exe = mock_tuflow_exe(workdir, options)
+    return measure(
+        'run_multiple',
+        [workflow.run_multiple([tcf_file] * options.tasks, exe)],
+        recorder
+    )
+
+
+def bench_run_anuga(options, workdir: str, recorder: EventRecorder):
+    from qflow import tasks
+    model = os.path.join(workdir, 'anuga')
+    os.makedirs(model)
+    scripts = [mock_anuga_script(model, options, i) for i in range(options.tasks)]
+    return measure(
+        'run_anuga',
+        [tasks.run_anuga.s(script, env_name=options.anuga_env) for script in scripts],
+        recorder
+    )
+
+
+def bench_extract_model(options, workdir: str, recorder: EventRecorder):
+    from qflow import tasks
+    archive_path = os.path.join(workdir, 'model.zip')
+    with zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        block = os.urandom(1024) * (options.file_size // 1024)
+        for i in range(options.files):
+            archive.writestr('model/input_{}.dat'.format(i), block)
+        archive.writestr('model.tcf', '')
+
+    # Archives are removed once extracted, so each task gets its own copy
+    archives = []
+    for i in range(options.tasks):
+        archives.append(os.path.join(workdir, 'model_{}.zip'.format(i)))
+        shutil.copyfile(archive_path, archives[-1])
+
+    extracted = os.path.join(workdir, 'extracted')
+    os.makedirs(extracted)
+    measurements = measure(
+        'extract_model',
+        [
+            tasks.extract_model.s(path, 'model_{}'.format(i), extracted)
+            for i, path in enumerate(archives)
+        ],
+        recorder
+    )
+    rates = [
+        result['bytes_per_second'] for result in measurements['results']
+        if isinstance(result, dict)
+    ]
+    measurements['bytes_per_second'] = _stats(rates)
+    return measurements
+
+
+def compare(current: dict, previous: dict):
+    '''Print the change in each measurement since a previous run
+    '''
+    for name, bench in sorted(current['benchmarks'].items()):
+        before = previous.get('benchmarks', {}).get(name)
+        if not before:
+            continue
+        print(name)
+        for key, value in sorted(bench.items()):
+            old = before.get(key)
+            if isinstance(value, dict) and isinstance(old, dict):
+                value, old, key = value.get('mean'), old.get('mean'), key + ' (mean)'
+            if isinstance(value, (int, float)) and isinstance(old, (int, float)) and old:
+                print('  {:<24} {:>12.4g} -> {:<12.4g} ({:+.1f}%)'.format(
+                    key, old, value, 100.0 * (value - old) / old))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark qflow')
+    parser.add_argument('benchmarks', nargs='*',
+                        help='Any of {}; all but run_anuga by default'.format(', '.join(BENCHMARKS)))
+    parser.add_argument('--broker', default='memory://')
+    parser.add_argument('--backend', default='cache+memory://')
+    parser.add_argument('--external-worker', action='store_true',
+                        help='Use running workers rather than starting one')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--pool', default='threads',
+                        help='Pool of the worker started by the benchmark')
+    parser.add_argument('--tasks', type=int, default=20,
+                        help='Tasks submitted by each benchmark')
+    parser.add_argument('--runtime', type=float, default=1.0,
+                        help='Mean runtime of the mock solver in seconds')
+    parser.add_argument('--distribution', default='fixed',
+                        choices=('fixed', 'uniform', 'exponential'))
+    parser.add_argument('--jitter', type=float, default=0.5)
+    parser.add_argument('--rate', type=float, default=500.0,
+                        help='Lines per second written by the mock solver')
+    parser.add_argument('--stderr-ratio', type=float, default=0.05)
+    parser.add_argument('--fail-rate', type=float, default=0.0)
+    parser.add_argument('--files', type=int, default=50,
+                        help='Files in the archives extracted by extract_model')
+    parser.add_argument('--file-size', type=int, default=1024 * 1024)
+    parser.add_argument('--data', default=DATA_DIR,
+                        help='Folder holding the TUFLOW model to run')
+    parser.add_argument('--tcf', default='M01_5m_001.tcf')
+    parser.add_argument('--anuga-env', default='anuga')
+    parser.add_argument('--output', default=os.path.join('build', 'benchmark.json'),
+                        help='File to write the results to')
+    parser.add_argument('--compare', default=None,
+                        help='Earlier results to compare against')
+    options = parser.parse_args(argv)
+    benchmarks = options.benchmarks or [name for name in BENCHMARKS if name != 'run_anuga']
+    for name in benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('Unknown benchmark {}'.format(name))
+
+    workdir = tempfile.mkdtemp(prefix='qflow-benchmark-')
+    app.conf.update(
+        broker_url=options.broker,
+        result_backend=options.backend,
+        worker_send_task_events=True,
+        task_send_sent_event=True,
+        resource_ledger=os.path.join(workdir, 'resources.json'),
+        worker_cores=max(options.concurrency, app.conf.get('worker_cores', None) or 0),
+        resource_retry_delay=1
+    )
+    if options.broker.startswith('memory://'):
+        # The in memory transport polls once a second by default, which
+        # would swamp the latency being measured
+        app.conf.broker_transport_options = {'polling_interval': 0.01}
+
+    report = {
+        'version': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.time(),
+        'options': vars(options),
+        'benchmarks': {}
+    }
+    functions = {
+        'run_tuflow': bench_run_tuflow,
+        'run_anuga': bench_run_anuga,
+        'extract_model': bench_extract_model,
+        'run_multiple': bench_run_multiple,
+    }
+    try:
+        with ExitStack() as stack:
+            if not options.external_worker:
+                from celery.contrib.testing.worker import start_worker
+                queues = ['celery'] + [queue['name'] for queue in app.conf.get('resource_queues')]
+                stack.enter_context(start_worker(
+                    app,
+                    concurrency=options.concurrency,
+                    pool=options.pool,
+                    perform_ping_check=False,
+                    queues=queues
+                ))
+            recorder = EventRecorder()
+            recorder.start()
+
+            for name in benchmarks:
+                measurements = functions[name](options, workdir, recorder)
+                del measurements['results']
+                report['benchmarks'][name] = measurements
+                print('{name}: {tasks} tasks, {failures} failed, {tasks_per_second:.2f} tasks/s, '
+                      '{events_per_second:.1f} events/s'.format(**measurements))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    ensure_dir(os.path.dirname(os.path.abspath(options.output)))
+    with open(options.output, 'w') as fout:
+        json.dump(report, fout, indent=2)
+
+    if options.compare:
+        with open(options.compare) as fin:
+            compare(report, json.load(fin))
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -3,10 +3,200 @@ import os
 broker_url = 'redis://localhost:6379/0'
 result_backend = 'redis://localhost:6379/0'
 result_persistent = True
-task_result_expires = None
 send_events = True
 task_track_started = True
+
+# Solver output is sent in batched events. A batch is flushed after
+# this many lines, bytes or seconds, whichever is reached first.
+event_batch_lines = 200
+event_batch_bytes = 32768
+event_batch_interval = 1.0
+# Maximum message events per second from a single task. Lines beyond
+# ``event_max_pending`` are dropped while the limit holds back a flush.
+event_rate_limit = 2.0
+event_max_pending = 5000
+# Solver output is also written to solver.log in the run's log folder
+# (the results folder for ANUGA). Once the log reaches solver_log_max_bytes
+# it is compressed to solver.log.<n>.gz and a new log started; only the
+# newest solver_log_backups segments are kept (None keeps them all). If
+# stream_solver_output is False, message events carry only line counts and
+# clients read the output with the tail_log task, which returns at most
+# tail_log_max_bytes at once.
+solver_log_max_bytes = 16 * 1024 * 1024
+solver_log_backups = None
+stream_solver_output = True
+tail_log_max_bytes = 1024 * 1024
+
+# Parsers for structured progress in solver output, and the minimum
+# number of seconds between ``task-progress`` events from a task
+progress_parsers = {
+    'tuflow': 'qflow.progress.TuflowProgressParser',
+    'anuga': 'qflow.progress.AnugaProgressParser',
+}
+progress_interval = 5.0
+
+# Rules for stopping unstable runs early, by solver (see qflow.watchdog).
+# A run is aborted when its cumulative mass error (%) exceeds
+# max_mass_error, its timestep stays below min_timestep for
+# timestep_patience reports, max_warnings lines match warning_pattern or
+# its simulated time has not advanced for stall_timeout seconds. Rules set
+# to None are disabled, and all are disabled by default. To enable a rule,
+# set it here for every run of a solver, e.g.
+#
+#     watchdog_rules['tuflow'].update(max_mass_error=5.0, stall_timeout=3600)
+#
+# or for a single run by passing a ``watchdog`` dict to run_tuflow or
+# run_anuga, e.g. ``watchdog={'min_timestep': 1e-6}``.
+watchdog_rules = {
+    'tuflow': {
+        'max_mass_error': None,
+        'min_timestep': None,
+        'warning_pattern': None,
+        'max_warnings': None,
+        'stall_timeout': None,
+    },
+    'anuga': {
+        'max_mass_error': None,
+        'min_timestep': None,
+        'warning_pattern': None,
+        'max_warnings': None,
+        'stall_timeout': None,
+    },
+}
+# Seconds an aborted run has to exit before it is killed
+watchdog_kill_timeout = 10
+
+# Seconds between samples of the CPU, memory and I/O used by a running
+# solver, each sent as a ``task-resource-usage`` event
+resource_sample_interval = 10.0
+
+# Folder each worker process writes histograms of its tasks' phase
+# timings to, in the Prometheus text format (e.g. the node_exporter
+# textfile collector directory). None disables the export.
+metrics_dir = None
+metrics_buckets = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600, 14400, 43200)
+
+# Threads compressing packages of run outputs (None uses every core),
+# the gzip level and the size of the blocks compressed independently
+package_workers = None
+package_level = 6
+package_block_size = 1024 * 1024
+
+# Threads used to extract uploaded zip files; None uses one per CPU
+extract_workers = None
+# Directory for de-duplicating extracted input files. Must be on the same
+# filesystem as the model directories so files can be hardlinked; if it is
+# not, models are extracted without it.
+blob_store = None
+blob_store_min_size = 1024 * 1024
+
+# Node-local scratch folder TUFLOW models are copied to before they run,
+# so solvers read their inputs from local disk rather than shared storage
+# (see qflow.staging). Inputs are cached there by content, evicting the
+# least recently used once the cache holds staging_cache_max_bytes. None
+# runs models where they are.
+staging_dir = None
+staging_cache_max_bytes = 50 * 1024**3
+
+# Number of parsed control file trees each worker process keeps in memory
+parse_cache_size = 64
+# Threads used to check referenced files exist in exhaustive validation
+validation_workers = 32
+
+# Solver tasks are routed to the smallest of these queues which fits the
+# ``cores`` and ``memory`` (MB) they ask for. Workers only consume the
+# queues which fit their node; see qflow.routing and tools/run.sh
+resource_queues = [
+    {'name': 'qflow.small', 'cores': 1, 'memory': 4096},
+    {'name': 'qflow.medium', 'cores': 4, 'memory': 16384},
+    {'name': 'qflow.large', 'cores': 16, 'memory': 65536},
+]
+# Resources of a node; detected if None
+worker_cores = None
+worker_memory = None
+# Seconds before retrying a task which does not fit in a node's free resources
+resource_retry_delay = 30
+# Only reserve one task per pool process, so tasks wait in the queue for
+# a node with free resources instead of on a busy worker
+worker_prefetch_multiplier = 1
+task_acks_late = True
+
+# Split each Redis queue into one list per priority level, which workers
+# consume highest priority first (0 is the highest). run_multiple gives the
+# models it predicts will run longest the highest priority.
+#
+# With late acks, Redis delivers a task again to another worker if it is
+# not acknowledged within visibility_timeout seconds, so this must be
+# longer than the longest solver run or long runs are run twice. Tasks of
+# a worker which is lost are only delivered again after this time.
+broker_transport_options = {
+    'priority_steps': list(range(10)),
+    'visibility_timeout': 7 * 24 * 3600,
+}
+
+# Results expire from Redis after this many seconds, so its memory stays
+# bounded. Finished results are copied to the SQLite database in
+# result_archive every result_archive_interval seconds before then, by a
+# task scheduled by celery beat (see qflow.results and tools/run.sh), so
+# they can still be looked up. None does not archive results.
+result_expires = 3 * 24 * 3600
+result_archive = None
+result_archive_interval = 15 * 60
+beat_schedule = {
+    'archive-results': {
+        'task': 'qflow.tasks.archive_results',
+        'schedule': result_archive_interval,
+    },
+}
+
+# Return the result of an earlier successful run with the same model,
+# inputs, solver and arguments instead of running a model again (see
+# qflow.memo). Runs may override this with ``memoise``. Identical runs
+# submitted while one is in flight wait for it, checking every
+# memo_wait_interval seconds. Results are remembered for memo_ttl seconds
+# and a run's claim on its fingerprint lasts at most memo_claim_ttl.
+memoise_runs = False
+memo_ttl = 30 * 24 * 3600
+memo_claim_ttl = 24 * 3600
+memo_wait_interval = 30
+
+# SQLite database of past TUFLOW runtimes, used to predict the runtimes
+# of new runs (see qflow.history). Workers record runs to it and clients
+# read it. SQLite's locking is unreliable on network file systems such as
+# NFS, so keep it on local disk where possible; a run whose runtime can't
+# be recorded still succeeds, with the error under history_error in its
+# result. None keeps no history. Predictions for a model average its last
+# history_recent_runs runs.
+history_db = None
+history_recent_runs = 5
+
+# Run serial ANUGA scripts in children forked from interpreters which
+# have already imported these modules, instead of a new interpreter.
+# Interpreters are replaced after a number of runs or once they use more
+# than a given amount of memory (MB)
+anuga_warm_pool = False
+anuga_preload = ['anuga', 'numpy', 'netCDF4']
+anuga_pool_max_runs = 50
+anuga_pool_max_memory = 2048
+
+# Summarise the .sww files of successful ANUGA runs into per-vertex
+# maxima (see qflow/swwsummary.py). The summariser reads the results in
+# chunks using about anuga_summary_max_memory MB, and treats vertices
+# shallower than anuga_summary_minimum_depth (m) as dry.
+anuga_summarise = False
+anuga_summary_max_memory = 256
+anuga_summary_minimum_depth = 1e-3
+
+# Emails are sent by a task on their own queue; see tools/run.sh
+task_routes = (
+    'qflow.routing.route_task',
+    {'qflow.tasks.send_notification': {'queue': 'notifications'}}
+)
+# Errors from a running task are emailed at most this often (seconds)
+notification_digest_interval = 300
+
 smtp_host = 'smtp.gmail.com'
 smtp_port = 587
+smtp_starttls = True
 smtp_user = os.environ.get('SMTP_USER', '')
 smtp_password = os.environ.get('SMTP_PASSWORD', '')
@@ -2,11 +2,109 @@
 Validation and formatting for Anuga & Tuflow entry point scripts.
 '''
 import os
+import copy
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from ship.utils.fileloaders.fileloader import FileLoader
 from ship.tuflow import FILEPART_TYPES as fpt
 
-from qflow.utils import ensure_dir
+from qflow.utils import allocate_numbered_dir, replace_file
+from qflow.controlfiles import control_file_tree, referenced_paths, find_path
+
+
+class ValidationError(IOError):
+    '''Raised when files referenced by a model are missing.
+    ``missing`` lists each missing path with the statement referencing it.
+    '''
+    def __init__(self, missing):
+        self.missing = missing
+        lines = '\n\t'.join(
+            '{} ({})'.format(path, statement) for path, statement in missing
+        )
+        super(ValidationError, self).__init__(
+            'The following referenced files do not exist:\n\t{}'.format(lines)
+        )
+
+
+def find_missing_paths(tcf_files, workers: int=32):
+    '''Check the input files of several models exist.
+
+    Paths are de-duplicated across all models and their includes, then
+    stat'd concurrently, which hides the latency of network filesystems.
+
+    Returns:
+        dict: Mapping each control file to a list of ``(path, statement)``
+            tuples for its missing files
+    '''
+    references = {tcf: referenced_paths(tcf) for tcf in tcf_files}
+    paths = set(path for refs in references.values() for path in refs)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        exists = dict(zip(paths, pool.map(lambda path: find_path(path) is not None, paths)))
+
+    return {
+        tcf: [(path, statement) for path, (_, statement) in refs.items() if not exists[path]]
+        for tcf, refs in references.items()
+    }
+
+
+class ParseCache(object):
+    '''LRU cache of parsed TUFLOW models.
+
+    Models are keyed on the path of their control file. An entry is only
+    used while every file in its control file tree has the same
+    modification time and size as when it was parsed. Callers always get
+    their own copy, as formatting edits the model.
+    '''
+    def __init__(self, maxsize: int=64):
+        self.maxsize = maxsize
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _signature(tree):
+        signature = []
+        for path in tree:
+            try:
+                stat = os.stat(path)
+                signature.append((path, stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                signature.append((path, None, None))
+        return tuple(signature)
+
+    def load(self, tcf_file: str):
+        '''Return a parsed copy of the model in ``tcf_file``
+        '''
+        key = os.path.abspath(tcf_file)
+        with self._lock:
+            entry = self._models.get(key)
+
+        # Check the files the model was built from are unchanged. Includes can
+        # only change if one of these files has, so statting them is enough.
+        if entry and self._signature(path for path, _, _ in entry[0]) == entry[0]:
+            with self._lock:
+                if key in self._models:
+                    self._models.move_to_end(key)
+            return copy.deepcopy(entry[1])
+
+        signature = self._signature(control_file_tree(key))
+        model = FileLoader().loadFile(tcf_file, version=2)
+        if self.maxsize:
+            with self._lock:
+                self._models[key] = (signature, copy.deepcopy(model))
+                self._models.move_to_end(key)
+                while len(self._models) > self.maxsize:
+                    self._models.popitem(last=False)
+        return model
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+
+
+parse_cache = ParseCache()
 
 class TuflowModelFormatter(object):
     '''Validate and format a control file
@@ -17,30 +115,26 @@ class TuflowModelFormatter(object):
 
     def __init__(self, tcf_file: str):
 
-        self.model = FileLoader().loadFile(tcf_file, version=2)
+        self.model = parse_cache.load(tcf_file)
         self.tcf_file = tcf_file
 
     def _create_folder(self, root, name):
-        i = 0
-        while True:
-            path = os.path.join(
-                root,
-                name,
-                str(i).zfill(3)
-            )
-            if os.path.isdir(path):
-                i += 1
-            else:
-                break
-
-        ensure_dir(path)
-        return path
-
-    def validate_model(self):
+        return allocate_numbered_dir(os.path.join(root, name))
+
+    def validate_model(self, exhaustive: bool=False, workers: int=32):
         '''
         Validate the referenced files in a tcf_file exist;
-        breaks on first failure
+        breaks on first failure.
+
+        If ``exhaustive``, every referenced file is checked concurrently
+        and a ``ValidationError`` listing all missing files is raised.
         '''
+        if exhaustive:
+            missing = find_missing_paths([self.tcf_file], workers)[self.tcf_file]
+            if missing:
+                raise ValidationError(missing)
+            return
+
         result = next(self.model.checkPathsExist(), None)
         if result:
             msg = 'The file path in the following statement does not exist:\n\t{}'.format(result[0])
@@ -86,7 +180,7 @@ class TuflowModelFormatter(object):
             appender(log_cmd, log_path)
 
         # Overwrite the control file
-        with open(self.tcf_file, 'w') as fout:
+        with replace_file(self.tcf_file) as fout:
             self.model.control_file_tree.write(out=fout)
 
         return out_path, check_path, log_path
@@ -135,7 +229,7 @@ class AnugaModelFormatter(TuflowModelFormatter):
             contents.insert(0, "import anuga\n{}".format(default_datadir_string))
 
         # Overwrite the script
-        with open(self._script, 'w') as fout:
+        with replace_file(self._script) as fout:
             fout.writelines(contents)
 
         return results_path
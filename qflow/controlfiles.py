@@ -0,0 +1,235 @@
+'''
+Lightweight reading of TUFLOW control files.
+
+Statements are read as plain ``command == value`` pairs and includes are
+followed without building a full model, which makes these functions
+cheap enough for cache keys and path checks.
+'''
+import os
+import re
+import threading
+from collections import OrderedDict
+
+# Files which contain further control statements
+CONTROL_FILE_EXTENSIONS = frozenset((
+    '.tcf', '.tgc', '.tbc', '.ecf', '.trd', '.tef', '.toc', '.tesf',
+    '.tscf', '.trfc', '.qcf'
+))
+
+# Commands whose values are output locations rather than inputs
+OUTPUT_COMMAND_PREFIXES = ('output', 'write', 'log folder')
+
+# Output locations TuflowModelFormatter rewrites for every run
+FORMATTED_COMMANDS = frozenset(('output folder', 'write check files', 'log folder'))
+
+# A file extension starts with a letter, so values like '36.5' are excluded
+_EXTENSION = re.compile(r'^\.[a-z][a-z0-9_]{0,7}$', re.IGNORECASE)
+
+
+class _StatementCache(object):
+    '''LRU cache of the statements in a control file, keyed on its path,
+    modification time and size so a changed file is always re-read
+    '''
+    def __init__(self, maxsize: int=256):
+        self.maxsize = maxsize
+        self._files = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path: str):
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._files.get(path)
+            if entry and entry[0] == key:
+                self._files.move_to_end(path)
+                return entry[1]
+
+        statements = tuple(_parse_statements(path))
+        with self._lock:
+            self._files[path] = (key, statements)
+            self._files.move_to_end(path)
+            while len(self._files) > self.maxsize:
+                self._files.popitem(last=False)
+        return statements
+
+
+def _parse_statements(path: str):
+    with open(path, errors='replace') as fin:
+        for line in fin:
+            # '!' and '#' start a comment
+            line = line.split('!', 1)[0].split('#', 1)[0]
+            if '==' not in line:
+                continue
+            command, value = line.split('==', 1)
+            yield command.strip(), value.strip()
+
+
+statement_cache = _StatementCache()
+
+
+def read_statements(path: str):
+    '''Return the ``(command, value)`` statements in a control file
+    '''
+    return statement_cache.get(os.path.abspath(path))
+
+
+def resolve(control_file: str, value: str):
+    '''Resolve a path in a control file, which may use Windows separators
+    and is relative to the control file it appears in
+    '''
+    value = value.strip().strip('"').replace('\\', '/')
+    root = os.path.dirname(os.path.abspath(control_file))
+    return os.path.normpath(os.path.join(root, value))
+
+
+def find_path(path: str):
+    '''Find a file, ignoring case if it isn't found as given.
+
+    TUFLOW is a Windows program, so models often refer to files with
+    the wrong case. Returns the path on disk or None if there is none.
+    '''
+    if os.path.exists(path):
+        return path
+
+    head, tail = os.path.split(path)
+    if not tail or head == path:
+        return None
+    parent = find_path(head)
+    if parent is None or not os.path.isdir(parent):
+        return None
+
+    lowered = tail.lower()
+    for name in os.listdir(parent):
+        if name.lower() == lowered:
+            return os.path.join(parent, name)
+    return None
+
+
+def includes(control_file: str):
+    '''Paths of the control files directly included by ``control_file``
+    '''
+    for _, value in read_statements(control_file):
+        for part in value.split('|'):
+            if os.path.splitext(part.strip())[1].lower() in CONTROL_FILE_EXTENSIONS:
+                yield resolve(control_file, part)
+
+
+def control_file_tree(tcf_file: str):
+    '''All control files making up a model, starting with ``tcf_file``.
+
+    Included files which don't exist are listed but not followed.
+    '''
+    tree = []
+    seen = set()
+    pending = [os.path.abspath(tcf_file)]
+    while pending:
+        path = pending.pop(0)
+        if path in seen:
+            continue
+        seen.add(path)
+
+        found = find_path(path)
+        tree.append(found or path)
+        if found:
+            pending.extend(includes(found))
+    return tree
+
+
+def _is_path(value: str):
+    value = value.strip().strip('"')
+    # Skip paths built from scenario/event variables, which we can't resolve
+    if not value or '<<' in value:
+        return False
+    return bool(_EXTENSION.match(os.path.splitext(value)[1]))
+
+
+def referenced_paths(tcf_file: str):
+    '''Find the input files referenced anywhere in a model.
+
+    Returns:
+        OrderedDict: Mapping each absolute path to the control file and
+            statement which first references it
+    '''
+    references = OrderedDict()
+    for control_file in control_file_tree(tcf_file):
+        if not os.path.exists(control_file):
+            continue
+        for command, value in read_statements(control_file):
+            if command.lower().startswith(OUTPUT_COMMAND_PREFIXES):
+                continue
+            for part in value.split('|'):
+                if _is_path(part):
+                    references.setdefault(
+                        resolve(control_file, part),
+                        (control_file, '{} == {}'.format(command, value))
+                    )
+    return references
+
+
+def read_value(tcf_file: str, command: str):
+    '''The value last given to ``command`` in a model, or None
+    '''
+    value = None
+    command = command.lower()
+    for control_file in control_file_tree(tcf_file):
+        if os.path.exists(control_file):
+            for name, statement_value in read_statements(control_file):
+                if name.lower() == command:
+                    value = statement_value
+    return value
+
+
+def simulation_times(tcf_file: str):
+    '''The simulated start and end times of a model in seconds.
+    Either may be None if it is not set.
+    '''
+    times = []
+    for command in ('Start Time', 'End Time'):
+        value = read_value(tcf_file, command)
+        try:
+            times.append(float(value.split()[0]) * 3600)
+        except (AttributeError, IndexError, ValueError):
+            times.append(None)
+    return tuple(times)
+
+
+def write_variant(tcf_file: str, path: str, overrides: dict):
+    '''Write a copy of a control file with the statements in ``overrides``
+    (a mapping of command to value) set.
+
+    Every statement of an overridden command is rewritten, keeping its
+    comment; commands not already in the file are appended. Included
+    control files and inputs are not copied, so ``path`` should be in the
+    same folder as ``tcf_file`` for relative paths to resolve.
+    '''
+    values = {command.lower(): value for command, value in overrides.items()}
+    found = set()
+    lines = []
+    newline = '\n'
+    # Keep the file's line endings; TUFLOW models are usually written on Windows
+    with open(tcf_file, errors='replace', newline='') as fin:
+        for line in fin:
+            statement = line.rstrip('\r\n')
+            newline = line[len(statement):] or newline
+            comment = ''
+            for marker in ('!', '#'):
+                if marker in statement:
+                    statement, rest = statement.split(marker, 1)
+                    comment = marker + rest + comment
+            command = statement.split('==', 1)[0].strip()
+            if '==' in statement and command.lower() in values:
+                found.add(command.lower())
+                indent = statement[:len(statement) - len(statement.lstrip())]
+                line = '{}{} == {}'.format(indent, command, values[command.lower()])
+                line = '{}  {}{}'.format(line, comment, newline) if comment else line + newline
+            lines.append(line)
+
+    if lines and not lines[-1].endswith(('\r', '\n')):
+        lines[-1] += newline
+    for command, value in overrides.items():
+        if command.lower() not in found:
+            lines.append('{} == {}{}'.format(command, value, newline))
+
+    with open(path, 'w', newline='') as fout:
+        fout.writelines(lines)
+    return path
@@ -0,0 +1,159 @@
+'''
+Coalescing of solver output into task events and notifications.
+'''
+import time
+from collections import deque, OrderedDict
+
+
+class EventBatcher(object):
+    '''Buffer lines of solver output and send them as a single event.
+
+    A batch is flushed once it holds ``max_lines`` lines or ``max_bytes``
+    bytes, or its oldest line is ``interval`` seconds old. No more than
+    ``rate_limit`` events are sent per second; while the limit holds
+    back a flush, up to ``max_pending`` lines are kept and older lines
+    are dropped. The number of dropped lines is sent with the next event.
+
+    ``send`` is called with ``stdout``, ``stderr``, ``lines`` and
+    ``dropped`` keyword arguments, e.g. a partially applied
+    ``Task.send_event``.
+    '''
+    def __init__(
+            self,
+            send,
+            max_lines: int=200,
+            max_bytes: int=32768,
+            interval: float=1.0,
+            rate_limit: float=2.0,
+            max_pending: int=5000):
+        self._send = send
+        self._max_lines = max_lines
+        self._max_bytes = max_bytes
+        self._interval = interval
+        self._min_gap = 1.0 / rate_limit if rate_limit else 0.0
+        self._max_pending = max(max_pending, max_lines)
+
+        self._pending = deque()
+        self._bytes = 0
+        self._dropped = 0
+        self._oldest = None
+        self._last_flush = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+    def add(self, stream: str, line: str):
+        '''Add a line of output from ``stream`` ('stdout' or 'stderr')
+        '''
+        if len(self._pending) >= self._max_pending:
+            _, oldest = self._pending.popleft()
+            self._bytes -= len(oldest.encode('utf-8'))
+            self._dropped += 1
+
+        self._pending.append((stream, line))
+        self._bytes += len(line.encode('utf-8'))
+        if self._oldest is None:
+            self._oldest = time.monotonic()
+        self.poll()
+
+    def poll(self):
+        '''Flush the buffered lines if a limit has been reached and
+        the rate limit allows it
+        '''
+        if not self._pending:
+            return
+
+        now = time.monotonic()
+        due = (
+            len(self._pending) >= self._max_lines or
+            self._bytes >= self._max_bytes or
+            now - self._oldest >= self._interval
+        )
+        if due and (self._last_flush is None or now - self._last_flush >= self._min_gap):
+            self.flush()
+
+    def flush(self):
+        '''Send all buffered lines as one event, ignoring the limits
+        '''
+        if not self._pending and not self._dropped:
+            return
+
+        output = {'stdout': [], 'stderr': []}
+        for stream, line in self._pending:
+            output[stream].append(line)
+
+        self._send(
+            stdout=''.join(output['stdout']),
+            stderr=''.join(output['stderr']),
+            lines=len(self._pending),
+            dropped=self._dropped
+        )
+
+        self._pending.clear()
+        self._bytes = 0
+        self._dropped = 0
+        self._oldest = None
+        self._last_flush = time.monotonic()
+
+
+class ErrorDigest(object):
+    '''Collect error messages and send them as a periodic digest.
+
+    Repeated messages are counted rather than repeated. The first error
+    is sent straight away; after that ``send`` is called with the digest
+    text at most once every ``interval`` seconds, and only if there have
+    been errors since the last digest. It should not block, e.g. it could
+    queue a notification task.
+    '''
+    def __init__(self, send, interval: float=300.0, max_messages: int=50):
+        self._send = send
+        self._interval = interval
+        self._max_messages = max_messages
+        self._messages = OrderedDict()
+        self._total = 0
+        self._last_sent = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+    def add(self, message: str):
+        message = message.strip()
+        if not message:
+            return
+        self._total += 1
+        if message in self._messages or len(self._messages) < self._max_messages:
+            self._messages[message] = self._messages.get(message, 0) + 1
+        self.poll()
+
+    def poll(self):
+        '''Send a digest if the interval has passed since the last one
+        '''
+        if not self._total:
+            return
+        if self._last_sent is None or time.monotonic() - self._last_sent >= self._interval:
+            self.flush()
+
+    def flush(self):
+        '''Send any collected errors now
+        '''
+        if not self._total:
+            return
+
+        lines = ['[x{}] {}'.format(count, message) for message, count in self._messages.items()]
+        shown = sum(self._messages.values())
+        if shown < self._total:
+            lines.append('... and {} more'.format(self._total - shown))
+        self._send(
+            '{} error messages ({} distinct):\n\t{}'.format(
+                self._total, len(self._messages), '\n\t'.join(lines))
+        )
+
+        self._messages.clear()
+        self._total = 0
+        self._last_sent = time.monotonic()
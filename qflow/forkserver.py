@@ -0,0 +1,106 @@
+'''
+A fork server for running Python scripts with heavy modules pre-imported.
+
+This file is run as a script by the Python interpreter of a conda
+environment (which may be Python 2), so it only uses the standard library
+and must not import qflow. See ``qflow.pool`` for the worker side.
+
+Usage: python forkserver.py MAX_RUNS [MODULE ...]
+
+Each MODULE is imported once at start up. The server then reads one JSON
+request per line from stdin::
+
+    {"script": "/path/to/script.py", "stdout": "/fifo", "stderr": "/fifo"}
+
+and forks a child which runs the script with its output written to the
+given FIFOs. The server replies on stdout with ``{"pid": ...}`` once the
+child is started and ``{"returncode": ...}`` once it has exited. After
+MAX_RUNS scripts the server exits so it can be replaced.
+'''
+import json
+import os
+import runpy
+import sys
+import traceback
+
+
+def _reply(**message):
+    sys.stdout.write(json.dumps(message) + '\n')
+    sys.stdout.flush()
+
+
+def _run_child(request):
+    '''Run a script in the forked child. Never returns.
+    '''
+    code = 1
+    try:
+        os.setsid()
+        script = request['script']
+        directory = os.path.dirname(os.path.abspath(script))
+        os.chdir(directory)
+
+        for fd, path in ((1, request['stdout']), (2, request['stderr'])):
+            fifo = os.open(path, os.O_WRONLY)
+            os.dup2(fifo, fd)
+            os.close(fifo)
+        sys.stdin.close()
+        # Line buffer Python's own output, so it is streamed as it is written
+        sys.stdout = os.fdopen(os.dup(1), 'w', 1)
+        sys.stderr = os.fdopen(os.dup(2), 'w', 1)
+
+        sys.argv = [script]
+        sys.path[0] = directory
+        try:
+            runpy.run_path(script, run_name='__main__')
+            code = 0
+        except SystemExit as error:
+            if error.code is None:
+                code = 0
+            elif isinstance(error.code, int):
+                code = error.code
+            else:
+                sys.stderr.write('{}\n'.format(error.code))
+                code = 1
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code)
+
+
+def main():
+    max_runs = int(sys.argv[1])
+    for module in sys.argv[2:]:
+        try:
+            __import__(module)
+        except ImportError:
+            sys.stderr.write('Could not preload {}\n'.format(module))
+    _reply(ready=True)
+
+    for _ in range(max_runs):
+        line = sys.stdin.readline()
+        if not line:
+            break
+        request = json.loads(line)
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            _run_child(request)
+
+        _reply(pid=pid)
+        _, status = os.waitpid(pid, 0)
+        if os.WIFSIGNALED(status):
+            returncode = -os.WTERMSIG(status)
+        else:
+            returncode = os.WEXITSTATUS(status)
+        _reply(returncode=returncode)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+'''
+History of TUFLOW runtimes, used to predict how long a model will take.
+
+Runs are recorded in a SQLite database (the ``history_db`` setting) with
+features read from the model's control files:
+
+- ``control_hash``: a hash of the statements in the control file tree,
+  ignoring output locations, which qflow rewrites for every run
+- ``cells``: the number of 2D cells, from the grid and cell size in the .tgc
+- ``start_time`` and ``end_time``: the simulated period, in seconds
+- ``timestep``: the 2D timestep in the .tcf, in seconds
+
+A model which has run before is predicted to take as long as it did
+recently. Otherwise the prediction scales the typical runtime per
+cell-timestep of past runs by the model's number of cell-timesteps.
+'''
+import hashlib
+import os
+import re
+import sqlite3
+import time
+from collections import namedtuple
+from contextlib import closing
+
+from qflow import controlfiles
+
+_NUMBER = re.compile(r'[-+]?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?')
+
+SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS runs (
+        id INTEGER PRIMARY KEY,
+        control_hash TEXT NOT NULL,
+        cells REAL,
+        start_time REAL,
+        end_time REAL,
+        timestep REAL,
+        runtime REAL NOT NULL,
+        recorded REAL NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS runs_control_hash ON runs (control_hash, recorded)',
+)
+
+
+class ModelFeatures(namedtuple(
+        'ModelFeatures', 'control_hash cells start_time end_time timestep')):
+    '''Features of a model which determine its runtime
+    '''
+    def work(self):
+        '''Number of cell-timesteps the model computes, or None if unknown
+        '''
+        if not (self.cells and self.end_time and self.timestep):
+            return None
+        return self.cells * (self.end_time - (self.start_time or 0.0)) / self.timestep
+
+
+def _numbers(value: str):
+    return [float(number) for number in _NUMBER.findall(value or '')]
+
+
+def control_hash(tcf_file: str):
+    '''Hash the statements of a model's control files, skipping output
+    locations so the hash is the same before and after qflow formats them
+    '''
+    digest = hashlib.sha256()
+    root = os.path.dirname(os.path.abspath(tcf_file))
+    for control_file in controlfiles.control_file_tree(tcf_file):
+        digest.update(os.path.relpath(control_file, root).lower().encode('utf-8'))
+        if not os.path.exists(control_file):
+            continue
+        for command, value in controlfiles.read_statements(control_file):
+            if command.lower().startswith(controlfiles.OUTPUT_COMMAND_PREFIXES):
+                continue
+            digest.update('\0{}\0{}'.format(command.lower(), value).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def model_features(tcf_file: str):
+    '''Read the features of a TUFLOW model
+    '''
+    cells = None
+    grid = _numbers(controlfiles.read_value(tcf_file, 'Grid Size (X,Y)'))
+    cell_size = _numbers(controlfiles.read_value(tcf_file, 'Cell Size'))
+    if len(grid) >= 2 and cell_size and cell_size[0] > 0:
+        cells = (grid[0] / cell_size[0]) * (grid[1] / cell_size[0])
+
+    # The first timestep in the .tcf is the 2D one; later ones may be for 1D domains
+    timestep = None
+    for command, value in controlfiles.read_statements(tcf_file):
+        if command.lower() == 'timestep':
+            numbers = _numbers(value)
+            timestep = numbers[0] if numbers else None
+            break
+
+    start_time, end_time = controlfiles.simulation_times(tcf_file)
+    return ModelFeatures(control_hash(tcf_file), cells, start_time, end_time, timestep)
+
+
+class RuntimeHistory(object):
+    '''Past runtimes in a SQLite database.
+
+    ``recent`` runs of the same model are averaged to predict its runtime.
+    '''
+    def __init__(self, path: str, recent: int=5):
+        self.path = path
+        self.recent = recent
+        with closing(self._connect()) as connection, connection:
+            for statement in SCHEMA:
+                connection.execute(statement)
+
+    def _connect(self):
+        # Several workers may record runs at once; wait for their locks
+        return sqlite3.connect(self.path, timeout=30)
+
+    def record(self, features: ModelFeatures, runtime: float):
+        with closing(self._connect()) as connection, connection:
+            connection.execute(
+                'INSERT INTO runs (control_hash, cells, start_time, end_time, timestep, '
+                'runtime, recorded) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                tuple(features) + (runtime, time.time())
+            )
+
+    def predict(self, features: ModelFeatures):
+        '''Predicted runtime in seconds, or None if there is no basis for one
+        '''
+        with closing(self._connect()) as connection:
+            runtimes = [row[0] for row in connection.execute(
+                'SELECT runtime FROM runs WHERE control_hash = ? '
+                'ORDER BY recorded DESC LIMIT ?',
+                (features.control_hash, self.recent)
+            )]
+            if runtimes:
+                return sum(runtimes) / len(runtimes)
+
+            work = features.work()
+            if work is None:
+                return None
+            rates = sorted(row[0] for row in connection.execute(
+                'SELECT runtime * timestep / (cells * (end_time - COALESCE(start_time, 0))) '
+                'FROM runs WHERE cells > 0 AND timestep > 0 AND end_time > COALESCE(start_time, 0)'
+            ))
+        if not rates:
+            return None
+        # The median is robust to the odd run slowed by a busy node
+        return rates[len(rates) // 2] * work
@@ -0,0 +1,219 @@
+'''
+Memoisation of solver runs.
+
+A run's fingerprint is a hash of everything which determines its results:
+the model's statements (ignoring the output folders qflow rewrites for
+every run), the content of its inputs, the solver and the arguments of
+the run. Paths are hashed relative to the model, so the same model
+extracted to another folder has the same fingerprint.
+
+The results of successful runs are kept in Redis under their fingerprint
+by a ``MemoStore``. A run with the same fingerprint returns them instead
+of running again. While a run is in flight it holds a claim on its
+fingerprint, so identical submissions wait for it rather than run too.
+'''
+import hashlib
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+from qflow import controlfiles, utils
+from qflow.staging import companions
+
+_CHUNK_SIZE = 1024 * 1024
+
+# Lines added to an ANUGA script by AnugaModelFormatter, which name the
+# results folder of the run
+_DATADIR_MARKERS = ('default_datadir', 'set_datadir')
+
+
+class _DigestCache(object):
+    '''LRU cache of file digests, keyed on path, size and modification
+    time, so unchanged inputs are not read again for every fingerprint
+    '''
+    def __init__(self, maxsize: int=4096):
+        self.maxsize = maxsize
+        self._digests = OrderedDict()
+        self._lock = threading.Lock()
+
+    def digest(self, path: str):
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            if key in self._digests:
+                self._digests.move_to_end(key)
+                return self._digests[key]
+
+        sha = hashlib.sha256()
+        with open(path, 'rb') as fin:
+            for chunk in iter(lambda: fin.read(_CHUNK_SIZE), b''):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        with self._lock:
+            self._digests[key] = digest
+            while len(self._digests) > self.maxsize:
+                self._digests.popitem(last=False)
+        return digest
+
+
+digest_cache = _DigestCache()
+
+
+def _update(sha, *values):
+    for value in values:
+        sha.update(str(value).encode('utf-8'))
+        sha.update(b'\0')
+
+
+def _hash_file(sha, name: str, path: str):
+    _update(sha, name.lower(), digest_cache.digest(path) if path else 'missing')
+
+
+def _hash_options(sha, options: dict):
+    _update(sha, json.dumps(options, sort_keys=True, default=str))
+
+
+def _hash_statements(sha, tcf_file: str):
+    '''Hash the statements of a model's control files. Unlike
+    ``history.control_hash``, only the output folders the formatter
+    rewrites are skipped, as other output commands (e.g. output intervals
+    and data types) change the results.
+    '''
+    root = os.path.dirname(os.path.abspath(tcf_file))
+    for control_file in controlfiles.control_file_tree(tcf_file):
+        _update(sha, os.path.relpath(control_file, root).lower())
+        if not os.path.exists(control_file):
+            continue
+        for command, value in controlfiles.read_statements(control_file):
+            if command.lower() not in controlfiles.FORMATTED_COMMANDS:
+                _update(sha, command.lower(), value)
+
+
+def tuflow_fingerprint(tcf_file: str, tflow_exe: str, options: dict):
+    '''Fingerprint of a TUFLOW run of ``tcf_file`` with ``tflow_exe``.
+    ``options`` are the arguments of the run which change its results.
+    '''
+    sha = hashlib.sha256()
+    _update(sha, 'tuflow')
+    _hash_statements(sha, tcf_file)
+
+    root = os.path.dirname(os.path.abspath(tcf_file))
+    inputs = {}
+    for path in controlfiles.referenced_paths(tcf_file):
+        if os.path.splitext(path)[1].lower() in controlfiles.CONTROL_FILE_EXTENSIONS:
+            continue
+        found = controlfiles.find_path(path)
+        inputs[os.path.relpath(path, root)] = found
+        # GIS attributes and database tables live in the files next to an input
+        for companion in companions(found) if found else ():
+            inputs.setdefault(os.path.relpath(companion, root), companion)
+    for name in sorted(inputs, key=str.lower):
+        _hash_file(sha, name, inputs[name])
+
+    # The executable itself identifies the solver version
+    exe = shutil.which(tflow_exe) or tflow_exe
+    if os.path.isfile(exe):
+        _hash_file(sha, 'exe', exe)
+    else:
+        _update(sha, 'exe', tflow_exe)
+    _hash_options(sha, options)
+    return sha.hexdigest()
+
+
+def _conda_packages(env_name: str):
+    '''Names of the packages installed in a conda environment, including
+    their versions and builds, or None if the environment can't be found
+    '''
+    try:
+        meta = os.path.join(utils.conda_prefix(env_name), 'conda-meta')
+        return sorted(name for name in os.listdir(meta) if name.endswith('.json'))
+    except (OSError, ValueError):
+        return None
+
+
+def anuga_fingerprint(entry_point: str, env_name: str, options: dict):
+    '''Fingerprint of an ANUGA run of ``entry_point`` in the conda
+    environment ``env_name``. ``options`` are the arguments of the run
+    which change its results.
+
+    Scripts can read any file, so every file in the script's folder is
+    hashed, except previous results.
+    '''
+    sha = hashlib.sha256()
+    entry_point = os.path.abspath(entry_point)
+    root = os.path.dirname(entry_point)
+    _update(sha, 'anuga', os.path.basename(entry_point).lower())
+
+    # The formatter rewrites the results folder into the script; ignore it
+    with open(entry_point, errors='replace') as fin:
+        for line in fin:
+            if not any(marker in line for marker in _DATADIR_MARKERS):
+                _update(sha, line.rstrip('\r\n'))
+
+    for dirpath, dirnames, fnames in os.walk(root):
+        if dirpath == root and 'results' in dirnames:
+            dirnames.remove('results')
+        dirnames[:] = sorted(name for name in dirnames if name != '__pycache__')
+        for fname in sorted(fnames):
+            path = os.path.join(dirpath, fname)
+            if path == entry_point or fname == 'anuga.log' or fname.endswith('.pyc'):
+                continue
+            _hash_file(sha, os.path.relpath(path, root), path)
+
+    _update(sha, 'env', env_name, _conda_packages(env_name))
+    _hash_options(sha, options)
+    return sha.hexdigest()
+
+
+class MemoStore(object):
+    '''Results of successful runs in Redis, keyed by fingerprint.
+
+    ``client`` is a Redis client. Results are kept for ``ttl`` seconds and
+    claims on in-flight runs for at most ``claim_ttl`` seconds, so a claim
+    left by a lost worker does not block its fingerprint for ever.
+    '''
+    PREFIX = 'qflow-memo-'
+
+    def __init__(self, client, ttl: int=30 * 24 * 3600, claim_ttl: int=24 * 3600):
+        self.client = client
+        self.ttl = ttl
+        self.claim_ttl = claim_ttl
+
+    def _result_key(self, fingerprint: str):
+        return '{}result-{}'.format(self.PREFIX, fingerprint)
+
+    def _claim_key(self, fingerprint: str):
+        return '{}claim-{}'.format(self.PREFIX, fingerprint)
+
+    def get(self, fingerprint: str):
+        '''The stored result for a fingerprint, or None
+        '''
+        value = self.client.get(self._result_key(fingerprint))
+        return json.loads(value.decode('utf-8') if isinstance(value, bytes) else value) \
+            if value else None
+
+    def save(self, fingerprint: str, result: dict):
+        self.client.set(self._result_key(fingerprint), json.dumps(result, default=str), ex=self.ttl)
+
+    def forget(self, fingerprint: str):
+        self.client.delete(self._result_key(fingerprint))
+
+    def claim(self, fingerprint: str, owner: str):
+        '''Claim a fingerprint for a run, returning whether the claim was
+        made. Only one owner can hold a claim at a time.
+        '''
+        return bool(self.client.set(self._claim_key(fingerprint), owner, nx=True, ex=self.claim_ttl))
+
+    def owner(self, fingerprint: str):
+        '''The owner of the claim on a fingerprint, or None
+        '''
+        value = self.client.get(self._claim_key(fingerprint))
+        return value.decode('utf-8') if isinstance(value, bytes) else value
+
+    def release(self, fingerprint: str, owner: str):
+        '''Release a claim, if ``owner`` still holds it
+        '''
+        if self.owner(fingerprint) == owner:
+            self.client.delete(self._claim_key(fingerprint))
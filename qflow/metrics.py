@@ -0,0 +1,94 @@
+'''
+Timing of the phases of a task, and export of timing histograms.
+
+Tasks time each phase of their work with a ``PhaseTimer`` and return the
+breakdown under ``timings``. Every worker process also aggregates the
+timings into histograms, which are written in the Prometheus text format
+to a file in the ``metrics_dir`` setting after each task, for the
+node_exporter textfile collector (or any other scraper) to pick up.
+'''
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from qflow.utils import ensure_dir, replace_file
+
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600, 4 * 3600, 12 * 3600)
+
+
+class PhaseTimer(object):
+    '''Time the phases of a task with a monotonic clock.
+    ``timings`` maps each phase to the seconds spent in it, in the order
+    the phases were first entered.
+    '''
+    def __init__(self):
+        self.timings = OrderedDict()
+
+    def add(self, phase: str, seconds: float):
+        self.timings[phase] = self.timings.get(phase, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, time.monotonic() - start)
+
+
+def _escape(value: str):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class PhaseHistograms(object):
+    '''Histograms of phase timings by task and phase
+    '''
+    NAME = 'qflow_task_phase_seconds'
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, task: str, timings: dict):
+        with self._lock:
+            for phase, seconds in timings.items():
+                series = self._series.setdefault(
+                    (task, phase), {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0})
+                for i, bound in enumerate(self.buckets):
+                    if seconds <= bound:
+                        series['buckets'][i] += 1
+                series['sum'] += seconds
+                series['count'] += 1
+
+    def render(self):
+        '''The histograms in the Prometheus text exposition format
+        '''
+        lines = [
+            '# HELP {} Seconds spent in each phase of qflow tasks'.format(self.NAME),
+            '# TYPE {} histogram'.format(self.NAME)
+        ]
+        with self._lock:
+            for (task, phase), series in sorted(self._series.items()):
+                labels = 'task="{}",phase="{}"'.format(_escape(task), _escape(phase))
+                for bound, count in zip(self.buckets, series['buckets']):
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(self.NAME, labels, bound, count))
+                lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(self.NAME, labels, series['count']))
+                lines.append('{}_sum{{{}}} {}'.format(self.NAME, labels, series['sum']))
+                lines.append('{}_count{{{}}} {}'.format(self.NAME, labels, series['count']))
+        return '\n'.join(lines) + '\n'
+
+    def export(self, directory: str):
+        '''Write the histograms to a ``.prom`` file for this process in
+        ``directory``, replacing it atomically so scrapers never see a
+        partial file
+        '''
+        ensure_dir(directory)
+        path = os.path.join(
+            directory, 'qflow_{}_{}.prom'.format(socket.gethostname(), os.getpid()))
+        with replace_file(path) as fout:
+            fout.write(self.render())
+        return path
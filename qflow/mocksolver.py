@@ -0,0 +1,89 @@
+'''
+A configurable stand in for a solver, used by ``qflow.benchmark``.
+
+This file is run as a script, possibly by the Python interpreter of the
+ANUGA conda environment (which may be Python 2), so it only uses the
+standard library and must not import qflow.
+
+Usage: python mocksolver.py [options] [ignored arguments...]
+
+Arguments it does not recognise (such as TUFLOW's ``-nmb -b file.tcf``)
+are ignored, so a wrapper script calling it can be passed to
+``run_tuflow`` as the TUFLOW executable. It prints progress lines in the
+format of TUFLOW or ANUGA at ``--rate`` lines per second for a runtime
+drawn from ``--distribution``, writes ``--stderr-ratio`` of its lines to
+stderr and fails with ``--fail-rate`` probability. Its last line is always::
+
+    Mock solver finished in <seconds>s
+'''
+from __future__ import print_function
+
+import argparse
+import random
+import sys
+import time
+
+FINISHED = 'Mock solver finished in {:.6f}s'
+
+
+def runtime(options, rng):
+    '''Draw a runtime in seconds
+    '''
+    mean = options.runtime
+    if options.distribution == 'uniform':
+        return rng.uniform(mean * (1 - options.jitter), mean * (1 + options.jitter))
+    if options.distribution == 'exponential':
+        return rng.expovariate(1.0 / mean) if mean > 0 else 0.0
+    return mean
+
+
+def progress_line(style, sim_time):
+    if style == 'anuga':
+        return 'Time = {:.4f}, delta t in [0.25000000, 0.30000000], steps=10 (0s)'.format(sim_time)
+    return ' {}:{:02d}:{:02d}  Dt 1.50  Wet 1000  CE 0.00%'.format(
+        int(sim_time // 3600), int(sim_time % 3600 // 60), int(sim_time % 60))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pretend to be a solver')
+    parser.add_argument('--style', choices=('tuflow', 'anuga'), default='tuflow')
+    parser.add_argument('--runtime', type=float, default=1.0,
+                        help='Mean runtime in seconds')
+    parser.add_argument('--distribution', choices=('fixed', 'uniform', 'exponential'),
+                        default='fixed')
+    parser.add_argument('--jitter', type=float, default=0.5,
+                        help='Half width of the uniform distribution, as a fraction of the mean')
+    parser.add_argument('--rate', type=float, default=100.0,
+                        help='Lines of output per second')
+    parser.add_argument('--stderr-ratio', type=float, default=0.0)
+    parser.add_argument('--fail-rate', type=float, default=0.0)
+    parser.add_argument('--end-time', type=float, default=10800.0,
+                        help='Simulated seconds to report by the end of the run')
+    parser.add_argument('--seed', type=int, default=None)
+    options, _ = parser.parse_known_args(argv)
+
+    rng = random.Random(options.seed)
+    duration = runtime(options, rng)
+    fail = rng.random() < options.fail_rate
+    lines = max(1, int(duration * options.rate))
+
+    started = time.time()
+    for i in range(1, lines + 1):
+        # Keep to the requested rate rather than sleeping a fixed interval,
+        # so slow writes do not stretch the runtime
+        delay = started + duration * i / lines - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        stream = sys.stderr if rng.random() < options.stderr_ratio else sys.stdout
+        print(progress_line(options.style, options.end_time * i / lines), file=stream)
+        stream.flush()
+
+    if fail:
+        print('ERROR: injected failure', file=sys.stderr)
+    print(FINISHED.format(time.time() - started))
+    sys.stdout.flush()
+    return 1 if fail else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
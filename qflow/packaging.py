@@ -0,0 +1,143 @@
+'''
+Packaging of run outputs for download.
+
+The results, check and log folders of a run are streamed into a single
+``.tar.gz`` file. The gzip stream is compressed in independent blocks on
+a pool of threads (zlib releases the GIL), so packaging uses every core
+while holding only a bounded number of blocks in memory. Each block is a
+complete gzip member; any gzip reader decompresses the concatenation.
+
+A JSON manifest with the size and SHA-256 of every packaged file, and of
+the package itself, is written next to the package.
+'''
+import gzip
+import hashlib
+import json
+import os
+import tarfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from qflow.utils import replace_file
+
+
+class ParallelGzipWriter(object):
+    '''A writable file object which gzips in parallel to ``fileobj``.
+
+    Data is cut into ``block_size`` blocks which are compressed by
+    ``workers`` threads. At most ``max_pending`` blocks are held in memory
+    at once; writes block until the oldest has been written out.
+    '''
+    def __init__(
+            self,
+            fileobj,
+            workers: int=None,
+            block_size: int=1024 * 1024,
+            level: int=6,
+            max_pending: int=None):
+        workers = workers or os.cpu_count() or 1
+        self._fileobj = fileobj
+        self._block_size = block_size
+        self._level = level
+        self._max_pending = max_pending or 2 * workers
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._pending = deque()
+        self._buffer = bytearray()
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+
+    def _write_oldest(self):
+        data = self._pending.popleft().result()
+        self._fileobj.write(data)
+        self.size += len(data)
+        self.sha256.update(data)
+
+    def _submit(self, block: bytes):
+        while len(self._pending) >= self._max_pending:
+            self._write_oldest()
+        self._pending.append(self._executor.submit(gzip.compress, block, self._level))
+
+    def write(self, data):
+        self._buffer.extend(data)
+        while len(self._buffer) >= self._block_size:
+            self._submit(bytes(self._buffer[:self._block_size]))
+            del self._buffer[:self._block_size]
+        return len(data)
+
+    def close(self):
+        '''Compress and write out any buffered data. Does not close ``fileobj``.
+        '''
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        while self._pending:
+            self._write_oldest()
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _HashingReader(object):
+    '''Hash a file as it is read
+    '''
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size: int=-1):
+        data = self._fileobj.read(size)
+        self.sha256.update(data)
+        return data
+
+
+def _walk(folder: str):
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for name in sorted(files):
+            yield os.path.join(root, name)
+
+
+def package_folders(
+        folders: dict,
+        archive_path: str,
+        workers: int=None,
+        level: int=6,
+        block_size: int=1024 * 1024):
+    '''Write the files in ``folders`` (a mapping of names in the archive to
+    paths) to a gzipped tar file, with a manifest at
+    ``<archive_path>.manifest.json``.
+
+    Returns:
+        dict: The manifest
+    '''
+    files = []
+    with replace_file(archive_path, 'wb') as fout:
+        with ParallelGzipWriter(fout, workers, block_size, level) as writer:
+            with tarfile.open(fileobj=writer, mode='w|') as tar:
+                for name, folder in sorted(folders.items()):
+                    for path in _walk(folder):
+                        arcname = '/'.join(
+                            [name] + os.path.relpath(path, folder).split(os.sep))
+                        info = tar.gettarinfo(path, arcname)
+                        with open(path, 'rb') as fin:
+                            reader = _HashingReader(fin)
+                            tar.addfile(info, reader)
+                        files.append({
+                            'path': arcname,
+                            'size': info.size,
+                            'sha256': reader.sha256.hexdigest()
+                        })
+
+    manifest = {
+        'archive': os.path.basename(archive_path),
+        'size': writer.size,
+        'sha256': writer.sha256.hexdigest(),
+        'files': files
+    }
+    with replace_file(archive_path + '.manifest.json') as fout:
+        json.dump(manifest, fout, indent=2)
+    return manifest
@@ -0,0 +1,230 @@
+'''
+Pools of warm Python interpreters for running ANUGA scripts.
+
+Starting a fresh interpreter and importing anuga, numpy and netCDF4 can
+take longer than a short calibration run. An ``InterpreterPool`` keeps
+fork servers (see ``qflow/forkserver.py``) running in the target conda
+environment with those modules already imported, and forks a child of
+one of them for each script.
+'''
+import json
+import os
+import queue
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+
+FORKSERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'forkserver.py')
+
+
+def _rss(pid: int):
+    '''Resident memory of a process in MB, or 0 if unknown
+    '''
+    try:
+        with open('/proc/{}/status'.format(pid)) as fin:
+            for line in fin:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    return 0
+
+
+class _ForkServer(object):
+    '''A running fork server and its reply channel
+    '''
+    def __init__(self, python: str, preload, max_runs: int, env: dict=None):
+        self.max_runs = max_runs
+        self.runs = 0
+        self.busy = False
+        self.process = subprocess.Popen(
+            [python, FORKSERVER, str(max_runs)] + list(preload),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            env=env,
+            universal_newlines=True
+        )
+        self._replies = queue.Queue()
+        reader = threading.Thread(target=self._read_replies)
+        reader.daemon = True
+        reader.start()
+
+        if not self.reply().get('ready'):
+            raise RuntimeError('Fork server for {} failed to start'.format(python))
+
+    def _read_replies(self):
+        for line in iter(self.process.stdout.readline, ''):
+            self._replies.put(json.loads(line))
+        self._replies.put(None)
+
+    def reply(self, block: bool=True):
+        '''The next reply from the server, or None if it has exited
+        (or, if not ``block``ing, has not replied yet)
+        '''
+        try:
+            return self._replies.get(block) or {}
+        except queue.Empty:
+            return None
+
+    def usable(self, max_memory: int=None):
+        if self.busy or self.process.poll() is not None or self.runs >= self.max_runs:
+            return False
+        return not max_memory or _rss(self.process.pid) <= max_memory
+
+    def run(self, script: str, stdout: str, stderr: str):
+        '''Ask the server to run a script, returning the child's pid
+        '''
+        self.busy = True
+        self.runs += 1
+        request = {'script': os.path.abspath(script), 'stdout': stdout, 'stderr': stderr}
+        self.process.stdin.write(json.dumps(request) + '\n')
+        self.process.stdin.flush()
+        pid = self.reply().get('pid')
+        if pid is None:
+            raise RuntimeError('Fork server exited before running {}'.format(script))
+        return pid
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.stdin.close()
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+
+
+class PooledProcess(object):
+    '''A script running in a fork server child.
+
+    Offers the parts of the ``subprocess.Popen`` interface used to
+    supervise a solver: ``pid``, ``stdout``, ``stderr``, ``returncode``,
+    ``poll``, ``wait``, ``terminate`` and ``kill``.
+    '''
+    def __init__(self, server: _ForkServer, pid: int, stdout, stderr, holders, fifo_dir: str):
+        self.pid = pid
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = None
+        self._server = server
+        # Our own write ends of the FIFOs, which stop readers seeing
+        # end-of-file before the child has opened them
+        self._holders = holders
+        self._fifo_dir = fifo_dir
+        self._lock = threading.Lock()
+
+    def _finish(self, reply):
+        self.returncode = reply.get('returncode', -signal.SIGKILL)
+        for fd in self._holders:
+            os.close(fd)
+        self._holders = []
+        shutil.rmtree(self._fifo_dir, ignore_errors=True)
+        self._server.busy = False
+
+    def poll(self):
+        if self.returncode is None and self._lock.acquire(False):
+            try:
+                reply = self._server.reply(block=False)
+                if reply is not None:
+                    self._finish(reply)
+            finally:
+                self._lock.release()
+        return self.returncode
+
+    def wait(self):
+        with self._lock:
+            if self.returncode is None:
+                self._finish(self._server.reply())
+        return self.returncode
+
+    def send_signal(self, sig: int):
+        if self.returncode is None:
+            try:
+                os.killpg(self.pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+class InterpreterPool(object):
+    '''Fork servers for one Python interpreter.
+
+    Each server runs one script at a time, so a new server is started if
+    all are busy. Servers are replaced after ``max_runs`` scripts or once
+    they use more than ``max_memory`` MB.
+    '''
+    def __init__(
+            self,
+            python: str,
+            preload=(),
+            max_runs: int=50,
+            max_memory: int=None,
+            env: dict=None):
+        self.python = python
+        self.preload = tuple(preload)
+        self.max_runs = max_runs
+        self.max_memory = max_memory
+        self.env = env
+        self._servers = []
+        self._lock = threading.Lock()
+
+    def _server(self):
+        with self._lock:
+            for server in list(self._servers):
+                if server.usable(self.max_memory):
+                    server.busy = True
+                    return server
+                if not server.busy:
+                    server.close()
+                    self._servers.remove(server)
+
+            server = _ForkServer(self.python, self.preload, self.max_runs, self.env)
+            server.busy = True
+            self._servers.append(server)
+            return server
+
+    def spawn(self, script: str):
+        '''Run a script in a child of a warm interpreter.
+        The child's working directory is the directory of the script.
+
+        Returns:
+            PooledProcess: the running script
+        '''
+        server = self._server()
+        fifo_dir = tempfile.mkdtemp(prefix='qflow-')
+        readers = []
+        holders = []
+        try:
+            paths = [os.path.join(fifo_dir, name) for name in ('stdout', 'stderr')]
+            for path in paths:
+                os.mkfifo(path)
+                fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+                holders.append(os.open(path, os.O_WRONLY))
+                os.set_blocking(fd, True)
+                readers.append(os.fdopen(fd, 'rb'))
+            pid = server.run(script, *paths)
+        except Exception:
+            for fd in holders:
+                os.close(fd)
+            for reader in readers:
+                reader.close()
+            shutil.rmtree(fifo_dir, ignore_errors=True)
+            server.busy = False
+            raise
+
+        return PooledProcess(server, pid, readers[0], readers[1], holders, fifo_dir)
+
+    def close(self):
+        '''Stop all servers
+        '''
+        with self._lock:
+            for server in self._servers:
+                server.close()
+            self._servers = []
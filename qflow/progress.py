@@ -0,0 +1,179 @@
+'''
+Structured progress from solver output.
+
+A parser reads lines of solver output and keeps track of the simulated
+time, timestep and mass error it reports. Parsers are chosen by the
+``progress_parsers`` setting, so another solver or output format can be
+supported by subclassing ``ProgressParser``.
+'''
+import re
+import time
+
+from qflow import controlfiles
+
+
+def _hms(value: str):
+    hours, minutes, seconds = value.split(':')
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+class ProgressParser(object):
+    '''Base class for parsing progress from solver output.
+
+    Subclasses implement ``parse``. ``end_time`` and ``start_time`` are
+    the simulated times (in seconds) the run ends and starts at, if known.
+    '''
+    def __init__(self, end_time: float=None, start_time: float=0.0):
+        self.end_time = end_time
+        self.start_time = start_time
+        self.sim_time = None
+        self.timestep = None
+        self.mass_error = None
+        self._first = None
+
+    @classmethod
+    def for_model(cls, path: str):
+        '''Make a parser for the model in ``path``, reading its start and
+        end times if the parser knows how
+        '''
+        return cls()
+
+    def parse(self, line: str):
+        '''Return a dict of any of ``sim_time``, ``timestep`` and
+        ``mass_error`` found in a line of output
+        '''
+        raise NotImplementedError
+
+    def feed(self, line: str):
+        '''Read a line of output.
+
+        Returns:
+            bool: Whether the line updated the progress
+        '''
+        values = self.parse(line)
+        if not values:
+            return False
+
+        for key, value in values.items():
+            setattr(self, key, value)
+        if 'sim_time' in values and self._first is None:
+            self._first = (time.monotonic(), values['sim_time'])
+        return True
+
+    def progress(self):
+        '''The current progress, with the rate of simulated seconds per
+        wall clock second, the percentage complete and an ETA in seconds
+        where they can be estimated
+        '''
+        rate = percent = eta = None
+        if self.sim_time is not None and self._first is not None:
+            wall_start, sim_start = self._first
+            wall = time.monotonic() - wall_start
+            if wall > 0 and self.sim_time > sim_start:
+                rate = (self.sim_time - sim_start) / wall
+
+            if self.end_time is not None and self.end_time > self.start_time:
+                span = self.end_time - self.start_time
+                done = min(max(self.sim_time - self.start_time, 0.0), span)
+                percent = 100.0 * done / span
+                if rate:
+                    eta = (span - done) / rate
+
+        return {
+            'sim_time': self.sim_time,
+            'timestep': self.timestep,
+            'mass_error': self.mass_error,
+            'rate': rate,
+            'percent': percent,
+            'eta': eta
+        }
+
+
+class TuflowProgressParser(ProgressParser):
+    '''Parse TUFLOW's screen display lines, which start with the
+    simulated time (``h:mm:ss`` or decimal hours) and report the
+    timestep (``Dt``) and cumulative mass error (``CE`` or ``ME``, %)
+    '''
+    TIME = re.compile(r'^\s*(\d+:\d\d:\d\d(?:\.\d+)?)|^\s*(\d+\.\d+)\s*h\b')
+    TIMESTEP = re.compile(r'\bDt\s*[=:]?\s*(\d+(?:\.\d+)?)', re.IGNORECASE)
+    MASS_ERROR = re.compile(r'\b(?:CE|ME|Mass Error)\s*[=:]?\s*([-+]?\d+(?:\.\d+)?)\s*%', re.IGNORECASE)
+
+    @classmethod
+    def for_model(cls, path: str):
+        start, end = controlfiles.simulation_times(path)
+        return cls(end_time=end, start_time=start or 0.0)
+
+    def parse(self, line: str):
+        values = {}
+        match = self.TIME.match(line)
+        if match:
+            hms, hours = match.groups()
+            values['sim_time'] = _hms(hms) if hms else float(hours) * 3600
+
+        match = self.TIMESTEP.search(line)
+        if match:
+            values['timestep'] = float(match.group(1))
+
+        match = self.MASS_ERROR.search(line)
+        if match:
+            values['mass_error'] = float(match.group(1))
+        return values
+
+
+class AnugaProgressParser(ProgressParser):
+    '''Parse the output of ANUGA's ``domain.timestepping_statistics()``, e.g.
+    ``Time = 60.0000, delta t in [0.27180880, 0.29315430], steps=210 (4s)``
+    '''
+    TIME = re.compile(r'\bTime\s*=\s*(\d+(?:\.\d+)?)')
+    TIMESTEP = re.compile(r'delta t in \[\s*(\d+(?:\.\d+)?(?:e[-+]?\d+)?)', re.IGNORECASE)
+    FINALTIME = re.compile(r'\bfinaltime\s*=\s*(\d+(?:\.\d+)?(?:e[-+]?\d+)?)', re.IGNORECASE)
+
+    @classmethod
+    def for_model(cls, path: str):
+        # Only literal values passed to ``domain.evolve`` can be found
+        with open(path) as fin:
+            match = cls.FINALTIME.search(fin.read())
+        return cls(end_time=float(match.group(1)) if match else None)
+
+    def parse(self, line: str):
+        values = {}
+        match = self.TIME.search(line)
+        if match:
+            values['sim_time'] = float(match.group(1))
+
+        match = self.TIMESTEP.search(line)
+        if match:
+            values['timestep'] = float(match.group(1))
+        return values
+
+
+class ProgressReporter(object):
+    '''Feed output to a parser and call ``report`` with the progress at
+    most once every ``interval`` seconds, when it has changed
+    '''
+    def __init__(self, parser: ProgressParser, report, interval: float=5.0):
+        self.parser = parser
+        self._report = report
+        self._interval = interval
+        self._changed = False
+        self._last = None
+
+    def feed(self, line: str):
+        '''Read a line of output, returning whether it updated the progress
+        '''
+        updated = self.parser.feed(line)
+        if updated:
+            self._changed = True
+        self.poll()
+        return updated
+
+    def poll(self):
+        now = time.monotonic()
+        if self._changed and (self._last is None or now - self._last >= self._interval):
+            self.flush()
+
+    def flush(self):
+        if self._changed:
+            self._report(self.parser.progress())
+            self._changed = False
+            self._last = time.monotonic()
@@ -0,0 +1,116 @@
+'''
+Archive of finished task results.
+
+Results expire from Redis after the ``result_expires`` setting, so Redis
+memory stays bounded however many runs there have been. Before they
+expire, the periodic ``archive_results`` task copies finished results to
+a SQLite database (the ``result_archive`` setting), indexed so results
+can still be looked up by task id, entrypoint or the time they finished.
+'''
+import json
+import sqlite3
+import time
+from contextlib import closing
+
+SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS results (
+        task_id TEXT PRIMARY KEY,
+        status TEXT NOT NULL,
+        entrypoint TEXT,
+        date_done REAL,
+        runtime REAL,
+        fids TEXT,
+        result TEXT,
+        traceback TEXT,
+        archived REAL NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS results_entrypoint ON results (entrypoint, date_done)',
+    'CREATE INDEX IF NOT EXISTS results_date_done ON results (date_done)',
+)
+
+COLUMNS = ('task_id', 'status', 'entrypoint', 'date_done', 'runtime', 'fids', 'result', 'traceback')
+
+
+class ResultArchive(object):
+    '''Finished task results in a SQLite database.
+
+    Records are dicts with the keys in ``COLUMNS``. ``fids`` and ``result``
+    are stored as JSON and decoded again when records are read.
+    '''
+    def __init__(self, path: str):
+        self.path = path
+        with closing(self._connect()) as connection, connection:
+            for statement in SCHEMA:
+                connection.execute(statement)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def store(self, records):
+        '''Archive records, ignoring tasks which are already archived.
+
+        Returns:
+            int: The number of records added
+        '''
+        rows = [
+            tuple(
+                json.dumps(record.get(column), default=str) if column in ('fids', 'result')
+                else record.get(column)
+                for column in COLUMNS
+            ) + (time.time(),)
+            for record in records
+        ]
+        with closing(self._connect()) as connection, connection:
+            before = connection.total_changes
+            connection.executemany(
+                'INSERT OR IGNORE INTO results ({}, archived) VALUES ({})'.format(
+                    ', '.join(COLUMNS), ', '.join('?' * (len(COLUMNS) + 1))),
+                rows
+            )
+            return connection.total_changes - before
+
+    def archived(self, task_ids):
+        '''The subset of ``task_ids`` which are already archived
+        '''
+        task_ids = list(task_ids)
+        found = set()
+        with closing(self._connect()) as connection:
+            # Stay below SQLite's limit on the number of query parameters
+            for i in range(0, len(task_ids), 500):
+                batch = task_ids[i:i + 500]
+                found.update(row[0] for row in connection.execute(
+                    'SELECT task_id FROM results WHERE task_id IN ({})'.format(
+                        ', '.join('?' * len(batch))),
+                    batch
+                ))
+        return found
+
+    def _query(self, where: str, parameters: tuple, limit: int=None):
+        sql = 'SELECT {} FROM results {} ORDER BY date_done DESC'.format(', '.join(COLUMNS), where)
+        if limit is not None:
+            sql += ' LIMIT {:d}'.format(limit)
+        with closing(self._connect()) as connection:
+            rows = connection.execute(sql, parameters).fetchall()
+        records = []
+        for row in rows:
+            record = dict(zip(COLUMNS, row))
+            for column in ('fids', 'result'):
+                record[column] = json.loads(record[column]) if record[column] else None
+            records.append(record)
+        return records
+
+    def get(self, task_id: str):
+        '''The archived result of a task, or None if it is not archived
+        '''
+        records = self._query('WHERE task_id = ?', (task_id,))
+        return records[0] if records else None
+
+    def for_entrypoint(self, entrypoint: str, limit: int=None):
+        '''Results of runs of an entrypoint, most recent first
+        '''
+        return self._query('WHERE entrypoint = ?', (entrypoint,), limit)
+
+    def between(self, start: float, end: float, limit: int=None):
+        '''Results of tasks which finished between two POSIX times, most recent first
+        '''
+        return self._query('WHERE date_done >= ? AND date_done < ?', (start, end), limit)
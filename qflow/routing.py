@@ -0,0 +1,203 @@
+'''
+Resource aware routing of solver tasks.
+
+``run_tuflow`` and ``run_anuga`` accept ``cores`` and ``memory`` (MB)
+hints. Tasks are routed to the smallest queue in the
+``resource_queues`` setting which can hold them, and workers only
+subscribe to queues whose tasks fit on their node (see ``tools/run.sh``).
+On the worker, a ``ResourceLedger`` shared by all pool processes makes
+sure the tasks running at once never need more than the node has.
+Hints must be passed as keyword arguments so the router can see them.
+'''
+import json
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from celery.worker.control import inspect_command
+
+from qflow.celery import app
+
+SOLVER_TASKS = ('qflow.tasks.run_tuflow', 'qflow.tasks.run_anuga')
+
+
+def node_capacity():
+    '''The cores and memory (MB) of this node, unless overridden by the
+    ``worker_cores`` and ``worker_memory`` settings
+    '''
+    cores = app.conf.get('worker_cores', None)
+    if not cores:
+        try:
+            cores = len(os.sched_getaffinity(0))
+        except AttributeError:
+            cores = os.cpu_count() or 1
+
+    memory = app.conf.get('worker_memory', None)
+    if not memory:
+        try:
+            memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2**20
+        except (AttributeError, ValueError, OSError):
+            memory = 0
+    return cores, memory
+
+
+def queue_for(cores: int, memory: int, queues=None):
+    '''Name of the smallest queue whose tasks may use ``cores`` and
+    ``memory``, or the largest queue if none are big enough
+    '''
+    queues = queues or app.conf.get('resource_queues')
+    for queue in queues:
+        if cores <= queue['cores'] and memory <= queue['memory']:
+            return queue['name']
+    return queues[-1]['name']
+
+
+def queues_for_node(cores: int, memory: int, queues=None):
+    '''Names of the queues whose tasks fit on a node
+    '''
+    queues = queues or app.conf.get('resource_queues')
+    return [
+        queue['name'] for queue in queues
+        if queue['cores'] <= cores and (not memory or queue['memory'] <= memory)
+    ] or [queues[0]['name']]
+
+
+def route_task(name, args, kwargs, options, task=None, **kw):
+    '''Celery router sending solver tasks to a queue by their resource hints
+    '''
+    if name not in SOLVER_TASKS:
+        return None
+    return {'queue': queue_for(kwargs.get('cores') or 1, kwargs.get('memory') or 0)}
+
+
+class InsufficientResources(Exception):
+    '''Raised when a task needs more resources than are free on this node
+    '''
+
+
+class ResourceLedger(object):
+    '''Record the cores and memory reserved by tasks running on this node.
+
+    The ledger is a JSON file guarded by an exclusive ``flock``, so it is
+    shared by every pool process of every worker on the node. Reservations
+    of processes which have died are discarded. Where ``fcntl`` is not
+    available (Windows) every reservation is granted.
+    '''
+    def __init__(self, path: str, cores: int, memory: int):
+        self.path = path
+        self.cores = cores
+        self.memory = memory
+
+    @contextmanager
+    def _locked(self):
+        with open(self.path, 'a+') as ledger:
+            fcntl.flock(ledger, fcntl.LOCK_EX)
+            try:
+                ledger.seek(0)
+                try:
+                    reservations = json.loads(ledger.read() or '{}')
+                except ValueError:
+                    reservations = {}
+                yield reservations
+
+                ledger.seek(0)
+                ledger.truncate()
+                ledger.write(json.dumps(reservations))
+            finally:
+                fcntl.flock(ledger, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _alive(pid: int):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def free(self):
+        '''Cores and memory not reserved by running tasks
+        '''
+        if fcntl is None:
+            return self.cores, self.memory
+        with self._locked() as reservations:
+            return self._free(reservations)
+
+    def _free(self, reservations):
+        for key, reservation in list(reservations.items()):
+            if not self._alive(reservation['pid']):
+                del reservations[key]
+        cores = self.cores - sum(r['cores'] for r in reservations.values())
+        memory = self.memory - sum(r['memory'] for r in reservations.values())
+        return cores, memory
+
+    @contextmanager
+    def reserve(self, key: str, cores: int, memory: int):
+        '''Reserve resources for the duration of a ``with`` block.
+
+        Raises:
+            InsufficientResources: if the reservation does not fit in what
+                is free. A task needing more than the whole node is granted
+                the node once it is idle, rather than never running.
+        '''
+        if fcntl is None:
+            yield
+            return
+
+        with self._locked() as reservations:
+            free_cores, free_memory = self._free(reservations)
+            idle = not reservations
+            fits = cores <= free_cores and (not self.memory or memory <= free_memory)
+            if not (fits or idle):
+                raise InsufficientResources(
+                    'Need {} cores and {}MB; {} cores and {}MB are free'.format(
+                        cores, memory, free_cores, free_memory))
+            reservations[key] = {'pid': os.getpid(), 'cores': cores, 'memory': memory}
+
+        try:
+            yield
+        finally:
+            with self._locked() as reservations:
+                reservations.pop(key, None)
+
+
+def node_ledger():
+    '''The resource ledger for this node
+    '''
+    path = app.conf.get('resource_ledger', None) or os.path.join(
+        tempfile.gettempdir(), 'qflow-resources.json')
+    cores, memory = node_capacity()
+    return ResourceLedger(path, cores, memory)
+
+
+@inspect_command()
+def capacity(state):
+    '''Report the resources of a worker's node and how much are free.
+    Call with ``app.control.broadcast('capacity', reply=True)``
+    '''
+    ledger = node_ledger()
+    free_cores, free_memory = ledger.free()
+    return {
+        'cores': ledger.cores,
+        'memory': ledger.memory,
+        'free_cores': free_cores,
+        'free_memory': free_memory,
+        'queues': queues_for_node(ledger.cores, ledger.memory)
+    }
+
+
+if __name__ == '__main__':
+    # Print the queues a worker on this node should consume, and how many
+    # single core tasks it can run at once. Used by tools/run.sh
+    cores, memory = node_capacity()
+    if sys.argv[1:] == ['--concurrency']:
+        print(cores)
+    else:
+        print(','.join(queues_for_node(cores, memory)))
@@ -0,0 +1,188 @@
+'''
+Capture of solver output to size-rotated, compressed log files.
+
+Solver tasks write everything a solver prints to ``solver.log`` in the
+run's log folder, so the output of a run is kept even if its events are
+missed. Lines the solver wrote to stderr are prefixed with ``[stderr]``.
+Once the log reaches a maximum size it is renamed to ``solver.log.<n>``
+(numbered from 1, oldest first), compressed to ``solver.log.<n>.gz`` in
+the background and a new ``solver.log`` started.
+
+``tail`` and ``read_range`` read the end or a byte range of a log by
+seeking, so clients following a run never re-read the whole file.
+``log_path`` checks a path a client asked for is one of these logs.
+'''
+import glob
+import gzip
+import os
+import re
+import shutil
+import threading
+import time
+
+LOG_NAME = 'solver.log'
+STDERR_PREFIX = '[stderr] '
+
+_SEGMENT = re.compile(r'\.(\d+)\.gz$')
+
+
+def segments(path: str):
+    '''The compressed segments rotated out of the log at ``path``, oldest first
+    '''
+    found = []
+    for segment in glob.glob(glob.escape(path) + '.*.gz'):
+        match = _SEGMENT.search(segment)
+        if match:
+            found.append((int(match.group(1)), segment))
+    return [segment for _, segment in sorted(found)]
+
+
+def log_path(path: str):
+    '''The real path of the solver log at ``path``, or of the log in the
+    folder ``path``. Only ``solver.log`` and its compressed segments, in a
+    folder ``SolverLog`` has written a log to, can be read.
+
+    Raises:
+        ValueError: If ``path`` is not a solver log
+    '''
+    path = os.path.realpath(path)
+    if os.path.isdir(path):
+        path = os.path.join(path, LOG_NAME)
+    folder, name = os.path.split(path)
+    is_log = name == LOG_NAME or (
+        name.startswith(LOG_NAME) and _SEGMENT.fullmatch(name[len(LOG_NAME):]))
+    if not (is_log and os.path.isfile(path) and os.path.isfile(os.path.join(folder, LOG_NAME))):
+        raise ValueError('{} is not a solver log'.format(path))
+    return path
+
+
+def _compress(path: str):
+    with open(path, 'rb') as fin, gzip.open(path + '.gz.part', 'wb') as fout:
+        shutil.copyfileobj(fin, fout, 1024 * 1024)
+    os.replace(path + '.gz.part', path + '.gz')
+    os.remove(path)
+
+
+class SolverLog(object):
+    '''Write solver output to a log file, rotating it once it is larger
+    than ``max_bytes``. Only the newest ``backups`` compressed segments are
+    kept; None keeps them all.
+
+    Writes are buffered and flushed at least every ``flush_interval``
+    seconds, so readers see output while the solver runs.
+    '''
+    def __init__(
+            self,
+            path: str,
+            max_bytes: int=16 * 1024 * 1024,
+            backups: int=None,
+            flush_interval: float=1.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        existing = segments(path)
+        self._count = int(_SEGMENT.search(existing[-1]).group(1)) if existing else 0
+        self._file = open(path, 'ab')
+        self._size = self._file.tell()
+        self._flushed = time.monotonic()
+        self._compressor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, stream: str, line: str):
+        '''Write a line of output from ``stream`` ('stdout' or 'stderr')
+        '''
+        if stream == 'stderr':
+            line = STDERR_PREFIX + line
+        data = line.encode('utf-8', errors='replace')
+        if self._size and self._size + len(data) > self.max_bytes:
+            self._rotate()
+        self._file.write(data)
+        self._size += len(data)
+        self.poll()
+
+    def poll(self):
+        '''Flush buffered output if ``flush_interval`` has passed
+        '''
+        now = time.monotonic()
+        if now - self._flushed >= self.flush_interval:
+            self._file.flush()
+            self._flushed = now
+
+    def _rotate(self):
+        self._file.close()
+        self._count += 1
+        rotated = '{}.{}'.format(self.path, self._count)
+        os.replace(self.path, rotated)
+        self._file = open(self.path, 'ab')
+        self._size = 0
+
+        # Compress one segment at a time, without holding up the solver's output
+        self._wait()
+        self._compressor = threading.Thread(target=self._finish_segment, args=(rotated,))
+        self._compressor.start()
+
+    def _finish_segment(self, rotated: str):
+        _compress(rotated)
+        if self.backups is not None:
+            for old in segments(self.path)[:-self.backups or None]:
+                os.remove(old)
+
+    def _wait(self):
+        if self._compressor is not None:
+            self._compressor.join()
+            self._compressor = None
+
+    def close(self):
+        self._file.close()
+        self._wait()
+
+
+def _open(path: str):
+    return gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+
+
+def tail(path: str, lines: int=100, max_bytes: int=None, block_size: int=64 * 1024):
+    '''The last ``lines`` lines of a log, but no more than its last
+    ``max_bytes`` bytes. Plain logs are read backwards from the end a block
+    at a time.
+
+    Returns:
+        tuple: The text, and the byte offsets it starts and ends at
+    '''
+    with _open(path) as fin:
+        if path.endswith('.gz'):
+            data = fin.read()
+            end = len(data)
+        else:
+            end = position = fin.seek(0, os.SEEK_END)
+            data = b''
+            # One more newline than lines is needed, as the last line usually ends with one
+            while position > 0 and data.count(b'\n') <= lines and \
+                    (max_bytes is None or len(data) < max_bytes):
+                step = min(block_size, position)
+                position -= step
+                fin.seek(position)
+                data = fin.read(step) + data
+    data = b''.join(data.splitlines(True)[-lines:]) if lines > 0 else b''
+    if max_bytes is not None:
+        data = data[-max_bytes:]
+    return data.decode('utf-8', errors='replace'), end - len(data), end
+
+
+def read_range(path: str, start: int, end: int=None):
+    '''Bytes ``start`` to ``end`` of a log (to the end of the log if None).
+    Compressed segments are read from their uncompressed contents.
+
+    Returns:
+        tuple: The text, and the byte offset it ends at
+    '''
+    with _open(path) as fin:
+        fin.seek(start)
+        data = fin.read(-1 if end is None else max(0, end - start))
+    return data.decode('utf-8', errors='replace'), start + len(data)
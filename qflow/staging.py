@@ -0,0 +1,333 @@
+'''
+Staging of TUFLOW models on node-local scratch.
+
+Models live on shared storage, and reading their grids from every node at
+once saturates it. A staged model is a copy of a model on the worker's
+scratch disk which the solver runs instead:
+
+- control files are copied, with paths which would not resolve in the
+  copy (absolute paths, or paths outside the model's folder) rewritten
+- input files are hardlinked from a ``StagingCache`` on the scratch disk,
+  so each version of a file is only read from shared storage once per node
+- output folders are created in the copy, and synced back to shared
+  storage once the run has finished
+
+Inputs are found from the model's control files. GIS layers are staged
+with their sidecar files (e.g. ``.shx``, ``.dbf`` and ``.prj``), and the
+``.csv`` and ``.ts1`` files next to a referenced ``.csv`` are staged with
+it, as databases refer to further files in their folder.
+'''
+import glob
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from contextlib import closing
+
+from qflow import controlfiles
+from qflow.store import link_file
+from qflow.utils import ensure_dir
+
+_CHUNK_SIZE = 1024 * 1024
+
+# Files a database (.csv) may refer to by name, relative to its own folder
+DATABASE_EXTENSIONS = frozenset(('.csv', '.ts1'))
+
+SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS files (
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        digest TEXT NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS blobs (
+        digest TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        last_used REAL NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS blobs_last_used ON blobs (last_used)',
+)
+
+
+class StagingCache(object):
+    '''A cache of input files on node-local scratch, keyed by the SHA-256
+    digest of their content.
+
+    An index maps each source file's path, size and modification time to
+    its digest, so an unchanged file is never read again while its blob is
+    cached. Blobs are evicted least recently used first once the cache
+    holds more than ``max_bytes``; blobs linked into a staged model are
+    never evicted.
+    '''
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        ensure_dir(os.path.join(root, 'tmp'))
+        with closing(self._connect()) as connection, connection:
+            for statement in SCHEMA:
+                connection.execute(statement)
+
+    def _connect(self):
+        # Every worker process on the node shares the cache
+        return sqlite3.connect(os.path.join(self.root, 'index.db'), timeout=30)
+
+    def blob_path(self, digest: str):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def _copy(self, source: str):
+        '''Copy a file into the cache, hashing it as it is read
+        '''
+        sha = hashlib.sha256()
+        temp = os.path.join(self.root, 'tmp', '{}-{}'.format(os.getpid(), os.urandom(8).hex()))
+        try:
+            with open(source, 'rb') as fin, open(temp, 'wb') as fout:
+                for chunk in iter(lambda: fin.read(_CHUNK_SIZE), b''):
+                    sha.update(chunk)
+                    fout.write(chunk)
+        except Exception:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+
+        digest = sha.hexdigest()
+        blob = self.blob_path(digest)
+        if os.path.exists(blob):
+            os.remove(temp)
+        else:
+            ensure_dir(os.path.dirname(blob))
+            os.chmod(temp, 0o444)
+            os.replace(temp, blob)
+        return digest
+
+    def fetch(self, source: str):
+        '''The path of the cached copy of ``source``, copying it into the
+        cache if it is not there already.
+
+        Returns:
+            tuple: The path of the blob, and the number of bytes read from
+                ``source`` (0 if it was cached)
+        '''
+        stat = os.stat(source)
+        with closing(self._connect()) as connection:
+            row = connection.execute(
+                'SELECT digest FROM files WHERE path = ? AND size = ? AND mtime_ns = ?',
+                (source, stat.st_size, stat.st_mtime_ns)
+            ).fetchone()
+
+        copied = 0
+        if row and os.path.exists(self.blob_path(row[0])):
+            digest = row[0]
+        else:
+            digest = self._copy(source)
+            copied = stat.st_size
+
+        with closing(self._connect()) as connection, connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO files (path, size, mtime_ns, digest) VALUES (?, ?, ?, ?)',
+                (source, stat.st_size, stat.st_mtime_ns, digest)
+            )
+            connection.execute(
+                'INSERT OR REPLACE INTO blobs (digest, size, last_used) VALUES (?, ?, ?)',
+                (digest, stat.st_size, time.time())
+            )
+        return self.blob_path(digest), copied
+
+    def size(self):
+        '''Bytes held in the cache
+        '''
+        with closing(self._connect()) as connection:
+            return connection.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+
+    def evict(self):
+        '''Remove least recently used blobs until the cache is within
+        ``max_bytes``, skipping blobs which are linked into a staged model.
+
+        Returns:
+            int: Number of bytes freed
+        '''
+        freed = 0
+        excess = self.size() - self.max_bytes
+        if excess <= 0:
+            return freed
+
+        with closing(self._connect()) as connection:
+            candidates = connection.execute(
+                'SELECT digest, size FROM blobs ORDER BY last_used').fetchall()
+        evicted = []
+        for digest, size in candidates:
+            if freed >= excess:
+                break
+            blob = self.blob_path(digest)
+            try:
+                if os.stat(blob).st_nlink > 1:
+                    continue
+                os.remove(blob)
+            except FileNotFoundError:
+                pass
+            evicted.append((digest,))
+            freed += size
+
+        with closing(self._connect()) as connection, connection:
+            connection.executemany('DELETE FROM blobs WHERE digest = ?', evicted)
+            connection.executemany('DELETE FROM files WHERE digest = ?', evicted)
+        return freed
+
+
+def companions(path: str):
+    '''Files to stage along with a referenced input
+    '''
+    if path.lower().endswith('.csv'):
+        folder = os.path.dirname(path)
+        return [
+            os.path.join(folder, name) for name in os.listdir(folder)
+            if os.path.splitext(name)[1].lower() in DATABASE_EXTENSIONS
+        ]
+    pattern = glob.escape(os.path.splitext(path)[0]) + '.*'
+    return [found for found in glob.glob(pattern) if os.path.isfile(found)]
+
+
+class StagedModel(object):
+    '''A copy of a TUFLOW model in a new folder under ``scratch``, which
+    runs with its inputs read from ``cache`` and writes the ``outputs``
+    folders of the original model to scratch.
+
+    Call ``stage`` to make the copy, then run ``tcf_file``. ``sync`` copies
+    the outputs back to the original model and ``cleanup`` removes the copy.
+    '''
+    def __init__(self, tcf_file: str, cache: StagingCache, scratch: str, outputs=()):
+        self.source_tcf = os.path.abspath(tcf_file)
+        self.source_root = os.path.dirname(self.source_tcf)
+        self.cache = cache
+        ensure_dir(scratch)
+        self.root = tempfile.mkdtemp(prefix='run-', dir=scratch)
+        self.tcf_file = self.local(self.source_tcf)
+        self.outputs = [os.path.abspath(output) for output in outputs]
+        self.staged_bytes = 0
+        self.copied_bytes = 0
+
+    def local(self, path: str):
+        '''Where a file of the original model is in the copy. Files outside
+        the model's folder are put in a folder for their original folder
+        under ``_external``.
+        '''
+        relative = os.path.relpath(path, self.source_root)
+        if os.path.isabs(relative) or relative == os.pardir or \
+                relative.startswith(os.pardir + os.sep):
+            folder, name = os.path.split(path)
+            key = hashlib.sha1(os.path.normcase(folder).encode('utf-8')).hexdigest()[:12]
+            return os.path.join(self.root, '_external', key, name)
+        return os.path.join(self.root, relative)
+
+    def stage(self):
+        '''Copy the model to scratch
+        '''
+        for output in self.outputs:
+            ensure_dir(self.local(output))
+
+        control_files = [
+            path for path in controlfiles.control_file_tree(self.source_tcf)
+            if os.path.exists(path)
+        ]
+        inputs = {}
+        for path in controlfiles.referenced_paths(self.source_tcf):
+            if os.path.splitext(path)[1].lower() in controlfiles.CONTROL_FILE_EXTENSIONS:
+                continue
+            found = controlfiles.find_path(path)
+            if found is None:
+                continue
+            # Stage the file under the name the model uses, whatever its case on disk
+            inputs[found] = self.local(path)
+            for companion in companions(found):
+                inputs.setdefault(companion, os.path.join(
+                    os.path.dirname(self.local(path)), os.path.basename(companion)))
+
+        for source, target in inputs.items():
+            ensure_dir(os.path.dirname(target))
+            blob, copied = self.cache.fetch(source)
+            try:
+                link_file(blob, target)
+            except FileNotFoundError:
+                # Evicted by another worker process since it was fetched
+                blob, copied = self.cache.fetch(source)
+                link_file(blob, target)
+            self.staged_bytes += os.path.getsize(blob)
+            self.copied_bytes += copied
+
+        for control_file in control_files:
+            self._write_control_file(control_file)
+        self.cache.evict()
+        return self
+
+    def _rewrite(self, control_file: str, staged: str, part: str):
+        '''A path in a statement, changed to resolve to the same file in
+        the copy if it would not already
+        '''
+        value = part.strip().strip('"')
+        if not value or '<<' in value:
+            return part
+        target = self.local(controlfiles.resolve(control_file, value))
+        if os.path.normcase(target) == os.path.normcase(controlfiles.resolve(staged, value)):
+            return part
+        path = os.path.relpath(target, os.path.dirname(staged))
+        if part.strip().startswith('"'):
+            path = '"{}"'.format(path)
+        # Keep the spacing around the path
+        return part[:len(part) - len(part.lstrip())] + path + part[len(part.rstrip()):]
+
+    def _write_control_file(self, control_file: str):
+        staged = self.local(control_file)
+        lines = []
+        # Keep the file's line endings and comments
+        with open(control_file, errors='replace', newline='') as fin:
+            for line in fin:
+                body = line.rstrip('\r\n')
+                ending = line[len(body):]
+                cut = min(
+                    (body.index(marker) for marker in ('!', '#') if marker in body),
+                    default=len(body)
+                )
+                statement, comment = body[:cut], body[cut:]
+                if '==' in statement:
+                    command, value = statement.split('==', 1)
+                    name = command.strip().lower()
+                    is_output = name.startswith(controlfiles.OUTPUT_COMMAND_PREFIXES)
+                    parts = [
+                        self._rewrite(control_file, staged, part)
+                        if is_output or controlfiles._is_path(part) else part
+                        for part in value.split('|')
+                    ]
+                    statement = '{}=={}'.format(command, '|'.join(parts))
+                lines.append(statement + comment + ending)
+
+        ensure_dir(os.path.dirname(staged))
+        with open(staged, 'w', newline='') as fout:
+            fout.writelines(lines)
+
+    def sync(self):
+        '''Copy the outputs written to scratch back to the original model.
+
+        Returns:
+            int: Number of bytes copied
+        '''
+        copied = 0
+        for output in self.outputs:
+            local = self.local(output)
+            for dirpath, _, fnames in os.walk(local):
+                target_dir = os.path.join(output, os.path.relpath(dirpath, local))
+                ensure_dir(target_dir)
+                for fname in fnames:
+                    source = os.path.join(dirpath, fname)
+                    shutil.copy2(source, os.path.join(target_dir, fname))
+                    copied += os.path.getsize(source)
+        return copied
+
+    def cleanup(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+def stage_model(tcf_file: str, cache: StagingCache, scratch: str, outputs=()):
+    '''Stage a TUFLOW model on scratch (see ``StagedModel``)
+    '''
+    return StagedModel(tcf_file, cache, scratch, outputs).stage()
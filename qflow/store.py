@@ -0,0 +1,206 @@
+'''
+Content addressed storage for model input files.
+
+Users upload the same DEMs, boundaries and materials layers again and
+again alongside different control files. Files extracted into a model
+directory are placed in a ``BlobStore`` keyed by their SHA-256 digest and
+hardlinked (or reflinked) into the model, so each unique file is only
+stored once on the worker's scratch disk.
+'''
+import errno
+import hashlib
+import os
+import shutil
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from qflow.utils import ensure_dir
+
+# ioctl request to clone a file's extents (Linux, e.g. btrfs and xfs)
+FICLONE = 0x40049409
+
+# Files the formatters rewrite or the user is likely to edit in place
+EDITABLE_EXTENSIONS = frozenset((
+    '.tcf', '.tgc', '.tbc', '.ecf', '.trd', '.tmf', '.tef', '.toc',
+    '.tesf', '.tscf', '.py'
+))
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+def _reflink(source: str, target: str):
+    '''Make ``target`` a copy-on-write clone of ``source``
+    '''
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, 'Reflinks are not supported')
+    with open(source, 'rb') as fin, open(target, 'wb') as fout:
+        try:
+            fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+        except OSError:
+            os.remove(target)
+            raise
+
+
+def link_file(source: str, target: str):
+    '''Link ``source`` to ``target``, preferring a hardlink, then a reflink,
+    falling back to a plain copy if the filesystem supports neither
+    '''
+    try:
+        os.link(source, target)
+        return
+    except OSError:
+        pass
+
+    try:
+        _reflink(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+class BlobStore(object):
+    '''A store of files named by the SHA-256 digest of their content.
+
+    The store must be on the same filesystem as the model directories
+    for hardlinks to be used. Only files of at least ``min_size`` bytes
+    which are not control files or scripts are stored; those are edited
+    in place and must never share an inode with another model.
+
+    Blobs keep their usual permissions, as hardlinked blobs are the input
+    files in the model directories which formatters and solvers open.
+    '''
+    def __init__(self, root: str, min_size: int=1024 * 1024):
+        self.root = root
+        self.min_size = min_size
+        ensure_dir(os.path.join(root, 'tmp'))
+        ensure_dir(os.path.join(root, 'crc'))
+
+    def same_filesystem(self, directory: str):
+        '''Whether files in the store can be hardlinked into ``directory``
+        '''
+        return os.stat(self.root).st_dev == os.stat(directory).st_dev
+
+    def accepts(self, path: str, size: int):
+        '''Whether a file should be stored
+        '''
+        ext = os.path.splitext(path)[1].lower()
+        return size >= self.min_size and ext not in EDITABLE_EXTENSIONS
+
+    def blob_path(self, digest: str):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def _crc_path(self, crc: int, size: int):
+        return os.path.join(self.root, 'crc', '{:08x}-{}'.format(crc, size))
+
+    def _temp_path(self):
+        return os.path.join(
+            self.root, 'tmp', '{}-{}'.format(os.getpid(), os.urandom(8).hex()))
+
+    def _remember_crc(self, crc: int, size: int, digest: str):
+        '''Record the digest of a file with a given CRC32 and size, so
+        zip members can be matched to blobs without writing them
+        '''
+        temp = self._temp_path()
+        with open(temp, 'w') as fout:
+            fout.write(digest)
+        os.replace(temp, self._crc_path(crc, size))
+
+    def _candidate(self, crc: int, size: int):
+        '''The digest of a stored blob which may match a zip member
+        '''
+        try:
+            with open(self._crc_path(crc, size)) as fin:
+                digest = fin.read().strip()
+        except OSError:
+            return None
+        return digest if os.path.exists(self.blob_path(digest)) else None
+
+    def _commit(self, temp: str, digest: str):
+        '''Move a fully written temporary file into the store
+        '''
+        blob = self.blob_path(digest)
+        if os.path.exists(blob):
+            os.remove(temp)
+        else:
+            ensure_dir(os.path.dirname(blob))
+            os.replace(temp, blob)
+        return blob
+
+    def add_stream(self, fileobj):
+        '''Copy a readable binary stream into the store.
+
+        Returns:
+            tuple: The digest and CRC32 of the stream content
+        '''
+        sha = hashlib.sha256()
+        crc = 0
+        temp = self._temp_path()
+        try:
+            with open(temp, 'wb') as fout:
+                for chunk in iter(lambda: fileobj.read(_CHUNK_SIZE), b''):
+                    sha.update(chunk)
+                    crc = zlib.crc32(chunk, crc)
+                    fout.write(chunk)
+        except Exception:
+            os.remove(temp)
+            raise
+
+        digest = sha.hexdigest()
+        self._commit(temp, digest)
+        return digest, crc
+
+    def extract_member(self, archive, info, target: str):
+        '''Extract a zip member to ``target`` via the store.
+
+        If a blob with the same CRC32 and size is already stored, the
+        member is only decompressed to confirm its digest; nothing is
+        written to disk unless the content is new.
+        '''
+        candidate = self._candidate(info.CRC, info.file_size)
+        if candidate:
+            sha = hashlib.sha256()
+            with archive.open(info) as fin:
+                for chunk in iter(lambda: fin.read(_CHUNK_SIZE), b''):
+                    sha.update(chunk)
+            digest = sha.hexdigest()
+            if digest != candidate:
+                candidate = None
+
+        if not candidate:
+            with archive.open(info) as fin:
+                digest, crc = self.add_stream(fin)
+            self._remember_crc(crc, info.file_size, digest)
+
+        link_file(self.blob_path(digest), target)
+
+    def ingest(self, path: str):
+        '''Replace a file already on disk with a link to its blob
+        '''
+        with open(path, 'rb') as fin:
+            digest, crc = self.add_stream(fin)
+        self._remember_crc(crc, os.path.getsize(path), digest)
+
+        # Link next to the file, so it is replaced within one filesystem
+        temp = '{}.{}.tmp'.format(path, os.getpid())
+        link_file(self.blob_path(digest), temp)
+        os.replace(temp, path)
+
+    def prune(self):
+        '''Remove blobs which are no longer linked into any model.
+
+        Returns:
+            int: Number of bytes freed
+        '''
+        freed = 0
+        for entry in os.scandir(self.root):
+            if not entry.is_dir() or len(entry.name) != 2:
+                continue
+            for blob in os.scandir(entry.path):
+                stat = blob.stat()
+                if stat.st_nlink == 1:
+                    os.remove(blob.path)
+                    freed += stat.st_size
+        return freed
@@ -0,0 +1,89 @@
+'''
+Supervision of solver subprocesses.
+'''
+import queue
+import threading
+
+
+class ProcessSupervisor(object):
+    '''Drain the output of a running process as it arrives.
+
+    stdout and stderr are each read on their own thread, so a process
+    which writes heavily to one pipe can never stall while we wait on
+    the other. Iterating over the supervisor yields ``(stream, line)``
+    tuples, where ``stream`` is ``'stdout'`` or ``'stderr'``, and stops
+    as soon as the process has exited and its pipes are drained.
+
+    If ``tick`` is given, ``(None, None)`` is yielded whenever the process
+    has been silent for that many seconds, so callers can do periodic work
+    without a separate timer.
+    '''
+    STREAMS = ('stdout', 'stderr')
+
+    def __init__(
+            self,
+            process,
+            encoding: str='utf-8',
+            tick: float=None,
+            grace: float=1.0):
+        self.process = process
+        self._encoding = encoding
+        self._tick = tick
+        # How long to keep reading after the process exits. Pipes inherited
+        # by an orphaned grandchild may otherwise never be closed.
+        self._grace = grace
+        self._lines = queue.Queue()
+
+    @property
+    def returncode(self):
+        return self.process.returncode
+
+    def _drain(self, name):
+        stream = getattr(self.process, name)
+        try:
+            for line in iter(stream.readline, b''):
+                self._lines.put((name, line))
+        finally:
+            stream.close()
+            self._lines.put((name, None))
+
+    def _reap(self):
+        self.process.wait()
+        self._lines.put((None, None))
+
+    def _start(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+
+    def __iter__(self):
+        open_streams = 0
+        for name in self.STREAMS:
+            if getattr(self.process, name) is not None:
+                self._start(self._drain, name)
+                open_streams += 1
+        self._start(self._reap)
+
+        exited = False
+        while open_streams or not exited:
+            try:
+                name, line = self._lines.get(timeout=self._grace if exited else self._tick)
+            except queue.Empty:
+                if exited:
+                    break
+                yield None, None
+                continue
+
+            if name is None:
+                exited = True
+            elif line is None:
+                open_streams -= 1
+            else:
+                yield name, line.decode(self._encoding, errors='replace')
+
+    def wait(self):
+        '''Discard all output and wait for the process to finish
+        '''
+        for _ in self:
+            pass
+        return self.returncode
@@ -0,0 +1,149 @@
+'''
+Summarise the results in an ANUGA .sww file.
+
+This file is run as a script by the Python interpreter of the ANUGA conda
+environment (which may be Python 2), so it only uses the standard
+library, numpy and netCDF4, and must not import qflow.
+
+Usage: python swwsummary.py SWW OUTPUT [--max-memory MB] [--minimum-depth M]
+
+The .sww file is read a chunk of timesteps at a time, with chunks sized
+to keep the arrays in memory under ``--max-memory``. For every vertex the
+summary records the maximum and minimum stage, the maximum depth, speed
+and hazard (depth x speed) and the times the maximum depth and speed
+were reached. The summary is written to OUTPUT as a compressed NetCDF
+file with the mesh of the .sww file, and its path is printed.
+'''
+from __future__ import print_function
+
+import argparse
+
+import numpy as np
+from netCDF4 import Dataset
+
+# Number of float64 arrays the size of a chunk in memory at once
+_ARRAYS_PER_CHUNK = 8
+
+SUMMARY_VARIABLES = (
+    ('max_stage', 'm'),
+    ('min_stage', 'm'),
+    ('max_depth', 'm'),
+    ('time_of_max_depth', 's'),
+    ('max_speed', 'm/s'),
+    ('time_of_max_speed', 's'),
+    ('max_hazard', 'm2/s'),
+)
+
+
+def _read(variable, start, stop):
+    return np.asarray(variable[start:stop], dtype=np.float64)
+
+
+def _update_max(current, times, values, chunk_times):
+    '''Update the running maximum and time of maximum of each vertex with
+    a chunk of values
+    '''
+    index = np.argmax(values, axis=0)
+    chunk_max = values[index, np.arange(values.shape[1])]
+    better = chunk_max > current
+    current[better] = chunk_max[better]
+    times[better] = chunk_times[index][better]
+
+
+def summarise(sww, output, max_memory=256, minimum_depth=1e-3):
+    '''Summarise ``sww`` into ``output``, holding at most around
+    ``max_memory`` MB of results in memory at once
+    '''
+    with Dataset(sww) as source:
+        variables = source.variables
+        points = len(source.dimensions['number_of_points'])
+        time = np.asarray(variables['time'][:], dtype=np.float64)
+        starttime = float(getattr(source, 'starttime', 0.0))
+
+        elevation = variables['elevation']
+        static_elevation = elevation.ndim == 1
+        if static_elevation:
+            bed = np.asarray(elevation[:], dtype=np.float64)
+
+        chunk = max(1, int(max_memory * 2**20 // (points * 8 * _ARRAYS_PER_CHUNK)))
+
+        summary = {
+            'max_stage': np.full(points, -np.inf),
+            'min_stage': np.full(points, np.inf),
+            'max_depth': np.zeros(points),
+            'time_of_max_depth': np.full(points, np.nan),
+            'max_speed': np.zeros(points),
+            'time_of_max_speed': np.full(points, np.nan),
+            'max_hazard': np.zeros(points),
+        }
+
+        for start in range(0, len(time), chunk):
+            stop = min(start + chunk, len(time))
+            chunk_times = time[start:stop] + starttime
+
+            stage = _read(variables['stage'], start, stop)
+            np.maximum(summary['max_stage'], stage.max(axis=0), out=summary['max_stage'])
+            np.minimum(summary['min_stage'], stage.min(axis=0), out=summary['min_stage'])
+
+            if static_elevation:
+                depth = stage - bed
+            else:
+                depth = stage - _read(elevation, start, stop)
+            del stage
+            np.maximum(depth, 0.0, out=depth)
+            _update_max(summary['max_depth'], summary['time_of_max_depth'], depth, chunk_times)
+
+            momentum = np.hypot(
+                _read(variables['xmomentum'], start, stop),
+                _read(variables['ymomentum'], start, stop)
+            )
+            wet = depth > minimum_depth
+            speed = np.zeros_like(depth)
+            np.divide(momentum, depth, out=speed, where=wet)
+            del momentum
+            _update_max(summary['max_speed'], summary['time_of_max_speed'], speed, chunk_times)
+
+            np.maximum(summary['max_hazard'], (depth * speed).max(axis=0), out=summary['max_hazard'])
+
+        with Dataset(output, 'w', format='NETCDF4') as target:
+            for name in source.ncattrs():
+                target.setncattr(name, source.getncattr(name))
+            target.setncattr('source', sww)
+            target.setncattr('timesteps', len(time))
+            target.setncattr('minimum_depth', minimum_depth)
+
+            target.createDimension('number_of_points', points)
+            mesh = ['x', 'y']
+            if 'volumes' in variables:
+                for name in variables['volumes'].dimensions:
+                    target.createDimension(name, len(source.dimensions[name]))
+                mesh.append('volumes')
+            for name in mesh:
+                var = variables[name]
+                out = target.createVariable(name, var.dtype, var.dimensions, zlib=True)
+                out[:] = var[:]
+
+            out = target.createVariable('elevation', 'f4', ('number_of_points',), zlib=True)
+            out[:] = bed if static_elevation else elevation[0]
+
+            for name, units in SUMMARY_VARIABLES:
+                out = target.createVariable(name, 'f4', ('number_of_points',), zlib=True)
+                out.units = units
+                out[:] = summary[name]
+    return output
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarise an ANUGA .sww file')
+    parser.add_argument('sww')
+    parser.add_argument('output')
+    parser.add_argument('--max-memory', type=float, default=256,
+                        help='Approximate memory limit in MB')
+    parser.add_argument('--minimum-depth', type=float, default=1e-3,
+                        help='Depth (m) below which the speed is taken to be zero')
+    args = parser.parse_args()
+    print(summarise(args.sww, args.output, args.max_memory, args.minimum_depth))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,112 +2,503 @@
 Celery tasks for running ANUGA or Tuflow
 '''
 import time
+import smtplib
+import sqlite3
 import subprocess
 import glob
 import os
 import base64
-from itertools import chain
+import calendar
+from datetime import datetime
+from contextlib import ExitStack
+from functools import partial
+from itertools import chain, islice
 from enum import Enum
-from celery import Task
+from celery import Task, chord, states
+from celery.signals import before_task_publish
+from celery.utils.imports import symbol_by_name
+from celery.utils.iso8601 import parse_iso8601
+from kombu.utils.encoding import bytes_to_str
 
 from qflow.celery import app
-from qflow import utils, checkers
+from qflow import utils, checkers, routing
+from qflow.accounting import ResourceMonitor
+from qflow.events import EventBatcher, ErrorDigest
+from qflow.memo import MemoStore, anuga_fingerprint, tuflow_fingerprint
+from qflow.history import RuntimeHistory, model_features
+from qflow.metrics import DEFAULT_BUCKETS, PhaseHistograms, PhaseTimer
+from qflow.packaging import package_folders
+from qflow.pool import InterpreterPool
+from qflow.progress import ProgressReporter
+from qflow.results import ResultArchive
+from qflow.solverlog import LOG_NAME, SolverLog, log_path, segments, tail, read_range
+from qflow.staging import StagingCache, stage_model
+from qflow.store import BlobStore
+from qflow.supervisor import ProcessSupervisor
+from qflow.watchdog import Watchdog
+
+checkers.parse_cache.maxsize = app.conf.get('parse_cache_size', 64)
+
+SWW_SUMMARY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'swwsummary.py')
+
+# Phase timings of the tasks run by this worker process
+phase_histograms = PhaseHistograms(app.conf.get('metrics_buckets', DEFAULT_BUCKETS))
+
 
 def make_fid(path):
     '''URL-safe base64 encoding of filepaths to transmit over a http api
     '''
     return base64.urlsafe_b64encode(path.encode('utf-8')).decode('utf-8')
 
-def make_process_results(retcode: int, data: dict):
-    '''Make a common 'result' dictionary for all tasks
+def decode_fid(fid: str):
+    '''Filepath of an id made by ``make_fid``
     '''
-    if retcode:
-        if retcode > 0:
-            data['status'] = 'FAILURE'
-        elif retcode == 0:
-            data['status'] = 'SUCCESS'
+    return base64.urlsafe_b64decode(fid.encode('utf-8')).decode('utf-8')
 
+def make_process_results(retcode: int, data: dict):
+    '''Make a common 'result' dictionary for all tasks. A nonzero
+    ``retcode`` is a failure, including a negative one from a process
+    killed by a signal. Mock runs have no ``retcode``.
+    '''
+    data['retcode'] = retcode
+    data['status'] = 'FAILURE' if retcode else 'SUCCESS'
     return data
 
+@before_task_publish.connect
+def _stamp_sent_time(headers=None, **kwargs):
+    '''Record when a task was sent, so its time in the queue can be measured.
+    The clocks of clients and workers are assumed to be in sync.
+    '''
+    if headers is not None:
+        headers.setdefault('qflow_sent', time.time())
+
+def start_timer(task):
+    '''Make a timer for the phases of a task, starting with the time it
+    spent ``queued``
+    '''
+    timer = PhaseTimer()
+    sent = task.request.get('qflow_sent')
+    if sent is not None:
+        timer.add('queued', max(0.0, time.time() - sent))
+    return timer
+
+def record_timings(task, timer: PhaseTimer, result: dict):
+    '''Add the phase timings of a task to its result, and to the
+    histograms exported to the ``metrics_dir`` setting
+    '''
+    result['timings'] = dict(timer.timings)
+    phase_histograms.observe(task.name, timer.timings)
+    directory = app.conf.get('metrics_dir', None)
+    if directory:
+        phase_histograms.export(directory)
+    return result
+
+def runtime_history():
+    '''The history of TUFLOW runtimes in the ``history_db`` setting, or
+    None if no history is kept
+    '''
+    path = app.conf.get('history_db', None)
+    if not path:
+        return None
+    return RuntimeHistory(path, recent=app.conf.get('history_recent_runs', 5))
+
+def result_archive():
+    '''The archive of task results in the ``result_archive`` setting, or
+    None if results are not archived
+    '''
+    path = app.conf.get('result_archive', None)
+    if not path:
+        return None
+    return ResultArchive(path)
+
+def find_result(task_id: str):
+    '''Look up the result of a task in the result backend, or in the
+    archive once it has expired from the backend
+
+    Returns:
+        dict: The archived record of the task (see ``qflow.results``), or
+            None if it has not finished or is unknown
+    '''
+    meta = app.backend.get_task_meta(task_id)
+    if meta['status'] in states.READY_STATES:
+        return _result_record(meta)
+    archive = result_archive()
+    return archive.get(task_id) if archive else None
+
+def _output_summary(send, stdout: str, stderr: str, lines: int, dropped: int):
+    '''Send the number of lines in a batch of solver output instead of the
+    output itself, for clients which read the solver log with ``tail_log``
+    '''
+    send(stdout='', stderr='', lines=lines, dropped=dropped, stderr_lines=stderr.count('\n'))
+
 class EventTypes(Enum):
     TUFLOW_MESSAGE = 'task-tuflow-message'
     ANUGA_MESSAGE = 'task-anuga-message'
     VALIDATION_FAIL = 'task-validation-fail'
     FOLDERS_CREATED = 'task-folders-created'
+    PROGRESS = 'task-progress'
+    ABORTED = 'task-aborted'
+    RESOURCE_USAGE = 'task-resource-usage'
+
+class SolverTask(Task):
+    '''Base class for tasks which run a solver and stream its output
+    '''
+    # Key of the solver's progress parser in the ``progress_parsers`` setting
+    solver = None
+
+    def __call__(self, *args, **kwargs):
+        '''Run the task once the ``cores`` and ``memory`` it needs are free
+        on this node; otherwise retry it later, possibly on another node
+        '''
+        cores = kwargs['cores'] = self._cores(kwargs)
+        memory = kwargs.get('memory') or 0
+        key = self.request.id or str(os.getpid())
+        try:
+            with routing.node_ledger().reserve(key, cores, memory):
+                return super(SolverTask, self).__call__(*args, **kwargs)
+        except routing.InsufficientResources as exc:
+            raise self.retry(
+                exc=exc,
+                countdown=app.conf.get('resource_retry_delay', 30),
+                max_retries=None
+            )
+
+    def _cores(self, kwargs: dict):
+        '''Number of cores to reserve for a call with ``kwargs``
+        '''
+        return kwargs.get('cores') or 1
+
+    def _batcher(self, event_type: EventTypes):
+        '''Make a batcher sending solver output as ``event_type`` events,
+        using the limits set in the celery config
+        '''
+        conf = app.conf
+        send = partial(self.send_event, event_type.value)
+        if not conf.get('stream_solver_output', True):
+            send = partial(_output_summary, send)
+        return EventBatcher(
+            send,
+            max_lines=conf.get('event_batch_lines', 200),
+            max_bytes=conf.get('event_batch_bytes', 32768),
+            interval=conf.get('event_batch_interval', 1.0),
+            rate_limit=conf.get('event_rate_limit', 2.0),
+            max_pending=conf.get('event_max_pending', 5000)
+        )
+
+    def _solver_log(self, folder: str):
+        '''Make a log capturing the solver's output in ``folder``, rotated
+        and compressed as set in the celery config
+        '''
+        conf = app.conf
+        return SolverLog(
+            os.path.join(folder, LOG_NAME),
+            max_bytes=conf.get('solver_log_max_bytes', 16 * 1024 * 1024),
+            backups=conf.get('solver_log_backups', None),
+            flush_interval=conf.get('event_batch_interval', 1.0)
+        )
+
+    def _progress(self, model: str):
+        '''Make a reporter sending the progress parsed from the solver
+        output as throttled ``task-progress`` events and a ``PROGRESS`` state
+        '''
+        parser = symbol_by_name(app.conf.get('progress_parsers')[self.solver])
+        return ProgressReporter(
+            parser.for_model(model),
+            self._report_progress,
+            interval=app.conf.get('progress_interval', 5.0)
+        )
+
+    def _report_progress(self, progress: dict):
+        self.send_event(EventTypes.PROGRESS.value, **progress)
+        if not self.request.called_directly:
+            self.update_state(state='PROGRESS', meta=progress)
+
+    def _watchdog(self, parser, rules: dict=None):
+        '''Make a watchdog for the solver's output using the solver's
+        ``watchdog_rules`` setting, updated with any ``rules`` for this run
+        '''
+        options = dict(app.conf.get('watchdog_rules', {}).get(self.solver, {}))
+        options.update(rules or {})
+        return Watchdog(parser, **options)
+
+    def _abort(self, proc, tripped: dict):
+        '''Stop an unstable run and everything it started
+        '''
+        self.send_event(EventTypes.ABORTED.value, **tripped)
+        utils.terminate_tree(proc, timeout=app.conf.get('watchdog_kill_timeout', 10))
+
+    def _monitor(self, proc):
+        '''Monitor the resources used by a solver process and its children,
+        sending ``task-resource-usage`` events every
+        ``resource_sample_interval`` seconds
+        '''
+        return ResourceMonitor(
+            proc.pid,
+            report=partial(self.send_event, EventTypes.RESOURCE_USAGE.value),
+            interval=app.conf.get('resource_sample_interval', 10.0)
+        )
+
+    def _memoised(self, fingerprint: str, run):
+        '''Return the stored result of a successful run with the same
+        ``fingerprint``, or call ``run`` and store its result if it succeeds.
+
+        While another task is running the same fingerprint, this task is
+        retried every ``memo_wait_interval`` seconds until it can return
+        that task's result, or run itself if that task failed.
+        '''
+        store = _get_memo_store()
+        owner = self.request.id or 'process-{}'.format(os.getpid())
+        while True:
+            cached = store.get(fingerprint)
+            if cached:
+                if os.path.exists(decode_fid(cached['results'])):
+                    cached['memoised'] = True
+                    return cached
+                # The results have been deleted since; run again
+                store.forget(fingerprint)
+            if store.claim(fingerprint, owner):
+                break
+            holder = store.owner(fingerprint)
+            # A task redelivered after its worker was lost already holds the claim
+            if holder == owner:
+                break
+            if holder is not None and \
+                    app.AsyncResult(holder).state not in states.READY_STATES:
+                raise self.retry(
+                    countdown=app.conf.get('memo_wait_interval', 30),
+                    max_retries=None
+                )
+            # The holder finished without storing a result, e.g. it failed
+            store.release(fingerprint, holder)
+
+        try:
+            result = run()
+            if not run_failed(result):
+                store.save(fingerprint, dict(result, memoised_from=self.request.id))
+            return result
+        finally:
+            store.release(fingerprint, owner)
+
+    def _supervise(self, proc):
+        '''Supervise a solver process, waking at least as often as
+        output batches are due to be flushed
+        '''
+        return ProcessSupervisor(
+            proc,
+            tick=app.conf.get('event_batch_interval', 1.0)
+        )
+
 
-class Anuga(Task):
+class Anuga(SolverTask):
+    solver = 'anuga'
 
-    def run(self, entry_point, env_name='anuga', email=None):
+    def _cores(self, kwargs: dict):
+        # Parallel runs with no core count use whatever is free on the node
+        if kwargs.get('parallel') and not kwargs.get('cores'):
+            return max(1, routing.node_ledger().free()[0])
+        return super(Anuga, self)._cores(kwargs)
+
+    def run(
+            self,
+            entry_point,
+            env_name='anuga',
+            email=None,
+            cores: int=1,
+            memory: int=0,
+            parallel: bool=False,
+            watchdog: dict=None,
+            summarise: bool=None,
+            memoise: bool=None):
         '''Run anuga hydro.
 
         The input python script is executed in a
         conda virtual environment named `env_name`.
-        This environment should be configured to run anuga
+        This environment should be configured to run anuga.
+
+        ``cores`` and ``memory`` (MB) are the resources the run needs,
+        and are used to route it to a suitable worker.
+
+        If ``parallel``, the script is run under MPI with one rank per core.
+        If ``cores`` is not given, every free core on the worker's node is used.
+        The output of each rank is also written to ``rank_<n>.log`` in the
+        results folder.
+
+        ``watchdog`` overrides the ``watchdog_rules`` for this run. If a rule
+        trips the run is stopped, the status is ``ABORTED`` and the rule and
+        the output which tripped it are returned under ``aborted``.
+
+        If ``summarise`` (by default, the ``anuga_summarise`` setting), each
+        .sww file written by a successful run is summarised (see
+        ``qflow/swwsummary.py``) and the ids of the summaries are returned
+        under ``summaries``.
+
+        If ``memoise`` (by default, the ``memoise_runs`` setting), the result
+        of an earlier successful run of the same script, inputs and
+        environment is returned instead of running again (see ``qflow.memo``).
         '''
-        start = time.time()
+        if summarise is None:
+            summarise = app.conf.get('anuga_summarise', False)
+        if memoise is None:
+            memoise = app.conf.get('memoise_runs', False)
+        if memoise:
+            fingerprint = anuga_fingerprint(entry_point, env_name, {
+                'ranks': cores if parallel else 1,
+                'summarise': bool(summarise)
+            })
+            return self._memoised(fingerprint, partial(
+                self.run, entry_point, env_name=env_name, email=email, cores=cores,
+                memory=memory, parallel=parallel, watchdog=watchdog, summarise=summarise,
+                memoise=False))
 
-        # Setup an emailer
-        mailer = utils.Emailer(
-            app.conf.get('smtp_host', None),
-            app.conf.get('smtp_port', None),
-            app.conf.get('smtp_user', None),
-            app.conf.get('smtp_password', None)
-        )
+        start = time.time()
+        timer = start_timer(self)
+        processes = cores if parallel else 1
 
         # Format the script to override the data directory
-        formatter = checkers.AnugaModelFormatter(entry_point)
-        results = formatter.format_output_paths()
-        proc = utils.execute_in_conda(
-            env_name,
-            entry_point
-        )
-        # Poll the process until it has finished
-        retcode = proc.poll()
-        while retcode is None:
-            # Get any output or errors, then wait a little
-            # before polling again
-            out = proc.stdout.readline()
-            err = proc.stderr.readline()
-
-            if out or err:
-                self.send_event(
-                    EventTypes.ANUGA_MESSAGE.value,
-                    stdout=out.decode('utf-8'),
-                    stderr=err.decode('utf-8')
+        with timer.phase('format_output_paths'):
+            formatter = checkers.AnugaModelFormatter(entry_point)
+            results = formatter.format_output_paths()
+        with timer.phase('launch'):
+            if processes == 1 and app.conf.get('anuga_warm_pool', False):
+                proc = _get_interpreter_pool(env_name).spawn(entry_point)
+            else:
+                proc = utils.execute_in_conda(
+                    env_name,
+                    entry_point,
+                    processes=processes
                 )
+        # Errors are coalesced into digests and emailed by a separate task,
+        # so a noisy script never holds up reading its output
+        def notify_errors(digest):
+            message = (
+                "Your running ANUGA task has emitted errors. "
+                "Messages:\n\t{}\nEntrypoint:\n\t{}\nTask ID:\n\t{}"
+            ).format(digest, entry_point, self.id)
+            send_notification.delay(email, 'Error in ANUGA task', message)
+
+        errors = ErrorDigest(
+            notify_errors,
+            interval=app.conf.get('notification_digest_interval', 300)
+        )
 
-            if err and email:
-                message = (
-                    "Your running ANUGA task has emitted an error. "
-                    "Message:\n\t{}\nEntrypoint:\n\t{}\nTask ID:\n\t{}"
-                ).format(err, entry_point, self.id)
-                mailer.send_email(email, 'Error in ANUGA task', message)
-            time.sleep(0.5)
-            retcode = proc.poll()
+        # Stream output until the process has finished
+        supervisor = self._supervise(proc)
+        monitor = self._monitor(proc)
+        progress = self._progress(entry_point)
+        watch = self._watchdog(progress.parser, watchdog)
+        tripped = None
+        with timer.phase('solver'), self._batcher(EventTypes.ANUGA_MESSAGE) as batcher, \
+                self._solver_log(results) as solver_log, ExitStack() as rank_logs:
+            logs = {}
+            for stream, line in supervisor:
+                monitor.poll()
+                if line is None:
+                    batcher.poll()
+                    solver_log.poll()
+                    progress.poll()
+                    if email:
+                        errors.poll()
+                    if not tripped and watch.poll():
+                        tripped = watch.tripped
+                        self._abort(proc, tripped)
+                    continue
+                batcher.add(stream, line)
+                solver_log.write(stream, line)
+
+                rank, text = utils.split_mpi_output(line) if processes > 1 else (None, line)
+                if rank is not None:
+                    if rank not in logs:
+                        logs[rank] = rank_logs.enter_context(
+                            open(os.path.join(results, 'rank_{}.log'.format(rank)), 'a'))
+                    logs[rank].write(text)
+                updated = progress.feed(text)
+                if not tripped and watch.feed(text, updated):
+                    tripped = watch.tripped
+                    self._abort(proc, tripped)
+
+                if stream == 'stderr' and email:
+                    errors.add(line)
+        progress.flush()
+        retcode = supervisor.returncode
+        resources = monitor.finish()
+        if email:
+            errors.flush()
 
         # Move the log file into the results folder
-        pth = os.path
-        oldpath = pth.join(pth.dirname(entry_point), 'anuga.log')
-        if pth.exists(oldpath):
-            newpath = pth.join(results, 'anuga.log')
-            os.rename(oldpath, newpath)
+        with timer.phase('move_log'):
+            pth = os.path
+            oldpath = pth.join(pth.dirname(entry_point), 'anuga.log')
+            if pth.exists(oldpath):
+                newpath = pth.join(results, 'anuga.log')
+                os.rename(oldpath, newpath)
 
-        end = time.time()
+        summaries = []
+        if summarise and not retcode and not tripped:
+            with timer.phase('summarise'):
+                summaries = self._summarise(env_name, results)
 
         # Send a success email
         if email:
-            msg = "Your ANUGA task has completed!\nTask ID: {}\n\tEntrypoint: {}".format(
-                self.id,
-                entry_point
-            )
-            mailer.send_email(email, 'ANUGA task completed', msg)
-        return make_process_results(
+            with timer.phase('notify'):
+                msg = "Your ANUGA task has completed!\nTask ID: {}\n\tEntrypoint: {}".format(
+                    self.id,
+                    entry_point
+                )
+                send_notification.delay(email, 'ANUGA task completed', msg)
+        end = time.time()
+        result = make_process_results(
             retcode,
-            {'results': make_fid(results), 'runtime': end - start}
+            {
+                'entrypoint': entry_point,
+                'results': make_fid(results),
+                'solver_log': make_fid(solver_log.path),
+                'runtime': end - start,
+                'ranks': processes,
+                'resources': resources
+            }
         )
+        if tripped:
+            result['status'] = 'ABORTED'
+            result['aborted'] = tripped
+        if summaries:
+            result['summaries'] = [make_fid(path) for path in summaries]
+        return record_timings(self, timer, result)
 
+    def _summarise(self, env_name: str, results: str):
+        '''Summarise each .sww file in the results folder, returning the
+        paths of the summaries written
+        '''
+        summaries = []
+        for sww in sorted(glob.glob(os.path.join(results, '*.sww'))):
+            output = os.path.splitext(sww)[0] + '_summary.nc'
+            proc = utils.execute_in_conda(
+                env_name,
+                SWW_SUMMARY,
+                args=[
+                    sww,
+                    output,
+                    '--max-memory', app.conf.get('anuga_summary_max_memory', 256),
+                    '--minimum-depth', app.conf.get('anuga_summary_minimum_depth', 1e-3)
+                ]
+            )
+            _, stderr = proc.communicate()
+            if proc.returncode:
+                # A failed summary leaves the results themselves intact
+                stderr = stderr.decode('utf-8', errors='replace')
+                self.send_event(
+                    EventTypes.ANUGA_MESSAGE.value,
+                    stdout='',
+                    stderr=stderr,
+                    lines=stderr.count('\n'),
+                    dropped=0
+                )
+            else:
+                summaries.append(output)
+        return summaries
 
-class Tuflow(Task):
+
+class Tuflow(SolverTask):
+    solver = 'tuflow'
 
     def run(
             self,
@@ -115,26 +506,69 @@ class Tuflow(Task):
             tflow_exe: str,
             mock: bool=False,
             runtime: int=2,
-            interval: float=0.5):
+            interval: float=0.5,
+            cores: int=1,
+            memory: int=0,
+            watchdog: dict=None,
+            memoise: bool=None):
         '''Run tuflow for a single control file
+
+        ``cores`` and ``memory`` (MB) are the resources the run needs,
+        and are used to route it to a suitable worker.
+
+        ``watchdog`` overrides the ``watchdog_rules`` for this run. If a rule
+        trips the run is stopped, the status is ``ABORTED`` and the rule and
+        the output which tripped it are returned under ``aborted``.
+
+        If ``memoise`` (by default, the ``memoise_runs`` setting), the result
+        of an earlier successful run of the same model, inputs and executable
+        is returned instead of running again (see ``qflow.memo``).
         '''
+        if memoise is None:
+            memoise = app.conf.get('memoise_runs', False)
+        if memoise:
+            fingerprint = tuflow_fingerprint(tcf_file, tflow_exe, {'mock': bool(mock)})
+            return self._memoised(fingerprint, partial(
+                self.run, tcf_file, tflow_exe, mock=mock, runtime=runtime, interval=interval,
+                cores=cores, memory=memory, watchdog=watchdog, memoise=False))
+
         start = time.time()
+        timer = start_timer(self)
         try:
-            formatter = checkers.TuflowModelFormatter(tcf_file)
-            formatter.validate_model()
+            with timer.phase('parse'):
+                formatter = checkers.TuflowModelFormatter(tcf_file)
+            with timer.phase('validate'):
+                formatter.validate_model()
         except IOError as error:
             self.send_event(
                 EventTypes.VALIDATION_FAIL.value,
                 message=str(error)
             )
-            return {
+            return record_timings(self, timer, {
                 'state': str(EventTypes.VALIDATION_FAIL),
                 'data': str(error)
-            }
+            })
+
+        # Features are read before output paths are added to the control file
+        history = None if mock else runtime_history()
+        if history:
+            with timer.phase('features'):
+                features = model_features(tcf_file)
 
-        results, check, log = formatter.format_output_paths()
+        with timer.phase('format_output_paths'):
+            results, check, log = formatter.format_output_paths()
+
+        # Run a copy of the model on node-local scratch if staging is enabled;
+        # output folders are still allocated on shared storage and synced back
+        staged = None
+        if app.conf.get('staging_dir', None):
+            with timer.phase('stage'):
+                staged = stage_model(
+                    tcf_file, _get_staging_cache(), os.path.join(app.conf.staging_dir, 'runs'),
+                    outputs=(results, check, log))
 
         # Convert all paths to url-safe id's so they can be passed as URL components
+        log_folder = log
         results = make_fid(results)
         check = make_fid(check)
         log = make_fid(log)
@@ -147,38 +581,89 @@ class Tuflow(Task):
         )
         self.runtime = runtime
         self.interval = interval
-        retcode = self._run_tuflow(tcf_file, tflow_exe, mock)
+        try:
+            with timer.phase('solver'), self._solver_log(log_folder) as solver_log:
+                retcode, tripped, resources = self._run_tuflow(
+                    staged.tcf_file if staged else tcf_file, tflow_exe, solver_log, mock, watchdog)
+        finally:
+            if staged:
+                with timer.phase('sync'):
+                    staged.sync()
+                    staged.cleanup()
+        history_error = None
+        if history and retcode == 0 and not tripped:
+            # The history may be on storage where SQLite's locking fails;
+            # that is no reason to fail a finished run
+            try:
+                history.record(features, timer.timings['solver'])
+            except sqlite3.OperationalError as error:
+                history_error = str(error)
 
         end = time.time()
-        return make_process_results(
+        result = make_process_results(
             retcode,
             {
+                'entrypoint': tcf_file,
                 'results': results,
                 'check': check,
                 'log': log,
+                'solver_log': make_fid(solver_log.path),
                 'runtime': end - start
             }
         )
+        if resources:
+            result['resources'] = resources
+        if history_error:
+            result['history_error'] = history_error
+        if staged:
+            result['staged_bytes'] = staged.staged_bytes
+            result['copied_bytes'] = staged.copied_bytes
+        if tripped:
+            result['status'] = 'ABORTED'
+            result['aborted'] = tripped
+        return record_timings(self, timer, result)
 
-    def _mock_tuflow(self):
-        '''Pretends to run tuflow
+    def _mock_tuflow(self, tcf_file: str, solver_log: SolverLog, watchdog: dict=None):
+        '''Pretends to run tuflow, printing TUFLOW style progress lines
+        as if the whole simulation takes ``runtime`` seconds
         '''
         runtime = self.runtime
         interval = self.interval
+        progress = self._progress(tcf_file)
+        watch = self._watchdog(progress.parser, watchdog)
+        span = (progress.parser.end_time or 3600) - progress.parser.start_time
+        started = time.monotonic()
         elapsed = 0
-        while elapsed < runtime:
-            time.sleep(interval)
-            elapsed += 5
-            self.send_event(
-                EventTypes.TUFLOW_MESSAGE.value,
-                stdout='Dummy message, time elapsed {}s'.format(elapsed),
-                stderr='Dummy stderr')
+        with self._batcher(EventTypes.TUFLOW_MESSAGE) as batcher:
+            while elapsed < runtime:
+                time.sleep(interval)
+                elapsed = time.monotonic() - started
+                sim_time = progress.parser.start_time + span * min(elapsed / runtime, 1.0)
+                line = ' {}:{:02d}:{:02d}  Dt 1.50  CE 0.00%\n'.format(
+                    int(sim_time // 3600), int(sim_time % 3600 // 60), int(sim_time % 60))
+                batcher.add('stdout', line)
+                batcher.add('stderr', 'Dummy stderr\n')
+                solver_log.write('stdout', line)
+                solver_log.write('stderr', 'Dummy stderr\n')
+                if watch.feed(line, progress.feed(line)):
+                    self.send_event(EventTypes.ABORTED.value, **watch.tripped)
+                    break
+        progress.flush()
+        return watch.tripped
 
-    def _run_tuflow(self, tcf_file: str, tflow_exe: str, mock: bool=True):
-        '''Run tuflow
+    def _run_tuflow(
+            self,
+            tcf_file: str,
+            tflow_exe: str,
+            solver_log: SolverLog,
+            mock: bool=True,
+            watchdog: dict=None):
+        '''Run tuflow, writing its output to ``solver_log`` and returning its
+        return code, the watchdog rule which stopped it (if any) and the
+        resources it used
         '''
         if mock:
-            self._mock_tuflow()
+            return None, self._mock_tuflow(tcf_file, solver_log, watchdog), None
         else:
             # Launch the tuflow application
             # -nmb: dont show windows message boxes
@@ -186,72 +671,250 @@ class Tuflow(Task):
             # to supress global logging
             # -od output drive for simulation
             proc = subprocess.Popen(
-                [tflow_exe, '-nmb', '-b', tcf_file], stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-
-            # Poll the process until it has finished
-            retcode = proc.poll()
-            while retcode is None:
-                # Get any output or errors, then wait a little
-                # before polling again
-                out = proc.stdout.readline()
-                err = proc.stderr.readline()
-
-                if out or err:
-                    self.send_event(
-                        'tuflow',
-                        stdout=out.decode('utf-8'),
-                        stderr=err.decode('utf-8')
-                    )
-                time.sleep(0.5)
-                retcode = proc.poll()
-            return retcode
+                [tflow_exe, '-nmb', '-b', tcf_file],
+                stderr=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                start_new_session=True
+            )
+
+            # Stream output until the process has finished
+            supervisor = self._supervise(proc)
+            monitor = self._monitor(proc)
+            progress = self._progress(tcf_file)
+            watch = self._watchdog(progress.parser, watchdog)
+            tripped = None
+            with self._batcher(EventTypes.TUFLOW_MESSAGE) as batcher:
+                for stream, line in supervisor:
+                    monitor.poll()
+                    if line is None:
+                        batcher.poll()
+                        solver_log.poll()
+                        progress.poll()
+                        check = watch.poll()
+                    else:
+                        batcher.add(stream, line)
+                        solver_log.write(stream, line)
+                        check = watch.feed(line, progress.feed(line))
+                    if check and not tripped:
+                        tripped = check
+                        self._abort(proc, tripped)
+            progress.flush()
+            retcode = supervisor.returncode
+            return retcode, tripped, monitor.finish()
+
+
+_interpreter_pools = {}
+
+
+def _get_interpreter_pool(env_name: str):
+    '''The pool of warm interpreters in a conda environment for this
+    worker process
+    '''
+    if env_name not in _interpreter_pools:
+        _interpreter_pools[env_name] = InterpreterPool(
+            utils.conda_python(env_name),
+            preload=app.conf.get('anuga_preload', ('anuga',)),
+            max_runs=app.conf.get('anuga_pool_max_runs', 50),
+            max_memory=app.conf.get('anuga_pool_max_memory', None),
+            env=utils.conda_environ(env_name)
+        )
+    return _interpreter_pools[env_name]
+
+
+_memo_store = None
+
+
+def _get_memo_store():
+    '''The store of memoised run results, in the result backend's Redis
+    '''
+    global _memo_store
+    if _memo_store is None:
+        _memo_store = MemoStore(
+            app.backend.client,
+            ttl=app.conf.get('memo_ttl', 30 * 24 * 3600),
+            claim_ttl=app.conf.get('memo_claim_ttl', 24 * 3600)
+        )
+    return _memo_store
+
+
+_staging_cache = None
+
+
+def _get_staging_cache():
+    '''The cache of model inputs on this node's scratch disk
+    '''
+    global _staging_cache
+    if _staging_cache is None:
+        _staging_cache = StagingCache(
+            os.path.join(app.conf.get('staging_dir'), 'cache'),
+            max_bytes=app.conf.get('staging_cache_max_bytes', 50 * 1024**3)
+        )
+    return _staging_cache
+
+
+_emailer = None
+
+
+def _get_emailer():
+    '''The emailer for this worker process. Its SMTP connection is
+    reused by every notification the process sends.
+    '''
+    global _emailer
+    if _emailer is None:
+        _emailer = utils.Emailer(
+            app.conf.get('smtp_host', None),
+            app.conf.get('smtp_port', None),
+            app.conf.get('smtp_user', None),
+            app.conf.get('smtp_password', None),
+            starttls=app.conf.get('smtp_starttls', True)
+        )
+    return _emailer
+
+
+@app.task(
+    bind=True,
+    ignore_result=True,
+    autoretry_for=(smtplib.SMTPException, OSError),
+    default_retry_delay=60,
+    max_retries=5)
+def send_notification(self, recipient, subject: str, body: str):
+    '''Email a notification. Routed to the ``notifications`` queue so
+    sending mail never takes a slot from a solver task.
+    '''
+    emailer = _get_emailer()
+    try:
+        emailer.send_email(recipient, subject, body)
+    except (smtplib.SMTPException, OSError):
+        emailer.close()
+        raise
 
 
 @app.task(bind=True)
-def extract_model(self, archive_path: str, model_name: str, directory: str):
+def extract_model(
+        self,
+        archive_path: str,
+        model_name: str,
+        directory: str,
+        workers: int=None):
     '''Extract a zip file to a new subdirectory of ``directory``, given by
-    ``model_name``
+    ``model_name``. Zip files are extracted by ``workers`` threads,
+    defaulting to the ``extract_workers`` setting.
 
     Returns:
         dict: Containing a key ``entrypoints`` which has a list of all *.tcf
-            and *.py files found in the root directory.
+            and *.py files found in the root directory, the number of
+            ``bytes`` extracted and the rate in ``bytes_per_second``.
     '''
-    model_directory = utils.extract_model(
-        archive_path,
-        model_name,
-        directory
-    )
+    timer = start_timer(self)
+    store_root = app.conf.get('blob_store', None)
+    store = None
+    if store_root:
+        store = BlobStore(store_root, app.conf.get('blob_store_min_size', 1024 * 1024))
+
+    with timer.phase('extract'):
+        model_directory, size = utils.extract_model(
+            archive_path,
+            model_name,
+            directory,
+            workers=workers or app.conf.get('extract_workers', None),
+            store=store
+        )
+    elapsed = timer.timings['extract']
 
     # Find all control files/anuga scripts in the model directory
-    tcf_pattern = os.path.join(model_directory, '*.tcf')
-    py_pattern = os.path.join(model_directory, '*.py')
-    entrypoints = chain.from_iterable(
-        glob.iglob(pattern) for pattern in (tcf_pattern, py_pattern)
-    )
+    with timer.phase('find_entrypoints'):
+        tcf_pattern = os.path.join(model_directory, '*.tcf')
+        py_pattern = os.path.join(model_directory, '*.py')
+        entrypoints = list(chain.from_iterable(
+            glob.iglob(pattern) for pattern in (tcf_pattern, py_pattern)
+        ))
 
-    return {'entrypoints': list(entrypoints)}
+    return record_timings(self, timer, {
+        'entrypoints': entrypoints,
+        'bytes': size,
+        'bytes_per_second': size / elapsed if elapsed > 0 else None
+    })
 
 
 @app.task(bind=True)
-def validate_model(self, tcf_file: str):
-    formatter = checkers.TuflowModelFormatter(tcf_file)
+def validate_model(self, tcf_file: str, exhaustive: bool=False):
+    '''Check the files referenced by a control file exist.
+
+    By default validation stops at the first missing file. If ``exhaustive``,
+    all referenced files are checked concurrently and every missing path
+    is returned under ``missing``.
+    '''
+    timer = start_timer(self)
     try:
-        formatter.validate_model()
+        if exhaustive:
+            with timer.phase('validate'):
+                missing = checkers.find_missing_paths(
+                    [tcf_file],
+                    app.conf.get('validation_workers', 32)
+                )[tcf_file]
+            if missing:
+                raise checkers.ValidationError(missing)
+        else:
+            with timer.phase('parse'):
+                formatter = checkers.TuflowModelFormatter(tcf_file)
+            with timer.phase('validate'):
+                formatter.validate_model()
     except IOError as error:
         self.send_event(
             EventTypes.VALIDATION_FAIL.value,
             message=str(error)
         )
-        return {
+        result = {
             'state': str(EventTypes.VALIDATION_FAIL),
             'data': str(error)
         }
+        if isinstance(error, checkers.ValidationError):
+            result['missing'] = [path for path, _ in error.missing]
+        return record_timings(self, timer, result)
 
-    return {
+    return record_timings(self, timer, {
         'state': 'SUCCESS',
         'data': {
             'controlFile': tcf_file
         }
+    })
+
+
+@app.task(bind=True)
+def validate_models(self, entrypoints: list):
+    '''Exhaustively validate a batch of control files in one task,
+    e.g. the ``entrypoints`` returned by ``extract_model``.
+    Files shared between models are only checked once.
+    Entrypoints which are not control files (i.e. ANUGA scripts) are ignored.
+
+    Returns:
+        dict: ``data`` has a list of ``valid`` control files and a mapping
+            of ``invalid`` control files to their missing paths
+    '''
+    tcf_files = [path for path in entrypoints if path.lower().endswith('.tcf')]
+    missing = checkers.find_missing_paths(
+        tcf_files,
+        app.conf.get('validation_workers', 32)
+    )
+
+    valid = [tcf for tcf in tcf_files if not missing[tcf]]
+    invalid = {
+        tcf: [path for path, _ in paths]
+        for tcf, paths in missing.items() if paths
+    }
+    for tcf, paths in missing.items():
+        if paths:
+            self.send_event(
+                EventTypes.VALIDATION_FAIL.value,
+                message=str(checkers.ValidationError(paths))
+            )
+
+    return {
+        'state': 'SUCCESS' if not invalid else str(EventTypes.VALIDATION_FAIL),
+        'data': {
+            'valid': valid,
+            'invalid': invalid
+        }
     }
 
 
@@ -269,3 +932,267 @@ def run_anuga(self, *args, **kwargs):
     See ``Anuga.__init__`` for supported arguments
     '''
     return super(self.__class__, self).run(*args, **kwargs)
+
+
+@app.task(bind=True)
+def aggregate_sweep(self, results: list, variants: list):
+    '''Collect the results of the runs of a sweep (see ``workflow.sweep``).
+    The variant control files are removed from the model's folder once
+    their runs have finished.
+
+    Returns:
+        dict: ``variants``, each with its ``control_file``, ``parameters``
+            and ``result``, and the number of runs which ``succeeded`` and
+            ``failed``
+    '''
+    collected = [
+        {'control_file': control_file, 'parameters': parameters, 'result': result}
+        for (control_file, parameters), result in zip(variants, results)
+    ]
+    for control_file, _ in variants:
+        try:
+            os.remove(control_file)
+        except FileNotFoundError:
+            pass
+    failed = sum(1 for result in results if run_failed(result))
+    return {
+        'variants': collected,
+        'succeeded': len(collected) - failed,
+        'failed': failed
+    }
+
+
+def run_failed(result):
+    '''Whether the result of a ``run_tuflow`` or ``run_anuga`` task is a
+    failure, including failed validation, an aborted run, a nonzero return
+    code or a result with no status
+    '''
+    return not isinstance(result, dict) or 'state' in result or \
+        result.get('status') != 'SUCCESS' or bool(result.get('retcode'))
+
+
+def plan_runs(
+        entrypoints: list,
+        tuflow_exe: str=None,
+        tuflow_options: dict=None,
+        anuga_options: dict=None):
+    '''Plan the runs of a model's entrypoints: control files are run with
+    ``run_tuflow`` if they are valid (and ``tuflow_exe`` is given) and
+    python scripts with ``run_anuga``. Options are passed to the tasks as
+    keyword arguments.
+
+    Returns:
+        tuple: The run signatures, the entrypoint each runs and a mapping of
+            skipped entrypoints to the reason they were skipped
+    '''
+    skipped = {}
+    tcf_files = [path for path in entrypoints if path.lower().endswith('.tcf')]
+    if tcf_files and not tuflow_exe:
+        skipped.update((tcf, 'No TUFLOW executable given') for tcf in tcf_files)
+    elif tcf_files:
+        validation = validate_models(tcf_files)
+        for tcf, missing in validation['data']['invalid'].items():
+            skipped[tcf] = 'Missing files: {}'.format(', '.join(missing))
+
+    runs = []
+    planned = []
+    for path in entrypoints:
+        if path in skipped:
+            continue
+        if path.lower().endswith('.tcf'):
+            runs.append(run_tuflow.s(path, tuflow_exe, **(tuflow_options or {})))
+        elif path.lower().endswith('.py'):
+            runs.append(run_anuga.s(path, **(anuga_options or {})))
+        else:
+            continue
+        planned.append(path)
+    return runs, planned, skipped
+
+
+@app.task(bind=True)
+def dispatch_entrypoints(
+        self,
+        extracted: dict,
+        tuflow_exe: str=None,
+        tuflow_options: dict=None,
+        anuga_options: dict=None):
+    '''Validate the entrypoints returned by ``extract_model`` and replace
+    this task with runs of the valid ones (see ``plan_runs``), collected by
+    ``collect_runs``. Invalid entrypoints are skipped rather than stopping
+    the others. See ``workflow.pipeline``.
+    '''
+    runs, planned, skipped = plan_runs(
+        extracted['entrypoints'], tuflow_exe, tuflow_options, anuga_options)
+    if not runs:
+        return collect_runs([], planned, skipped)
+    raise self.replace(chord(runs, collect_runs.s(planned, skipped)))
+
+
+@app.task(bind=True)
+def collect_runs(self, results: list, entrypoints: list, skipped: dict):
+    '''Collect the results of the runs started by ``dispatch_entrypoints``
+
+    Returns:
+        dict: ``runs``, each with its ``entrypoint`` and ``result``, the
+            ``skipped`` entrypoints and the number of runs which
+            ``succeeded`` and ``failed``
+    '''
+    failed = sum(1 for result in results if run_failed(result))
+    return {
+        'runs': [
+            {'entrypoint': entrypoint, 'result': result}
+            for entrypoint, result in zip(entrypoints, results)
+        ],
+        'skipped': skipped,
+        'succeeded': len(results) - failed,
+        'failed': failed
+    }
+
+
+@app.task(bind=True)
+def package_results(self, result: dict, workers: int=None):
+    '''Package the ``results``, ``check`` and ``log`` folders of a run into
+    a single ``.tar.gz`` file next to the results folder, so a download is a
+    single file read. Takes the result of ``run_tuflow`` or ``run_anuga``,
+    so it can be chained after either.
+
+    The package is compressed by ``workers`` threads, defaulting to the
+    ``package_workers`` setting or every core.
+
+    Returns:
+        dict: ``result``, with the ids of the ``package`` and its
+            ``manifest`` (listing the size and SHA-256 of every file) and the
+            package size in ``package_bytes``. Results without a results
+            folder (e.g. failed validation) are returned unchanged.
+    '''
+    if 'results' not in result:
+        return result
+
+    folders = {
+        name: decode_fid(result[name])
+        for name in ('results', 'check', 'log') if result.get(name)
+    }
+    archive_path = folders['results'].rstrip(os.sep) + '.tar.gz'
+    manifest = package_folders(
+        folders,
+        archive_path,
+        workers=workers or app.conf.get('package_workers', None),
+        level=app.conf.get('package_level', 6),
+        block_size=app.conf.get('package_block_size', 1024 * 1024)
+    )
+
+    result = dict(result)
+    result['package'] = make_fid(archive_path)
+    result['manifest'] = make_fid(archive_path + '.manifest.json')
+    result['package_bytes'] = manifest['size']
+    return result
+
+
+def _result_record(meta: dict):
+    '''Make an archive record from the metadata of a finished task
+    '''
+    result = meta.get('result')
+    date_done = meta.get('date_done')
+    if isinstance(date_done, str):
+        date_done = parse_iso8601(date_done)
+    if isinstance(date_done, datetime):
+        # Celery stores naive UTC times
+        date_done = calendar.timegm(date_done.utctimetuple()) + date_done.microsecond / 1e6
+    record = {
+        'task_id': meta['task_id'],
+        'status': meta['status'],
+        'date_done': date_done,
+        'traceback': meta.get('traceback'),
+        'result': result if not isinstance(result, BaseException) else repr(result)
+    }
+    if isinstance(result, dict):
+        record['entrypoint'] = result.get('entrypoint')
+        record['runtime'] = result.get('runtime')
+        record['fids'] = {
+            name: result[name]
+            for name in ('results', 'check', 'log', 'solver_log', 'summaries', 'package', 'manifest')
+            if result.get(name)
+        }
+    return record
+
+
+@app.task(bind=True)
+def archive_results(self, batch_size: int=1000):
+    '''Copy finished results from the result backend to the archive in the
+    ``result_archive`` setting, before they expire from the backend. Run
+    periodically by celery beat (see ``beat_schedule`` in celeryconfig).
+
+    Returns:
+        dict: The number of finished results ``scanned`` and the number
+            newly ``archived``
+    '''
+    archive = result_archive()
+    if archive is None:
+        return {'scanned': 0, 'archived': 0}
+
+    backend = app.backend
+    client = backend.client
+    # The key prefix is bytes on key-value backends
+    keyprefix = bytes_to_str(backend.task_keyprefix)
+    keys = client.scan_iter(match=keyprefix + '*', count=batch_size)
+    scanned = archived = 0
+    while True:
+        batch = list(islice(keys, batch_size))
+        if not batch:
+            break
+        # Results already archived are skipped without being decoded
+        task_ids = [bytes_to_str(key)[len(keyprefix):] for key in batch]
+        done = archive.archived(task_ids)
+        batch = [key for key, task_id in zip(batch, task_ids) if task_id not in done]
+
+        records = []
+        for value in client.mget(batch) if batch else ():
+            # Keys may expire between the scan and the read
+            if value is None:
+                continue
+            meta = backend.decode_result(value)
+            if meta['status'] in states.READY_STATES:
+                records.append(_result_record(meta))
+        scanned += len(records)
+        archived += archive.store(records)
+    return {'scanned': scanned, 'archived': archived}
+
+
+@app.task(bind=True)
+def tail_log(self, fid: str, lines: int=100, start: int=None, end: int=None):
+    '''Read part of a solver log without reading the whole file. ``fid``
+    is the id of a log, or of the folder holding a run's ``solver.log``
+    (e.g. the ``log`` folder of a TUFLOW run).
+
+    By default the last ``lines`` lines are returned. If ``start`` is
+    given, bytes ``start`` to ``end`` are returned instead, so a client can
+    follow a running log by asking for the bytes after the ``end`` of its
+    last read. No more than ``tail_log_max_bytes`` are returned at once.
+
+    Returns:
+        dict: The ``text`` read, the ``start`` and ``end`` byte offsets it
+            was read from, the ``size`` of the log in bytes (None for
+            compressed segments) and the ids of the compressed
+            ``segments`` rotated out of the log, oldest first
+
+    Raises:
+        ValueError: If ``fid`` is not the id of a solver log or its folder
+    '''
+    path = log_path(decode_fid(fid))
+    max_bytes = app.conf.get('tail_log_max_bytes', 1024 * 1024)
+    compressed = path.endswith('.gz')
+
+    if start is None:
+        text, start, end = tail(path, lines, max_bytes)
+    else:
+        if end is None or end - start > max_bytes:
+            end = start + max_bytes
+        text, end = read_range(path, start, end)
+
+    return {
+        'text': text,
+        'start': start,
+        'end': end,
+        'size': None if compressed else os.path.getsize(path),
+        'segments': [] if compressed else [make_fid(segment) for segment in segments(path)]
+    }
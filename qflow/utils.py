@@ -5,8 +5,16 @@ import smtplib
 import zipfile
 import tarfile
 import os
+import re
+import json
 import shlex
-from subprocess import Popen, PIPE
+import signal
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from subprocess import Popen, PIPE, call, check_output
 
 
 def ensure_dir(path: str):
@@ -31,25 +39,254 @@ def ensure_path(path: str):
 
     return path
 
-def execute_in_conda(env_name, script):
-    '''Execute Python code in a conda environment, return its stdout and stderr.'''
+def allocate_numbered_dir(root: str, digits: int=3):
+    '''Create the next free numbered directory (``000``, ``001``...) in ``root``.
 
-    # We CD into the directory of the script as anuga often expects data files to be co-located
-    # etc..
-    command_template = '/bin/bash -c "cd {} && source activate {} && python {}"'
-    command = shlex.split(command_template.format(os.path.dirname(script), env_name, script))
-    process = Popen(command, stdout=PIPE, stderr=PIPE)
+    Directories are claimed with ``os.mkdir``, which fails if the directory
+    already exists, so concurrent callers are never given the same one.
+    A counter file in ``root`` records where the last search ended, so
+    finding a free number does not slow down as runs accumulate. The
+    counter is only a hint; a stale value costs a few extra attempts.
+    '''
+    ensure_dir(root)
+    counter = os.path.join(root, '.next')
+    try:
+        with open(counter) as fin:
+            i = int(fin.read())
+    except (OSError, ValueError):
+        i = 0
+
+    while True:
+        path = os.path.join(root, str(i).zfill(digits))
+        try:
+            os.mkdir(path)
+            break
+        except FileExistsError:
+            i += 1
+
+    temp = '{}.{}.{}'.format(counter, os.getpid(), threading.get_ident())
+    with open(temp, 'w') as fout:
+        fout.write(str(i + 1))
+    os.replace(temp, counter)
+    return path
+
+
+@contextmanager
+def replace_file(path: str, mode: str='w'):
+    '''Open a temporary file for writing which replaces ``path`` once
+    closed. The original file is never written to, so any hardlinks to
+    it are left untouched.
+    '''
+    temp = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(temp, mode) as fout:
+            yield fout
+        os.replace(temp, path)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+@lru_cache(maxsize=None)
+def conda_prefix(env_name: str):
+    '''Find the directory of a conda environment by name; ``base`` is
+    conda's root prefix. Cached, so conda is only asked once per worker
+    process.
+    '''
+    info = json.loads(check_output(['conda', 'info', '--json']).decode('utf-8'))
+    if env_name == 'base':
+        return info['root_prefix']
+    for prefix in info['envs']:
+        if prefix != info['root_prefix'] and os.path.basename(prefix) == env_name:
+            return prefix
+    raise ValueError('No conda environment named {}'.format(env_name))
+
+
+def _activated(env_name: str, command):
+    '''A bash command which activates a conda environment, running the
+    scripts in its ``etc/conda/activate.d``, then runs ``command``
+    '''
+    return ['/bin/bash', '-c', 'source activate {} && exec {}'.format(
+        shlex.quote(env_name), ' '.join(shlex.quote(str(arg)) for arg in command))]
+
+
+@lru_cache(maxsize=None)
+def _conda_environ(env_name: str):
+    output = check_output(_activated(env_name, ['env', '-0']))
+    return tuple(
+        tuple(item.split('=', 1)) for item in output.decode('utf-8').split('\0') if '=' in item)
+
+
+def conda_environ(env_name: str):
+    '''Environment variables set by activating a conda environment,
+    including those set by its activation scripts (e.g. GDAL_DATA or MPI
+    settings). The environment is only activated once per worker process.
+    '''
+    return dict(_conda_environ(env_name))
+
+
+def conda_python(env_name: str):
+    '''Path of the Python interpreter in a conda environment
+    '''
+    return os.path.join(conda_prefix(env_name), 'bin', 'python')
+
+
+def execute_in_conda(env_name, script, processes: int=1, args=()):
+    '''Execute Python code in a conda environment, return its stdout and stderr.
+    ``args`` are passed to the script on its command line.
+
+    If ``processes`` is more than 1, the script is run in parallel under
+    MPI with that many ranks. Each line of output is then tagged with the
+    rank that wrote it; see ``split_mpi_output``.
+    '''
+    command = ['python', script] + list(args)
+    if processes > 1:
+        command = ['mpirun', '-np', processes, '--tag-output'] + command
+
+    # We run in the directory of the script as anuga often expects data files
+    # to be co-located etc..
+    process = Popen(
+        _activated(env_name, command),
+        cwd=os.path.dirname(os.path.abspath(script)),
+        stdout=PIPE,
+        stderr=PIPE,
+        start_new_session=True
+    )
     return process
 
 
-def extract_model(archive_path: str, name: str, directory: str):
+def terminate_tree(process, timeout: float=10.0):
+    '''Terminate a process and every process it started, killing them
+    if they have not exited after ``timeout`` seconds.
+
+    On POSIX the process must lead its own process group (e.g. be started
+    with ``start_new_session=True``) for its children to be signalled.
+    '''
+    if process.poll() is not None:
+        return
+    if os.name == 'nt':
+        call(['taskkill', '/F', '/T', '/PID', str(process.pid)])
+        return
+
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            if os.getpgid(process.pid) == process.pid:
+                os.killpg(process.pid, sig)
+            else:
+                process.send_signal(sig)
+        except ProcessLookupError:
+            return
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                return
+            time.sleep(0.1)
+
+
+# OpenMPI's --tag-output prefixes lines with [jobid,rank]<stream>:
+_MPI_TAG = re.compile(r'^\[\d+,(\d+)\]<\w+>:(.*)$', re.DOTALL)
+
+
+def split_mpi_output(line: str):
+    '''Split a line of tagged MPI output into the rank which wrote it and
+    the original line. The rank is None if the line is not tagged.
+    '''
+    match = _MPI_TAG.match(line)
+    if not match:
+        return None, line
+    return int(match.group(1)), match.group(2)
+
+
+def _archive_size(archive):
+    '''Total uncompressed size of the members of a zip or tar archive
+    '''
+    if isinstance(archive, zipfile.ZipFile):
+        return sum(info.file_size for info in archive.infolist())
+    return sum(member.size for member in archive.getmembers())
+
+
+def _zip_target(path: str, filename: str):
+    '''The path ``ZipFile.extract`` will write the member ``filename`` to
+    '''
+    arcname = os.path.splitdrive(filename.replace('/', os.path.sep))[1]
+    parts = [
+        part for part in arcname.split(os.path.sep)
+        if part not in ('', os.path.curdir, os.path.pardir)
+    ]
+    return os.path.join(path, *parts)
+
+
+def _extract_zip_members(archive_path: str, members: list, path: str, store=None):
+    '''Extract some members of a zip file using a private file handle,
+    so several threads can read the same archive at once
+    '''
+    with zipfile.ZipFile(archive_path) as archive:
+        for member in members:
+            if store and store.accepts(member.filename, member.file_size):
+                store.extract_member(archive, member, _zip_target(path, member.filename))
+            else:
+                archive.extract(member, path)
+
+
+def _extract_zip_parallel(archive: zipfile.ZipFile, path: str, workers: int, store=None):
+    '''Extract a zip file across a pool of threads.
+
+    Decompression in zlib releases the GIL and each member is streamed to
+    disk in small chunks, so memory use is bounded by the number of workers.
+    '''
+    files = [info for info in archive.infolist() if not info.filename.endswith('/')]
+
+    # Create the directory tree up front so threads don't race to make it
+    for info in archive.infolist():
+        if info.filename.endswith('/'):
+            archive.extract(info, path)
+    for target in set(os.path.dirname(_zip_target(path, info.filename)) for info in files):
+        ensure_dir(target)
+
+    # Share the members out so each thread has a similar amount of data
+    buckets = [[] for _ in range(workers)]
+    sizes = [0] * workers
+    for info in sorted(files, key=lambda info: info.file_size, reverse=True):
+        smallest = sizes.index(min(sizes))
+        buckets[smallest].append(info)
+        sizes[smallest] += info.file_size
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(_extract_zip_members, archive.filename, bucket, path, store)
+            for bucket in buckets if bucket
+        ]
+        for future in futures:
+            future.result()
+
+
+def extract_model(
+        archive_path: str,
+        name: str,
+        directory: str,
+        workers: int=None,
+        store=None):
     '''
     Extract input data from an archive.
     Archive can be any format supported by zipfile or tarfile std. lib. modules
+
+    Zip files are extracted by ``workers`` threads (default: one per CPU).
+    Tar files are read sequentially, as compressed tar streams cannot be
+    split between readers.
+
+    If a ``qflow.store.BlobStore`` is given, large input files are linked
+    from the store rather than written out for every model. A store on
+    another filesystem than ``directory`` is not used, as files can't be
+    linked across filesystems.
+
+    Returns:
+        tuple: The model directory and the number of bytes extracted
     '''
+    workers = workers or os.cpu_count() or 1
 
     # Create the model directory
     ensure_dir(directory)
+    if store and not store.same_filesystem(directory):
+        store = None
     if zipfile.is_zipfile(archive_path):
         archive = zipfile.ZipFile(archive_path)
     else:
@@ -62,27 +299,60 @@ def extract_model(archive_path: str, name: str, directory: str):
     # Check available space
     stats = os.statvfs(directory)
     freespace = stats.f_frsize * stats.f_bavail
-    total_size = sum(info.file_size for info in archive.infolist())
+    total_size = _archive_size(archive)
 
     if freespace <= total_size:
+        archive.close()
         raise IOError('Not enough space to extract model')
 
     # Extract then remove the archive
-    archive.extractall(path=model_directory)
+    if isinstance(archive, zipfile.ZipFile):
+        _extract_zip_parallel(archive, model_directory, workers, store)
+    else:
+        archive.extractall(path=model_directory)
+        if store:
+            for member in archive.getmembers():
+                if member.isfile() and store.accepts(member.name, member.size):
+                    store.ingest(os.path.join(model_directory, member.name))
     archive.close()
     os.remove(archive_path)
 
-    return model_directory
+    return model_directory, total_size
 
 
 class Emailer:
     '''Send emails via SMTP
+
+    The connection is kept open and reused for later messages, and is
+    re-established if the server has closed it in the meantime.
     '''
-    def __init__(self, host, port, user, password):
+    def __init__(self, host, port, user, password, starttls=True):
         self._host = host
         self._port = port
         self._user = user
         self._pwd = password
+        self._starttls = starttls
+        self._server = None
+
+    def _connect(self):
+        server = smtplib.SMTP(self._host, self._port)
+        server.ehlo()
+        if self._starttls:
+            server.starttls()
+            server.ehlo()
+        if self._user and self._pwd:
+            server.login(self._user, self._pwd)
+        self._server = server
+
+    def close(self):
+        '''Close the connection to the SMTP server
+        '''
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except smtplib.SMTPException:
+                pass
+            self._server = None
 
     def send_email(self, recipient, subject, body):
         '''Send an email via smtp
@@ -96,9 +366,11 @@ class Emailer:
             subject,
             body
         )
-        server = smtplib.SMTP(self._host, self._port)
-        server.ehlo()
-        server.starttls()
-        server.login(self._user, self._pwd)
-        server.sendmail(self._user, recipients, message)
-        server.close()
+        if self._server is None:
+            self._connect()
+        try:
+            self._server.sendmail(self._user, recipients, message)
+        except smtplib.SMTPServerDisconnected:
+            # Idle connections are dropped by the server; retry once
+            self._connect()
+            self._server.sendmail(self._user, recipients, message)
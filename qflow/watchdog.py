@@ -0,0 +1,126 @@
+'''
+Early abort of unstable solver runs.
+
+A ``Watchdog`` checks the progress parsed from a solver's output (see
+``qflow.progress``) and the output itself against a set of rules. The
+rules for each solver are given by the ``watchdog_rules`` setting and
+may be overridden per run.
+'''
+import re
+import time
+from collections import deque
+
+
+class Watchdog(object):
+    '''Decide whether a run has become unstable.
+
+    Rules left as None are disabled:
+
+    - ``max_mass_error``: the absolute cumulative mass error (%) exceeds this
+    - ``min_timestep``: the timestep is below this for ``timestep_patience``
+      reports in a row
+    - ``warning_pattern`` and ``max_warnings``: this many lines match the
+      pattern (a regular expression, matched case insensitively)
+    - ``stall_timeout``: simulated time has not advanced for this many
+      seconds since it was first reported
+
+    Once a rule trips, ``tripped`` holds the rule, a message and the last
+    ``evidence_lines`` lines of output, and no more checks are made.
+    '''
+    def __init__(
+            self,
+            parser,
+            max_mass_error: float=None,
+            min_timestep: float=None,
+            timestep_patience: int=10,
+            warning_pattern: str=None,
+            max_warnings: int=None,
+            stall_timeout: float=None,
+            evidence_lines: int=20):
+        self.parser = parser
+        self.max_mass_error = max_mass_error
+        self.min_timestep = min_timestep
+        self.timestep_patience = timestep_patience
+        self.warning_pattern = re.compile(warning_pattern, re.IGNORECASE) if warning_pattern else None
+        self.max_warnings = max_warnings
+        self.stall_timeout = stall_timeout
+        self.tripped = None
+        self.warnings = 0
+        self._small_steps = 0
+        self._lines = deque(maxlen=evidence_lines)
+        self._sim_time = None
+        self._advanced = None
+
+    def _trip(self, rule: str, message: str):
+        progress = self.parser.progress()
+        self.tripped = {
+            'rule': rule,
+            'message': message,
+            'sim_time': progress['sim_time'],
+            'timestep': progress['timestep'],
+            'mass_error': progress['mass_error'],
+            'warnings': self.warnings,
+            'evidence': list(self._lines)
+        }
+        return self.tripped
+
+    def feed(self, line: str, updated: bool=True):
+        '''Check a line of output, after it has been fed to the parser.
+        ``updated`` is whether the line changed the parsed progress.
+
+        Returns:
+            dict: ``tripped``, if a rule has tripped
+        '''
+        if self.tripped:
+            return self.tripped
+        self._lines.append(line)
+
+        if self.warning_pattern and self.warning_pattern.search(line):
+            self.warnings += 1
+            if self.max_warnings is not None and self.warnings >= self.max_warnings:
+                return self._trip(
+                    'max_warnings',
+                    '{} lines matched {!r}'.format(self.warnings, self.warning_pattern.pattern))
+
+        if not updated:
+            return None
+
+        parser = self.parser
+        if (self.max_mass_error is not None and parser.mass_error is not None
+                and abs(parser.mass_error) > self.max_mass_error):
+            return self._trip(
+                'max_mass_error',
+                'Mass error {}% exceeds {}%'.format(parser.mass_error, self.max_mass_error))
+
+        if self.min_timestep is not None and parser.timestep is not None:
+            if parser.timestep < self.min_timestep:
+                self._small_steps += 1
+                if self._small_steps >= self.timestep_patience:
+                    return self._trip(
+                        'min_timestep',
+                        'Timestep {} below {} for {} reports'.format(
+                            parser.timestep, self.min_timestep, self._small_steps))
+            else:
+                self._small_steps = 0
+
+        if parser.sim_time is not None and parser.sim_time != self._sim_time:
+            self._sim_time = parser.sim_time
+            self._advanced = time.monotonic()
+        return self.poll()
+
+    def poll(self):
+        '''Check for a stalled simulation. Call periodically, even when
+        there is no output.
+
+        Returns:
+            dict: ``tripped``, if a rule has tripped
+        '''
+        if self.tripped:
+            return self.tripped
+        if (self.stall_timeout is not None and self._advanced is not None
+                and time.monotonic() - self._advanced > self.stall_timeout):
+            return self._trip(
+                'stall_timeout',
+                'Simulated time stuck at {}s for over {}s'.format(
+                    self._sim_time, self.stall_timeout))
+        return None
@@ -1,5 +1,32 @@
-from celery import group
-from qflow import tasks
+import itertools
+import os
+import uuid
+from celery import chain, chord, group
+from qflow import tasks, controlfiles
+from qflow.history import model_features
+
+# Priorities run from 0 (highest) to 9 on Redis
+MAX_PRIORITY = 9
+
+
+def order_by_runtime(control_file_list, history=None):
+    '''Order control files by their predicted runtime, longest first.
+    Models with no prediction come first, as they may be long.
+
+    Returns:
+        list: ``(control file, predicted runtime)`` tuples
+    '''
+    history = history or tasks.runtime_history()
+    if history is None:
+        return [(tcf, None) for tcf in control_file_list]
+
+    predictions = [
+        (tcf, history.predict(model_features(tcf))) for tcf in control_file_list
+    ]
+    return sorted(
+        predictions,
+        key=lambda prediction: (prediction[1] is not None, -(prediction[1] or 0))
+    )
 
 
 def run_multiple(control_file_list, tuflow_exe, **kwargs):
@@ -7,12 +34,97 @@ def run_multiple(control_file_list, tuflow_exe, **kwargs):
     Create a group for running all models in a given list
     of control files.
     Can then be called like any other celery task
+
+    If a runtime history is kept (see the ``history_db`` setting), the
+    models are submitted longest predicted runtime first, with priorities
+    falling from the highest to the lowest, so the longest runs never
+    start last and stretch out the batch.
     '''
+    history = tasks.runtime_history()
+    if history is None:
+        return group(
+            tasks.run_tuflow.s(tcf, tuflow_exe, **kwargs) for tcf in control_file_list
+        )
+
+    ordered = order_by_runtime(control_file_list, history)
+    last = max(len(ordered) - 1, 1)
     task_group = group(
-        tasks.run_tuflow.s(
-            tcf,
-            tuflow_exe,
-            **kwargs
-        ) for i, tcf in enumerate(control_file_list)
+        tasks.run_tuflow.signature(
+            (tcf, tuflow_exe),
+            kwargs,
+            priority=round(MAX_PRIORITY * i / last) if predicted is not None else 0
+        ) for i, (tcf, predicted) in enumerate(ordered)
     )
     return task_group
+
+
+def write_sweep(base_tcf: str, grid: dict):
+    '''Write a control file for every combination of the values in ``grid``,
+    a mapping of control file commands to lists of values.
+
+    Variants are written next to ``base_tcf`` as ``<name>_<sweep>_<n>.tcf``
+    and share its included control files and inputs, so each variant costs
+    one small file however large the model is. ``aggregate_sweep`` removes
+    them once the sweep has run.
+
+    Returns:
+        list: ``(control file, parameters)`` tuples
+    '''
+    stem = os.path.splitext(base_tcf)[0]
+    sweep_id = uuid.uuid4().hex[:8]
+    commands = list(grid)
+    variants = []
+    for i, values in enumerate(itertools.product(*(grid[command] for command in commands))):
+        parameters = dict(zip(commands, values))
+        path = '{}_{}_{:03d}.tcf'.format(stem, sweep_id, i)
+        controlfiles.write_variant(base_tcf, path, parameters)
+        variants.append((path, parameters))
+    return variants
+
+
+def sweep(base_tcf: str, grid: dict, tuflow_exe: str, **kwargs):
+    '''
+    Create a chord running a model once for every combination of the
+    values in ``grid`` (see ``write_sweep``), e.g.::
+
+        sweep('model.tcf', {'Set Variable Event': ['Q20', 'Q100'],
+                            'End Time': [3, 6]}, tuflow_exe)()
+
+    Only statements of the .tcf itself are changed; to vary a statement
+    of an included file, vary the command which includes it instead.
+    Keyword arguments are passed to every ``run_tuflow``. The results of
+    all variants are collected by ``aggregate_sweep``.
+    '''
+    variants = write_sweep(base_tcf, grid)
+    return chord(
+        (tasks.run_tuflow.s(tcf, tuflow_exe, **kwargs) for tcf, _ in variants),
+        tasks.aggregate_sweep.s(variants)
+    )
+
+
+def pipeline(
+        archive_path: str,
+        model_name: str,
+        directory: str,
+        tuflow_exe: str=None,
+        tuflow_options: dict=None,
+        anuga_options: dict=None):
+    '''
+    Create a chain which extracts an uploaded model, validates its
+    entrypoints and runs them, so the whole path from upload to running
+    models is one message from the client.
+
+    Control files are run with ``run_tuflow`` and python scripts with
+    ``run_anuga``, with ``tuflow_options`` and ``anuga_options`` as their
+    keyword arguments. Invalid entrypoints are skipped. The final result
+    lists the result of every run and the skipped entrypoints (see
+    ``tasks.collect_runs``).
+    '''
+    return chain(
+        tasks.extract_model.s(archive_path, model_name, directory),
+        tasks.dispatch_entrypoints.s(
+            tuflow_exe=tuflow_exe,
+            tuflow_options=tuflow_options,
+            anuga_options=anuga_options
+        )
+    )
@@ -13,7 +13,8 @@ with open('HISTORY.rst') as history_file:
 
 requirements = (
     'celery>=4.0.0',
-    'redis==2.10.5'
+    'redis==2.10.5',
+    'psutil>=5.4.0'
 )
 
 dependency_links = [
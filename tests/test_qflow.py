@@ -4,12 +4,35 @@
 """Tests for `qflow` package."""
 
 import unittest
+import fnmatch
 import glob
+import hashlib
+import json
 import os
 import shutil
+import sqlite3
+import subprocess
+import sys
+import tarfile
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from unittest import mock
 from ship.tuflow import FILEPART_TYPES as fpt
 
-from qflow import tasks, utils, workflow, checkers
+from qflow import tasks, utils, workflow, checkers, controlfiles, routing, history
+from aiosmtpd.controller import Controller
+from qflow.accounting import ResourceMonitor
+from qflow.events import EventBatcher, ErrorDigest
+from qflow.memo import MemoStore, tuflow_fingerprint
+from qflow.metrics import PhaseHistograms, PhaseTimer
+from qflow.pool import InterpreterPool
+from qflow.progress import TuflowProgressParser, AnugaProgressParser
+from qflow.results import ResultArchive
+from qflow.solverlog import SolverLog, segments
+from qflow.staging import StagingCache, stage_model
+from qflow.store import BlobStore
+from qflow.supervisor import ProcessSupervisor
+from qflow.watchdog import Watchdog
 
 def _data_dir():
     # Setup commonly used paths
@@ -38,11 +61,81 @@ class QFlowTestCase(unittest.TestCase):
 
 class TestQflowUtils(QFlowTestCase):
 
+    def test_allocate_numbered_dir(self):
+        root = os.path.join(self._output, 'results')
+        paths = [utils.allocate_numbered_dir(root) for _ in range(3)]
+        self.assertEqual([os.path.basename(path) for path in paths], ['000', '001', '002'])
+
+        # A gap left by a deleted run is not reused; the counter moves on
+        os.rmdir(paths[1])
+        self.assertEqual(os.path.basename(utils.allocate_numbered_dir(root)), '003')
+
+    def test_allocate_numbered_dir_concurrent(self):
+        """Parallel workers are never given the same folder"""
+        root = os.path.join(self._output, 'results')
+        count = 400
+        with ProcessPoolExecutor(max_workers=4) as processes, \
+                ThreadPoolExecutor(max_workers=8) as threads:
+            futures = [
+                (processes if i % 2 else threads).submit(utils.allocate_numbered_dir, root)
+                for i in range(count)
+            ]
+            paths = [future.result() for future in futures]
+
+        self.assertEqual(len(set(paths)), count)
+        self.assertEqual(len(os.listdir(root)), count + 1)
+
+    def test_split_mpi_output(self):
+        self.assertEqual(
+            utils.split_mpi_output('[1,3]<stdout>:Time = 10.0000\n'),
+            (3, 'Time = 10.0000\n')
+        )
+        self.assertEqual(utils.split_mpi_output('untagged\n'), (None, 'untagged\n'))
+
+    def test_conda_environments(self):
+        """Environments are activated with their activation scripts"""
+        info = {'root_prefix': '/opt/conda', 'envs': ['/opt/conda', '/opt/conda/envs/anuga']}
+        utils.conda_prefix.cache_clear()
+        self.addCleanup(utils.conda_prefix.cache_clear)
+        with mock.patch.object(utils, 'check_output', return_value=json.dumps(info).encode()):
+            self.assertEqual(utils.conda_prefix('base'), '/opt/conda')
+            self.assertEqual(utils.conda_prefix('anuga'), '/opt/conda/envs/anuga')
+            self.assertRaises(ValueError, utils.conda_prefix, 'conda')
+
+        # Stands in for conda's activate, which runs the env's activate.d scripts
+        with open(os.path.join(self._output, 'activate'), 'w') as fout:
+            fout.write('export GDAL_DATA=/opt/conda/envs/$1/share/gdal\n')
+        path = os.pathsep.join((self._output, os.environ.get('PATH', '')))
+        utils._conda_environ.cache_clear()
+        self.addCleanup(utils._conda_environ.cache_clear)
+        with mock.patch.dict(os.environ, {'PATH': path}):
+            env = utils.conda_environ('anuga')
+            script = os.path.join(self._output, 'script.py')
+            with open(script, 'w') as fout:
+                fout.write('import os, sys\nprint(os.environ[\'GDAL_DATA\'], sys.argv[1])\n')
+            proc = utils.execute_in_conda('anuga', script, args=(3,))
+            stdout, _ = proc.communicate()
+        self.assertEqual(env['GDAL_DATA'], '/opt/conda/envs/anuga/share/gdal')
+        self.assertEqual(stdout.decode(), '/opt/conda/envs/anuga/share/gdal 3\n')
+
     def test_validation_fail(self):
         tcf_file = os.path.join(self._data_dir, 'bad_paths.tcf')
         fmt = checkers.TuflowModelFormatter(tcf_file)
         self.assertRaises(IOError, fmt.validate_model)
 
+    def test_exhaustive_validation(self):
+        """Exhaustive validation reports every missing file at once"""
+        data_copy = os.path.join(self._output, 'data')
+        shutil.copytree(self._data_dir, data_copy)
+        os.remove(os.path.join(data_copy, 'model', 'materials.csv'))
+
+        tcf_file = os.path.join(data_copy, 'bad_paths.tcf')
+        fmt = checkers.TuflowModelFormatter(tcf_file)
+        with self.assertRaises(checkers.ValidationError) as context:
+            fmt.validate_model(exhaustive=True)
+        missing = [os.path.basename(path) for path, _ in context.exception.missing]
+        self.assertEqual(missing, ['projection.prj', 'materials.csv'])
+
     def test_model_formatting(self):
         """Test the output paths are correctly formatted.
         We expect output paths to be set within the root
@@ -60,6 +153,669 @@ class TestQflowUtils(QFlowTestCase):
         for node in fmt.model.control_file_tree.filter(fpt.RESULT):
             self.assertIn(self._output, node.parameter)
 
+class TestProcessSupervisor(unittest.TestCase):
+
+    def _spawn(self, script):
+        return subprocess.Popen(
+            [sys.executable, '-c', script],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+
+    def test_drains_both_streams(self):
+        """A process flooding both pipes must not deadlock"""
+        script = (
+            "import sys\n"
+            "for i in range(20000):\n"
+            "    sys.stdout.write('out %d\\n' % i)\n"
+            "    sys.stderr.write('err %d\\n' % i)\n"
+        )
+        supervisor = ProcessSupervisor(self._spawn(script))
+        counts = {'stdout': 0, 'stderr': 0}
+        for stream, _ in supervisor:
+            counts[stream] += 1
+        self.assertEqual(counts, {'stdout': 20000, 'stderr': 20000})
+        self.assertEqual(supervisor.returncode, 0)
+
+    def test_returncode(self):
+        supervisor = ProcessSupervisor(self._spawn('import sys; sys.exit(3)'))
+        self.assertEqual(supervisor.wait(), 3)
+
+class TestResourceMonitor(unittest.TestCase):
+
+    def test_process_tree_usage(self):
+        """Usage of the solver's children is included"""
+        code = (
+            'import subprocess, sys\n'
+            'subprocess.check_call([sys.executable, "-c", '
+            '"x = bytearray(100 * 2**20); sum(range(10**7))"])\n'
+        )
+        proc = subprocess.Popen(
+            [sys.executable, '-c', code], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        snapshots = []
+        monitor = ResourceMonitor(proc.pid, report=snapshots.append, interval=0.05)
+        for _ in ProcessSupervisor(proc, tick=0.05):
+            monitor.poll()
+
+        usage = monitor.finish()
+        self.assertTrue(snapshots)
+        self.assertGreaterEqual(usage['peak_rss'], 100)
+        self.assertGreater(usage['user'], 0)
+        self.assertGreater(usage['cpu_utilisation'], 0)
+
+class TestInterpreterPool(QFlowTestCase):
+
+    def test_run_scripts(self):
+        """Scripts run in forked children, in their own directory"""
+        script = os.path.join(self._output, 'script.py')
+        with open(script, 'w') as fout:
+            fout.write(
+                "import os, sys\n"
+                "print(os.getcwd())\n"
+                "sys.stderr.write('warning\\n')\n"
+                "sys.exit(2)\n"
+            )
+
+        pool = InterpreterPool(sys.executable, preload=('json',), max_runs=2)
+        try:
+            for _ in range(3):
+                supervisor = ProcessSupervisor(pool.spawn(script))
+                output = sorted(supervisor)
+                self.assertEqual(output, [
+                    ('stderr', 'warning\n'),
+                    ('stdout', self._output + '\n')
+                ])
+                self.assertEqual(supervisor.returncode, 2)
+            # The first server was replaced after two runs
+            self.assertEqual(len(pool._servers), 1)
+            self.assertEqual(pool._servers[0].runs, 1)
+        finally:
+            pool.close()
+
+class TestMockSolver(unittest.TestCase):
+
+    def test_output_and_failures(self):
+        """The mock solver writes parsable progress and can be made to fail"""
+        from qflow import mocksolver
+        command = [
+            sys.executable, mocksolver.__file__, '-nmb', '-b', 'model.tcf',
+            '--runtime', '0.2', '--rate', '50', '--end-time', '3600'
+        ]
+        output = subprocess.check_output(command, universal_newlines=True).splitlines()
+        self.assertEqual(len(output), 11)
+        parser = TuflowProgressParser(end_time=3600)
+        for line in output:
+            parser.feed(line)
+        self.assertEqual(parser.progress()['percent'], 100.0)
+        self.assertTrue(output[-1].startswith('Mock solver finished in'))
+
+        proc = subprocess.run(
+            command + ['--fail-rate', '1'], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        self.assertEqual(proc.returncode, 1)
+        self.assertIn(b'injected failure', proc.stderr)
+
+class TestEventBatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.events = []
+
+    def _send(self, **kwargs):
+        self.events.append(kwargs)
+
+    def test_flush_on_line_count(self):
+        batcher = EventBatcher(self._send, max_lines=10, interval=60, rate_limit=None)
+        for i in range(25):
+            batcher.add('stdout', 'line {}\n'.format(i))
+        self.assertEqual([e['lines'] for e in self.events], [10, 10])
+        batcher.flush()
+        self.assertEqual(self.events[-1]['lines'], 5)
+        self.assertTrue(self.events[-1]['stdout'].startswith('line 20\n'))
+
+    def test_drops_when_rate_limited(self):
+        batcher = EventBatcher(
+            self._send, max_lines=10, interval=60, rate_limit=0.001, max_pending=50)
+        with batcher:
+            for i in range(200):
+                batcher.add('stderr', 'line {}\n'.format(i))
+        self.assertEqual(len(self.events), 2)
+        self.assertEqual(self.events[1]['lines'], 50)
+        self.assertEqual(self.events[1]['dropped'], 140)
+        self.assertTrue(self.events[1]['stderr'].endswith('line 199\n'))
+
+class TestControlFiles(QFlowTestCase):
+
+    def test_control_file_tree(self):
+        tcf_file = os.path.join(self._data_dir, 'M03_5m_001.tcf')
+        tree = [os.path.basename(path) for path in controlfiles.control_file_tree(tcf_file)]
+        self.assertEqual(tree, ['M03_5m_001.tcf', 'M03_5m_001.tgc', 'M02_5m_001.tbc'])
+
+    def test_parse_cache(self):
+        """Models are parsed once until a file in their tree changes"""
+        data_copy = os.path.join(self._output, 'data')
+        shutil.copytree(self._data_dir, data_copy)
+        tcf_file = os.path.join(data_copy, 'M03_5m_001.tcf')
+
+        cache = checkers.ParseCache(maxsize=4)
+        first = cache.load(tcf_file)
+        self.assertIsNot(cache.load(tcf_file), first)
+        self.assertEqual(len(cache._models), 1)
+        signature = cache._models[tcf_file][0]
+
+        # Touching an include invalidates the entry
+        tgc_file = os.path.join(data_copy, 'model', 'M03_5m_001.tgc')
+        stat = os.stat(tgc_file)
+        os.utime(tgc_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        cache.load(tcf_file)
+        self.assertNotEqual(cache._models[tcf_file][0], signature)
+
+class TestProgress(QFlowTestCase):
+
+    def test_tuflow_progress(self):
+        parser = TuflowProgressParser(end_time=3 * 3600)
+        self.assertFalse(parser.feed('Reading control file...\n'))
+        self.assertTrue(parser.feed(' 0:30:00  Dt  1.50  Wet 1234  CE  0.05%\n'))
+        progress = parser.progress()
+        self.assertEqual(progress['sim_time'], 1800)
+        self.assertEqual(progress['timestep'], 1.5)
+        self.assertEqual(progress['mass_error'], 0.05)
+        self.assertAlmostEqual(progress['percent'], 100 / 6)
+
+    def test_anuga_progress(self):
+        script = os.path.join(self._output, 'model.py')
+        with open(script, 'w') as fout:
+            fout.write('for t in domain.evolve(yieldstep=10, finaltime=100.0):\n    pass\n')
+        parser = AnugaProgressParser.for_model(script)
+        self.assertEqual(parser.end_time, 100.0)
+        parser.feed('Time = 25.0000, delta t in [0.27180880, 0.29315430], steps=210 (4s)\n')
+        self.assertEqual(parser.progress()['percent'], 25.0)
+        self.assertEqual(parser.timestep, 0.2718088)
+
+class TestWatchdog(unittest.TestCase):
+
+    def _feed(self, watchdog, lines):
+        for line in lines:
+            if watchdog.feed(line, watchdog.parser.feed(line)):
+                return watchdog.tripped
+
+    def test_mass_error(self):
+        watchdog = Watchdog(TuflowProgressParser(), max_mass_error=5.0)
+        tripped = self._feed(watchdog, [
+            ' 0:01:00  Dt 1.50  CE 0.10%\n',
+            ' 0:02:00  Dt 1.50  CE 7.50%\n',
+            ' 0:03:00  Dt 1.50  CE 9.00%\n'
+        ])
+        self.assertEqual(tripped['rule'], 'max_mass_error')
+        self.assertEqual(tripped['sim_time'], 120)
+        self.assertEqual(len(tripped['evidence']), 2)
+
+    def test_disabled_by_default(self):
+        """No rules are enabled unless configured"""
+        watchdog = tasks.run_tuflow._watchdog(TuflowProgressParser())
+        lines = [' 0:01:00  Dt 1.50  CE 90.00%\n'] + ['WARNING 2550 - Negative depth\n'] * 500
+        self.assertIsNone(self._feed(watchdog, lines))
+
+    def test_warnings_and_timestep(self):
+        watchdog = Watchdog(TuflowProgressParser(), warning_pattern='negative depth', max_warnings=3)
+        tripped = self._feed(watchdog, ['WARNING 2550 - Negative depth\n'] * 5)
+        self.assertEqual(tripped['warnings'], 3)
+
+        watchdog = Watchdog(AnugaProgressParser(), min_timestep=1e-3, timestep_patience=2)
+        tripped = self._feed(watchdog, [
+            'Time = 1.0, delta t in [0.0001, 0.2]\n',
+            'Time = 2.0, delta t in [0.1, 0.2]\n',
+            'Time = 2.1, delta t in [0.0001, 0.2]\n',
+            'Time = 2.2, delta t in [0.0001, 0.2]\n',
+        ])
+        self.assertEqual(tripped['rule'], 'min_timestep')
+        self.assertEqual(tripped['sim_time'], 2.2)
+
+    def test_terminate_tree(self):
+        """The solver and the processes it started are all stopped"""
+        proc = subprocess.Popen(
+            [sys.executable, '-c', 'import subprocess, sys, time\n'
+             'child = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])\n'
+             'print(child.pid, flush=True)\ntime.sleep(60)'],
+            stdout=subprocess.PIPE,
+            start_new_session=True
+        )
+        child = int(proc.stdout.readline())
+        utils.terminate_tree(proc, timeout=5)
+        self.assertEqual(proc.wait(), -15)
+        for _ in range(50):
+            try:
+                with open('/proc/{}/stat'.format(child)) as fin:
+                    if fin.read().split()[2] == 'Z':
+                        break
+            except FileNotFoundError:
+                break
+            time.sleep(0.1)
+        else:
+            self.fail('Child process still running')
+        proc.stdout.close()
+
+class TestMetrics(QFlowTestCase):
+
+    def test_phase_histograms(self):
+        timer = PhaseTimer()
+        with timer.phase('parse'):
+            pass
+        timer.add('solver', 7.5)
+        timer.add('solver', 0.5)
+        self.assertEqual(list(timer.timings), ['parse', 'solver'])
+        self.assertEqual(timer.timings['solver'], 8.0)
+
+        histograms = PhaseHistograms(buckets=(1, 10))
+        histograms.observe('qflow.tasks.run_tuflow', timer.timings)
+        path = histograms.export(self._output)
+        with open(path) as fin:
+            text = fin.read()
+        labels = 'task="qflow.tasks.run_tuflow",phase="solver"'
+        self.assertIn('qflow_task_phase_seconds_bucket{{{},le="1"}} 0'.format(labels), text)
+        self.assertIn('qflow_task_phase_seconds_bucket{{{},le="10"}} 1'.format(labels), text)
+        self.assertIn('qflow_task_phase_seconds_sum{{{}}} 8.0'.format(labels), text)
+
+class TestNotifications(unittest.TestCase):
+
+    class Handler:
+        def __init__(self):
+            self.messages = []
+            self.sessions = set()
+
+        async def handle_DATA(self, server, session, envelope):
+            self.sessions.add(id(session))
+            self.messages.append(envelope)
+            return '250 OK'
+
+    def setUp(self):
+        self.handler = self.Handler()
+        self.controller = Controller(self.handler, hostname='127.0.0.1', port=8025)
+        self.controller.start()
+
+    def tearDown(self):
+        self.controller.stop()
+
+    def test_emailer_reuses_connection(self):
+        emailer = utils.Emailer('127.0.0.1', 8025, 'qflow@localhost', '', starttls=False)
+        for i in range(3):
+            emailer.send_email('user@localhost', 'Test', 'Message {}'.format(i))
+        emailer.close()
+        self.assertEqual(len(self.handler.messages), 3)
+        self.assertEqual(len(self.handler.sessions), 1)
+
+    def test_error_digest(self):
+        digests = []
+        digest = ErrorDigest(digests.append, interval=60)
+        for _ in range(100):
+            digest.add('Warning: negative depth\n')
+        digest.add('Another error')
+        digest.flush()
+
+        # The first error is sent at once, the rest are coalesced
+        self.assertEqual(len(digests), 2)
+        self.assertIn('[x99] Warning: negative depth', digests[1])
+        self.assertIn('[x1] Another error', digests[1])
+
+class TestSweep(QFlowTestCase):
+
+    def test_write_sweep(self):
+        """Variants share the base model's inputs and differ only in the grid"""
+        data_copy = os.path.join(self._output, 'data')
+        shutil.copytree(self._data_dir, data_copy)
+        tcf_file = os.path.join(data_copy, 'M01_5m_002.tcf')
+        grid = {'End Time': [3, 6], 'Set Variable Event': ['Q20', 'Q100']}
+
+        variants = workflow.write_sweep(tcf_file, grid)
+        self.assertEqual(len(variants), 4)
+        for path, parameters in variants:
+            self.assertEqual(os.path.dirname(path), data_copy)
+            self.assertEqual(controlfiles.simulation_times(path)[1], parameters['End Time'] * 3600)
+            self.assertEqual(
+                controlfiles.read_value(path, 'Set Variable Event'), parameters['Set Variable Event'])
+            self.assertEqual(
+                set(controlfiles.referenced_paths(path)), set(controlfiles.referenced_paths(tcf_file)))
+
+        result = tasks.aggregate_sweep(
+            [{'results': 'a', 'status': 'SUCCESS'}, {'status': 'FAILURE'},
+             {'results': 'b', 'status': 'SUCCESS'}, {'results': 'c', 'status': 'SUCCESS'}], variants)
+        self.assertEqual((result['succeeded'], result['failed']), (3, 1))
+
+        # Runs killed by a signal, or with no status, are failures
+        result = tasks.aggregate_sweep(
+            [{'results': 'a', 'status': 'SUCCESS', 'retcode': 0}, {'results': 'b', 'retcode': -9},
+             {'results': 'c', 'status': 'SUCCESS', 'retcode': -15}, {'results': 'd'}], variants)
+        self.assertEqual((result['succeeded'], result['failed']), (1, 3))
+        self.assertEqual(result['variants'][1]['parameters'], variants[1][1])
+        # The variants are removed from the model's folder
+        self.assertFalse(any(os.path.exists(path) for path, _ in variants))
+
+class TestRuntimeHistory(QFlowTestCase):
+
+    def test_predict_and_order(self):
+        """Models are ordered longest predicted runtime first"""
+        data_copy = os.path.join(self._output, 'data')
+        shutil.copytree(self._data_dir, data_copy)
+        small = os.path.join(data_copy, 'M01_5m_002.tcf')
+        large = os.path.join(data_copy, 'M01_2p5m_003.tcf')
+        unknown = os.path.join(data_copy, 'M01_5m_001.tcf')
+
+        features = history.model_features(small)
+        self.assertEqual(features.cells, 170 * 200)
+        self.assertEqual(features.end_time, 3 * 3600)
+        self.assertEqual(features.timestep, 1.5)
+
+        runtimes = history.RuntimeHistory(os.path.join(self._output, 'history.db'))
+        self.assertIsNone(runtimes.predict(features))
+        runtimes.record(features, 100.0)
+        self.assertEqual(runtimes.predict(features), 100.0)
+        # Twice the resolution: four times the cells at a smaller timestep
+        self.assertAlmostEqual(runtimes.predict(history.model_features(large)), 600.0)
+
+        ordered = workflow.order_by_runtime([small, large, unknown], runtimes)
+        self.assertEqual([tcf for tcf, _ in ordered], [unknown, large, small])
+
+    def test_history_write_failure(self):
+        """A run whose runtime can't be recorded still succeeds"""
+        tasks.Tuflow.send_event = lambda *args, **kwargs: kwargs
+        tasks.app.conf.history_db = os.path.join(self._output, 'history.db')
+        self.addCleanup(setattr, tasks.app.conf, 'history_db', None)
+
+        data_copy = os.path.join(self._output, 'data')
+        shutil.copytree(self._data_dir, data_copy)
+        tcf_file = os.path.join(data_copy, 'M01_5m_001.tcf')
+        with mock.patch.object(tasks.Tuflow, '_run_tuflow', return_value=(0, None, None)), \
+                mock.patch.object(history.RuntimeHistory, 'record',
+                                  side_effect=sqlite3.OperationalError('database is locked')):
+            result = tasks.run_tuflow(tcf_file, 'tuflow_exe', mock=False)
+        self.assertEqual(result['status'], 'SUCCESS')
+        self.assertEqual(result['history_error'], 'database is locked')
+
+class TestSolverLog(QFlowTestCase):
+
+    def test_rotate_and_tail(self):
+        """Logs are rotated into compressed segments and read from the end"""
+        path = os.path.join(self._output, 'solver.log')
+        with SolverLog(path, max_bytes=1000, backups=2) as log:
+            for i in range(500):
+                log.write('stdout', 'line {:03d}\n'.format(i))
+            log.write('stderr', 'warning\n')
+        self.assertEqual(
+            [os.path.basename(segment) for segment in segments(path)],
+            ['solver.log.3.gz', 'solver.log.4.gz'])
+        self.assertLessEqual(os.path.getsize(path), 1000)
+
+        fid = tasks.make_fid(self._output)
+        result = tasks.tail_log(fid, lines=2)
+        self.assertEqual(result['text'], 'line 499\n[stderr] warning\n')
+        self.assertEqual(result['end'], result['size'])
+        self.assertEqual(len(result['segments']), 2)
+
+        # Follow the log by reading on from a byte offset
+        result = tasks.tail_log(fid, start=0, end=9)
+        self.assertEqual(result['text'], 'line 444\n')
+        self.assertEqual(result['end'], 9)
+        result = tasks.tail_log(result['segments'][0], start=9, end=18)
+        self.assertEqual(result['text'], 'line 223\n')
+
+    def test_tail_log_outside_log_folder(self):
+        """Only solver logs can be read"""
+        folder = os.path.join(self._output, 'log')
+        utils.ensure_dir(folder)
+        with SolverLog(os.path.join(folder, 'solver.log')) as log:
+            log.write('stdout', 'line\n')
+        secret = os.path.join(self._output, 'secret.txt')
+        with open(secret, 'w') as fout:
+            fout.write('secret\n')
+        os.symlink(secret, os.path.join(self._output, 'solver.log'))
+
+        for path in (secret, os.path.join(folder, os.pardir, 'secret.txt'),
+                     os.path.join(self._output, 'solver.log'), self._data_dir):
+            with self.assertRaises(ValueError):
+                tasks.tail_log(tasks.make_fid(path))
+        self.assertEqual(tasks.tail_log(tasks.make_fid(folder))['text'], 'line\n')
+
+class TestStaging(QFlowTestCase):
+
+    def test_stage_and_sync(self):
+        """Models run from scratch with inputs cached by content"""
+        # A local folder stands in for the shared mount
+        shared = os.path.join(self._output, 'shared')
+        shutil.copytree(self._data_dir, shared)
+        external = os.path.join(self._output, 'external', 'dem.asc')
+        utils.ensure_dir(os.path.dirname(external))
+        shutil.copy(os.path.join(shared, 'model', 'grid', 'dem_m01.asc'), external)
+        tgc = os.path.join(shared, 'model', 'M01_5m_002.tgc')
+        controlfiles.write_variant(tgc, tgc, {'Read GRID Zpts': external})
+        tcf_file = os.path.join(shared, 'M01_5m_002.tcf')
+        results = utils.allocate_numbered_dir(os.path.join(shared, 'results'))
+
+        scratch = os.path.join(self._output, 'scratch')
+        cache = StagingCache(os.path.join(scratch, 'cache'), max_bytes=2**30)
+        staged = stage_model(tcf_file, cache, os.path.join(scratch, 'runs'), outputs=[results])
+        self.assertGreater(staged.copied_bytes, 0)
+        for path in controlfiles.referenced_paths(staged.tcf_file):
+            self.assertTrue(path.startswith(staged.root), path)
+            self.assertIsNotNone(controlfiles.find_path(path), path)
+        staged_tgc = staged.local(tgc)
+        dem = controlfiles.resolve(staged_tgc, controlfiles.read_value(staged.tcf_file, 'Read GRID Zpts'))
+        self.assertTrue(os.path.samefile(dem, cache.fetch(external)[0]))
+        self.assertTrue(os.path.exists(os.path.join(
+            os.path.dirname(staged_tgc), 'gis', '2d_code_M01_002_R.shx')))
+
+        # A second run of the model reads nothing from shared storage
+        again = stage_model(tcf_file, cache, os.path.join(scratch, 'runs'))
+        self.assertEqual(again.copied_bytes, 0)
+        again.cleanup()
+
+        with open(os.path.join(staged.local(results), 'M01.tlf'), 'w') as fout:
+            fout.write('log')
+        staged.sync()
+        staged.cleanup()
+        self.assertTrue(os.path.exists(os.path.join(results, 'M01.tlf')))
+
+        cache.max_bytes = 0
+        self.assertGreater(cache.evict(), 0)
+        self.assertEqual(cache.size(), 0)
+
+class _DictRedis(object):
+    """The Redis commands used by MemoStore, in memory"""
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.values:
+            return None
+        self.values[key] = value
+        return True
+
+    def delete(self, key):
+        self.values.pop(key, None)
+
+    def scan_iter(self, match='*', count=None):
+        # Redis returns keys as bytes
+        return iter([key for key in self.values if fnmatch.fnmatchcase(key.decode(), match)])
+
+    def mget(self, keys):
+        return [self.values.get(key) for key in keys]
+
+class TestMemo(QFlowTestCase):
+
+    def test_fingerprint(self):
+        """Fingerprints depend on inputs but not on output paths or location"""
+        first = os.path.join(self._output, 'first')
+        second = os.path.join(self._output, 'second')
+        shutil.copytree(self._data_dir, first)
+        shutil.copytree(self._data_dir, second)
+        tcf = 'M01_5m_002.tcf'
+        fingerprint = tuflow_fingerprint(os.path.join(first, tcf), 'tuflow', {})
+
+        controlfiles.write_variant(
+            os.path.join(second, tcf), os.path.join(second, tcf), {'Output Folder': 'results/000'})
+        self.assertEqual(tuflow_fingerprint(os.path.join(second, tcf), 'tuflow', {}), fingerprint)
+        self.assertNotEqual(tuflow_fingerprint(os.path.join(second, tcf), 'other', {}), fingerprint)
+
+        # Output commands other than the output folders change the results
+        third = os.path.join(self._output, 'third')
+        for command, value in (('Output Interval (s)', 60), ('Write Restart File', 'ON')):
+            shutil.copytree(self._data_dir, third)
+            variant = controlfiles.write_variant(
+                os.path.join(third, tcf), os.path.join(third, tcf), {command: value})
+            self.assertNotEqual(tuflow_fingerprint(variant, 'tuflow', {}), fingerprint)
+            shutil.rmtree(third)
+
+        # Attributes of a GIS layer are in the .dbf next to the referenced .shp
+        with open(os.path.join(second, 'model', 'gis', '2d_code_M01_002_R.dbf'), 'ab') as fout:
+            fout.write(b'\0')
+        self.assertNotEqual(tuflow_fingerprint(os.path.join(second, tcf), 'tuflow', {}), fingerprint)
+
+    def test_memoised_run(self):
+        """An identical run returns the first run's results"""
+        tasks.Tuflow.send_event = lambda *args, **kwargs: kwargs
+        tasks._memo_store = MemoStore(_DictRedis())
+        self.addCleanup(setattr, tasks, '_memo_store', None)
+
+        data_copy = os.path.join(self._output, 'data')
+        shutil.copytree(self._data_dir, data_copy)
+        tcf_file = os.path.join(data_copy, 'M01_5m_001.tcf')
+        first = tasks.run_tuflow(tcf_file, 'tuflow_exe', mock=True, runtime=0.5, interval=0.1, memoise=True)
+        second = tasks.run_tuflow(tcf_file, 'tuflow_exe', mock=True, runtime=0.5, interval=0.1, memoise=True)
+        self.assertNotIn('memoised', first)
+        self.assertTrue(second['memoised'])
+        self.assertEqual(second['results'], first['results'])
+
+        # Once the results are deleted the model runs again
+        shutil.rmtree(tasks.decode_fid(first['results']))
+        third = tasks.run_tuflow(tcf_file, 'tuflow_exe', mock=True, runtime=0.5, interval=0.1, memoise=True)
+        self.assertNotIn('memoised', third)
+
+    def test_killed_run_not_memoised(self):
+        """A run killed by a signal fails and is not memoised"""
+        tasks.Tuflow.send_event = lambda *args, **kwargs: kwargs
+        store = MemoStore(_DictRedis())
+        tasks._memo_store = store
+        self.addCleanup(setattr, tasks, '_memo_store', None)
+
+        data_copy = os.path.join(self._output, 'data')
+        shutil.copytree(self._data_dir, data_copy)
+        tcf_file = os.path.join(data_copy, 'M01_5m_001.tcf')
+        with mock.patch.object(tasks.Tuflow, '_run_tuflow', return_value=(-9, None, None)):
+            result = tasks.run_tuflow(tcf_file, 'tuflow_exe', mock=False, memoise=True)
+        self.assertEqual((result['status'], result['retcode']), ('FAILURE', -9))
+        self.assertFalse(any(key.startswith(MemoStore.PREFIX + 'result-') for key in store.client.values))
+
+class TestResultArchive(QFlowTestCase):
+
+    def test_archive_and_lookup(self):
+        """Finished results are archived once and found by id, entrypoint and date"""
+        archive = ResultArchive(os.path.join(self._output, 'results.db'))
+        fid = tasks.make_fid('/models/results')
+        first = tasks._result_record({
+            'task_id': 'first',
+            'status': 'SUCCESS',
+            'date_done': '2018-03-01T12:00:00.500000',
+            'traceback': None,
+            'result': {'entrypoint': 'model.tcf', 'results': fid, 'runtime': 60.0, 'status': 'SUCCESS'}
+        })
+        self.assertEqual(first['date_done'], 1519905600.5)
+        self.assertEqual(first['fids'], {'results': fid})
+        failed = tasks._result_record({
+            'task_id': 'failed',
+            'status': 'FAILURE',
+            'date_done': '2018-03-02T12:00:00',
+            'traceback': 'Traceback...',
+            'result': ValueError('bad model')
+        })
+
+        self.assertEqual(archive.store([first, failed]), 2)
+        self.assertEqual(archive.store([first]), 0)
+        self.assertEqual(archive.archived(['first', 'unknown']), {'first'})
+        self.assertEqual(archive.get('first')['result']['runtime'], 60.0)
+        self.assertEqual(archive.get('failed')['result'], "ValueError('bad model')")
+        self.assertEqual([r['task_id'] for r in archive.for_entrypoint('model.tcf')], ['first'])
+        self.assertEqual(
+            [r['task_id'] for r in archive.between(1519905600, 1520000000)], ['failed', 'first'])
+        self.assertIsNone(archive.get('unknown'))
+
+    def test_archive_results(self):
+        """The periodic task archives finished results from Redis"""
+        from celery import Celery, states
+        from celery.backends.redis import RedisBackend
+
+        backend = RedisBackend(app=tasks.app, url='redis://localhost:6379/0')
+        client = _DictRedis()
+        for task_id, status in (('done', states.SUCCESS), ('running', states.STARTED)):
+            client.values[backend.get_key_for_task(task_id)] = backend.encode({
+                'task_id': task_id,
+                'status': status,
+                'result': {'entrypoint': 'model.tcf', 'runtime': 1.0},
+                'date_done': '2018-03-01T12:00:00',
+                'traceback': None,
+                'children': []
+            })
+
+        tasks.app.conf.result_archive = os.path.join(self._output, 'results.db')
+        self.addCleanup(setattr, tasks.app.conf, 'result_archive', None)
+        with mock.patch.object(RedisBackend, 'client', client, create=True), \
+                mock.patch.object(Celery, 'backend', backend):
+            self.assertEqual(tasks.archive_results(), {'scanned': 1, 'archived': 1})
+            self.assertEqual(tasks.archive_results(), {'scanned': 0, 'archived': 0})
+        self.assertEqual(tasks.result_archive().get('done')['entrypoint'], 'model.tcf')
+        self.assertIsNone(tasks.result_archive().get('running'))
+
+class TestRouting(QFlowTestCase):
+
+    def test_route_by_resources(self):
+        route = routing.route_task('qflow.tasks.run_anuga', (), {'cores': 4, 'memory': 8000}, {})
+        self.assertEqual(route, {'queue': 'qflow.medium'})
+        route = routing.route_task('qflow.tasks.run_tuflow', ('model.tcf', 'tuflow'), {}, {})
+        self.assertEqual(route, {'queue': 'qflow.small'})
+        self.assertIsNone(routing.route_task('qflow.tasks.extract_model', (), {}, {}))
+
+    def test_resource_ledger(self):
+        ledger = routing.ResourceLedger(os.path.join(self._output, 'ledger.json'), 4, 8000)
+        with ledger.reserve('first', 3, 1000):
+            self.assertEqual(ledger.free(), (1, 7000))
+            with self.assertRaises(routing.InsufficientResources):
+                with ledger.reserve('second', 2, 0):
+                    pass
+        self.assertEqual(ledger.free(), (4, 8000))
+
+class TestSwwSummary(QFlowTestCase):
+
+    def test_chunked_summary(self):
+        """Summaries are the same however many timesteps are read at once"""
+        import numpy as np
+        from netCDF4 import Dataset
+        from qflow import swwsummary
+
+        sww = os.path.join(self._output, 'model.sww')
+        depth = np.array([[0.0, 1.0], [2.0, 0.5], [1.0, 3.0]])
+        with Dataset(sww, 'w', format='NETCDF3_64BIT') as fout:
+            fout.starttime = 100.0
+            fout.createDimension('number_of_points', 2)
+            fout.createDimension('number_of_timesteps', None)
+            for name in ('x', 'y', 'elevation'):
+                fout.createVariable(name, 'f4', ('number_of_points',))[:] = [0.0, 1.0]
+            fout.createVariable('time', 'f4', ('number_of_timesteps',))[:] = [0.0, 10.0, 20.0]
+            dims = ('number_of_timesteps', 'number_of_points')
+            fout.createVariable('stage', 'f4', dims)[:] = depth + [0.0, 1.0]
+            fout.createVariable('xmomentum', 'f4', dims)[:] = depth * 2
+            fout.createVariable('ymomentum', 'f4', dims)[:] = 0.0
+
+        whole = swwsummary.summarise(sww, os.path.join(self._output, 'whole.nc'))
+        chunked = swwsummary.summarise(
+            sww, os.path.join(self._output, 'chunked.nc'), max_memory=1e-6)
+        with Dataset(whole) as first, Dataset(chunked) as second:
+            for name, _ in swwsummary.SUMMARY_VARIABLES:
+                self.assertEqual(list(first[name][:]), list(second[name][:]))
+            self.assertEqual(list(first['max_depth'][:]), [2.0, 3.0])
+            self.assertEqual(list(first['time_of_max_depth'][:]), [110.0, 120.0])
+            self.assertEqual(list(first['max_speed'][:]), [2.0, 2.0])
+            self.assertEqual(list(first['max_hazard'][:]), [4.0, 6.0])
+
 class TestQflowTasks(QFlowTestCase):
     """Tests for `qflow` package."""
 
@@ -79,6 +835,60 @@ class TestQflowTasks(QFlowTestCase):
         result = tasks.extract_model(self._archive, 'test_model', self._output)
         self.assertIn('entrypoints', result)
         self.assertEqual(len(result['entrypoints']), 6)
+        self.assertGreater(result['bytes'], 0)
+        self.assertIn('bytes_per_second', result)
+
+    def test_extract_tar(self):
+        """Test extracting a model from a compressed tar file"""
+        archive = shutil.make_archive(
+            os.path.join(self._output, 'test'),
+            'gztar',
+            self._data_dir,
+            '.'
+        )
+        result = tasks.extract_model(archive, 'test_model', self._output)
+        self.assertEqual(len(result['entrypoints']), 6)
+
+    def test_extract_serial_matches_parallel(self):
+        """Parallel and serial zip extraction produce the same tree"""
+        serial_archive = shutil.copy(self._archive, self._archive + '.copy')
+        serial, _ = utils.extract_model(serial_archive, 'serial', self._output, workers=1)
+        parallel, _ = utils.extract_model(self._archive, 'parallel', self._output, workers=4)
+
+        def tree(root):
+            return sorted(
+                (os.path.relpath(os.path.join(dirpath, fname), root),
+                 os.path.getsize(os.path.join(dirpath, fname)))
+                for dirpath, _, fnames in os.walk(root) for fname in fnames
+            )
+        self.assertEqual(tree(serial), tree(parallel))
+
+    def test_extract_deduplicates_inputs(self):
+        """Repeat uploads share input files through the blob store"""
+        store = BlobStore(os.path.join(self._output, 'store'), min_size=1024)
+        copy = shutil.copy(self._archive, self._archive + '.copy')
+        other = shutil.copy(self._archive, self._archive + '.other')
+        first, _ = utils.extract_model(self._archive, 'first', self._output, store=store)
+        second, _ = utils.extract_model(copy, 'second', self._output, store=store)
+
+        dem = os.path.join('model', 'grid', 'dem_m01.asc')
+        self.assertTrue(os.path.samefile(
+            os.path.join(first, dem),
+            os.path.join(second, dem)
+        ))
+        # Control files are rewritten in place, so are never shared
+        tcf = 'M01_5m_001.tcf'
+        self.assertFalse(os.path.samefile(
+            os.path.join(first, tcf),
+            os.path.join(second, tcf)
+        ))
+        # Linked inputs can still be opened for writing by the formatters
+        self.assertTrue(os.stat(os.path.join(first, dem)).st_mode & 0o200)
+
+        # A store on another filesystem is not used
+        with mock.patch.object(BlobStore, 'same_filesystem', return_value=False):
+            third, _ = utils.extract_model(other, 'third', self._output, store=store)
+        self.assertFalse(os.path.samefile(os.path.join(first, dem), os.path.join(third, dem)))
 
     def test_validate(self):
         """Test a model passes validation"""
@@ -92,6 +902,33 @@ class TestQflowTasks(QFlowTestCase):
         }
         self.assertEqual(result, expected)
 
+    def test_validate_models(self):
+        """Test validating a batch of entrypoints in one task"""
+        entrypoints = glob.glob(os.path.join(self._data_dir, '*.tcf'))
+        result = tasks.validate_models(entrypoints)
+        self.assertEqual(len(result['data']['valid']), 5)
+        self.assertEqual(
+            list(result['data']['invalid']),
+            [os.path.join(self._data_dir, 'bad_paths.tcf')]
+        )
+
+    def test_plan_runs(self):
+        """Invalid entrypoints are skipped and the rest planned by solver"""
+        entrypoints = sorted(glob.glob(os.path.join(self._data_dir, '*.tcf')))
+        script = os.path.join(self._data_dir, 'model.py')
+        bad_paths = os.path.join(self._data_dir, 'bad_paths.tcf')
+        runs, planned, skipped = tasks.plan_runs(
+            entrypoints + [script], 'tuflow', anuga_options={'cores': 4})
+
+        self.assertEqual(list(skipped), [bad_paths])
+        self.assertEqual(planned, [path for path in entrypoints if path != bad_paths] + [script])
+        self.assertEqual([run.task for run in runs], ['qflow.tasks.run_tuflow'] * 5 + ['qflow.tasks.run_anuga'])
+        self.assertEqual(runs[-1].kwargs, {'cores': 4})
+
+        result = tasks.collect_runs(
+            [{'results': 'a', 'status': 'SUCCESS'}, {'status': 'ABORTED'}], planned[:2], skipped)
+        self.assertEqual((result['succeeded'], result['failed']), (1, 1))
+
     def test_fail_validate(self):
         """Test a model fails validation properly"""
         tcf_file = os.path.join(self._data_dir, 'bad_paths.tcf')
@@ -110,6 +947,30 @@ class TestQflowTasks(QFlowTestCase):
         tcf_file = os.path.join(data_copy, 'M01_5m_001.tcf')
         result = tasks.run_tuflow(tcf_file, 'tuflow_exe', mock=True, runtime=2, interval=0.5)
         self.assertIn('results', result)
+        self.assertEqual(
+            list(result['timings']), ['parse', 'validate', 'format_output_paths', 'solver'])
+
+    def test_package_results(self):
+        """Run outputs are packaged with a manifest of their checksums"""
+        tasks.Tuflow.send_event = lambda *args, **kwargs: kwargs
+        data_copy = os.path.join(self._output, 'data')
+        shutil.copytree(self._data_dir, data_copy)
+        tcf_file = os.path.join(data_copy, 'M01_5m_001.tcf')
+        result = tasks.run_tuflow(tcf_file, 'tuflow_exe', mock=True, runtime=0.5, interval=0.1)
+
+        results = tasks.decode_fid(result['results'])
+        with open(os.path.join(results, 'M01_5m_001_h.dat'), 'wb') as fout:
+            fout.write(os.urandom(100000) * 30)
+
+        packaged = tasks.package_results(result, workers=4)
+        with open(tasks.decode_fid(packaged['manifest'])) as fin:
+            manifest = json.load(fin)
+        files = {entry['path']: entry for entry in manifest['files']}
+        self.assertIn('log/solver.log', files)
+        with tarfile.open(tasks.decode_fid(packaged['package'])) as tar:
+            data = tar.extractfile('results/M01_5m_001_h.dat').read()
+        self.assertEqual(len(data), files['results/M01_5m_001_h.dat']['size'])
+        self.assertEqual(hashlib.sha256(data).hexdigest(), files['results/M01_5m_001_h.dat']['sha256'])
 
     def test_run_all(self):
         """Test end-to-end: extract model and run all"""
@@ -5,6 +5,8 @@ apt-get update
 apt-get install -y gcc gfortran
 gcc -v
 conda install -y nomkl nose numpy scipy matplotlib netcdf4
+# mpi4py is needed to run ANUGA in parallel
+conda install -y mpi4py
 conda install -y -c pingucarsti gdal
 git clone https://github.com/GeoscienceAustralia/anuga_core.git
 cd anuga_core/
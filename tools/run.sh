@@ -1,4 +1,21 @@
 #!/bin/bash
 
-# Run a celery qflow worker
-celery -A qflow worker -l info -Ofair
+# Subscribe to the queues of tasks which fit on this node, and run as many
+# processes as there are cores. Larger tasks reserve several cores each.
+QUEUES=$(python -m qflow.routing)
+CONCURRENCY=$(python -m qflow.routing --concurrency)
+
+# Run a celery qflow worker for model runs
+celery -A qflow worker -l info -Ofair -Q celery,$QUEUES -c $CONCURRENCY -n qflow@%h &
+
+# Run a small worker to send email notifications, so that
+# sending mail never takes a slot from a model run
+celery -A qflow worker -l info -Q notifications -c 1 -n notifications@%h &
+
+# Schedule periodic tasks, such as archiving results before they expire
+# from Redis. Only one node should run the scheduler; set QFLOW_BEAT on it.
+if [ -n "$QFLOW_BEAT" ]; then
+    celery -A qflow beat -l info &
+fi
+
+wait